@@ -0,0 +1,243 @@
+# ***********************************************************************
+# ******************  CANADIAN ASTRONOMY DATA CENTRE  *******************
+# *************  CENTRE CANADIEN DE DONNÉES ASTRONOMIQUES  **************
+#
+#  (c) 2026.                            (c) 2026.
+#  Government of Canada                 Gouvernement du Canada
+#  National Research Council            Conseil national de recherches
+#  Ottawa, Canada, K1A 0R6              Ottawa, Canada, K1A 0R6
+#  All rights reserved                  Tous droits réservés
+#
+#  NRC disclaims any warranties,        Le CNRC dénie toute garantie
+#  expressed, implied, or               énoncée, implicite ou légale,
+#  statutory, of any kind with          de quelque nature que ce
+#  respect to the software,             soit, concernant le logiciel,
+#  including without limitation         y compris sans restriction
+#  any warranty of merchantability      toute garantie de valeur
+#  or fitness for a particular          marchande ou de pertinence
+#  purpose. NRC shall not be            pour un usage particulier.
+#  liable in any event for any          Le CNRC ne pourra en aucun cas
+#  damages, whether direct or           être tenu responsable de tout
+#  indirect, special or general,        dommage, direct ou indirect,
+#  consequential or incidental,         particulier ou général,
+#  arising from the use of the          accessoire ou fortuit, résultant
+#  software.  Neither the name          de l'utilisation du logiciel. Ni
+#  of the National Research             le nom du Conseil National de
+#  Council of Canada nor the            Recherches du Canada ni les noms
+#  names of its contributors may        de ses  participants ne peuvent
+#  be used to endorse or promote        être utilisés pour approuver ou
+#  products derived from this           promouvoir les produits dérivés
+#  software without specific prior      de ce logiciel sans autorisation
+#  written permission.                  préalable et particulière
+#                                       par écrit.
+#
+#  This file is part of the             Ce fichier fait partie du projet
+#  OpenCADC project.                    OpenCADC.
+#
+#  OpenCADC is free software:           OpenCADC est un logiciel libre ;
+#  you can redistribute it and/or       vous pouvez le redistribuer ou le
+#  modify it under the terms of         modifier suivant les termes de
+#  the GNU Affero General Public        la “GNU Affero General Public
+#  License as published by the          License” telle que publiée
+#  Free Software Foundation,            par la Free Software Foundation
+#  either version 3 of the              : soit la version 3 de cette
+#  License, or (at your option)         licence, soit (à votre gré)
+#  any later version.                   toute version ultérieure.
+#
+#  OpenCADC is distributed in the       OpenCADC est distribué
+#  hope that it will be useful,         dans l’espoir qu’il vous
+#  but WITHOUT ANY WARRANTY;            sera utile, mais SANS AUCUNE
+#  without even the implied             GARANTIE : sans même la garantie
+#  warranty of MERCHANTABILITY          implicite de COMMERCIALISABILITÉ
+#  or FITNESS FOR A PARTICULAR          ni d’ADÉQUATION À UN OBJECTIF
+#  PURPOSE.  See the GNU Affero         PARTICULIER. Consultez la Licence
+#  General Public License for           Générale Publique GNU Affero
+#  more details.                        pour plus de détails.
+#
+#  You should have received             Vous devriez avoir reçu une
+#  a copy of the GNU Affero             copie de la Licence Générale
+#  General Public License along         Publique GNU Affero avec
+#  with OpenCADC.  If not, see          OpenCADC ; si ce n’est
+#  <http://www.gnu.org/licenses/>.      pas le cas, consultez :
+#                                       <http://www.gnu.org/licenses/>.
+#
+#  $Revision: 4 $
+# ***********************************************************************
+#
+
+import errno
+import os
+import sys
+import tempfile
+import threading
+import unittest
+
+from unittest.mock import MagicMock, Mock, patch
+from vos import commands, vos
+from vos.vos import Client, Node
+
+
+class TestVcp(unittest.TestCase):
+
+    @patch('vos.vos.Client')
+    def test_vcp_nstreams(self, vos_client_mock):
+        tmp_dir = tempfile.TemporaryDirectory()
+        src_dir = os.path.join(tmp_dir.name, 'src')
+        os.makedirs(os.path.join(src_dir, 'subdir'))
+        file_names = ['file{}'.format(i) for i in range(10)]
+        for name in file_names:
+            open(os.path.join(src_dir, name), 'w').write('test')
+            open(os.path.join(src_dir, 'subdir', name), 'w').write('test')
+
+        copied = []
+        copy_threads = set()
+
+        def copy(source, destination, head=None):
+            copy_threads.add(threading.get_ident())
+            copied.append((source, destination))
+
+        client = vos_client_mock.return_value
+        client.is_remote_file.side_effect = lambda name: name.startswith(
+            'vos:')
+        client.isdir.side_effect = lambda name: name == 'vos:dest'
+        client.copy.side_effect = copy
+
+        sys.argv = ['vcp', '--nstreams', '4', src_dir, 'vos:dest']
+        commands.vcp()
+
+        expected = []
+        for name in file_names:
+            expected.append((os.path.join(src_dir, name),
+                             os.path.join('vos:dest/src', name)))
+            expected.append((os.path.join(src_dir, 'subdir', name),
+                             os.path.join('vos:dest/src/subdir', name)))
+        assert sorted(expected) == sorted(copied)
+        client.mkdir.assert_any_call('vos:dest/src')
+        client.mkdir.assert_any_call('vos:dest/src/subdir')
+        # files copied by the workers and not by the main thread
+        assert threading.get_ident() not in copy_threads
+
+    @patch('vos.vos.Client')
+    def test_vcp_nstreams_error(self, vos_client_mock):
+        tmp_dir = tempfile.TemporaryDirectory()
+        src_dir = os.path.join(tmp_dir.name, 'src')
+        os.makedirs(src_dir)
+        open(os.path.join(src_dir, 'file1'), 'w').write('test')
+
+        client = vos_client_mock.return_value
+        client.is_remote_file.side_effect = lambda name: name.startswith(
+            'vos:')
+        client.isdir.side_effect = lambda name: name == 'vos:dest'
+        client.copy.side_effect = RuntimeError('Failed')
+
+        # errors in the workers are reported just like in a serial copy
+        sys.argv = ['vcp', '--nstreams', '2', src_dir, 'vos:dest']
+        with self.assertRaises(SystemExit):
+            commands.vcp()
+
+    @patch('vos.commands.vcp.AdaptiveConcurrency')
+    @patch('vos.vos.Client')
+    def test_vcp_adaptive(self, vos_client_mock, controller_mock):
+        tmp_dir = tempfile.TemporaryDirectory()
+        src_dir = os.path.join(tmp_dir.name, 'src')
+        os.makedirs(src_dir)
+        for i in range(5):
+            open(os.path.join(src_dir, 'file{}'.format(i)), 'w').write('test')
+
+        client = vos_client_mock.return_value
+        client.is_remote_file.side_effect = lambda name: name.startswith(
+            'vos:')
+        client.isdir.side_effect = lambda name: name == 'vos:dest'
+
+        sys.argv = ['vcp', '--nstreams', '4', '--adaptive', src_dir,
+                    'vos:dest']
+        commands.vcp()
+
+        # the number of streams adapts up to --nstreams
+        controller_mock.assert_called_once_with(4)
+        controller = controller_mock.return_value
+        client.add_response_hook.assert_called_with(controller.response_hook)
+        assert 5 == controller.acquire.call_count
+        assert 5 == controller.release.call_count
+        controller.release.assert_called_with(4)
+
+    @patch('vos.vos.Client')
+    def test_vcp_nstreams_remote_listing(self, vos_client_mock):
+        tmp_dir = tempfile.TemporaryDirectory()
+        dest_dir = os.path.join(tmp_dir.name, 'dest')
+        os.makedirs(dest_dir)
+        file_names = ['file{}'.format(i) for i in range(5)]
+
+        def child(name, is_dir=False):
+            node = Mock()
+            node.name = name
+            node.isdir.return_value = is_dir
+            node.islink.return_value = False
+            return node
+
+        children = {'vos:src': [child(name) for name in file_names] +
+                    [child('subdir', True)],
+                    'vos:src/subdir': [child('file5')]}
+        isdir_threads = {}
+
+        def isdir(name):
+            isdir_threads.setdefault(name, set()).add(threading.get_ident())
+            return name in children
+
+        copied = []
+        client = vos_client_mock.return_value
+        client.is_remote_file.side_effect = lambda name: name.startswith(
+            'vos:')
+        client.isdir.side_effect = isdir
+        client.glob.side_effect = lambda pattern: [pattern]
+        client.get_node.return_value.islink.return_value = False
+        client.get_children_info.side_effect = \
+            lambda name, force=False: iter(children[name])
+        client.copy.side_effect = \
+            lambda source, destination, head=None: copied.append(source)
+
+        sys.argv = ['vcp', '--nstreams', '4', 'vos:src', dest_dir]
+        commands.vcp()
+
+        assert sorted(['vos:src/{}'.format(name) for name in file_names] +
+                      ['vos:src/subdir/file5']) == sorted(copied)
+        # the type of the children comes from the listing of their
+        # container, the walking thread does not look them up one by one
+        for name in copied:
+            assert threading.get_ident() not in isdir_threads.get(name, ())
+
+    @patch('vos.vos.Client')
+    def test_vcp_corrupted_download(self, vos_client_mock):
+        tmp_dir = tempfile.TemporaryDirectory()
+        dest_file = os.path.join(tmp_dir.name, 'foo')
+        # left by a previous attempt
+        open(dest_file + vos.PART_SUFFIX, 'wb').write(b'abc')
+
+        # the download is corrupted again and again
+        node = MagicMock(spec=Node)
+        node.props = {'MD5': 'beef', 'length': 3}
+        real_client = Client()
+        real_client.is_remote_file = Mock(side_effect=lambda x: ':' in x)
+        real_client.get_node = Mock(return_value=node)
+        real_client.get_node_url = Mock(
+            side_effect=lambda *args, **kwargs:
+            [] if kwargs.get('full_negotiation') else 'https://cadc.ca/foo')
+        # a second attempt would fail differently
+        real_client._download_segments = Mock(side_effect=[OSError(
+            errno.EIO, 'Downloaded file is corrupted')])
+        real_client._get_si_client = Mock()
+        real_client._get_si_client.return_value.download_file.side_effect = \
+            OSError(errno.EIO, 'Downloaded file is corrupted')
+
+        client = vos_client_mock.return_value
+        client.is_remote_file.side_effect = real_client.is_remote_file
+        client.glob.side_effect = lambda pattern: [pattern]
+        client.get_node.return_value.islink.return_value = False
+        client.isdir.return_value = False
+        client.copy.side_effect = real_client.copy
+
+        # vcp gives up rather than downloading the file again forever
+        sys.argv = ['vcp', 'vos:foo', dest_file]
+        with self.assertRaises(SystemExit):
+            commands.vcp()
+        real_client._download_segments.assert_called_once()
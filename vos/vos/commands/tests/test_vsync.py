@@ -73,11 +73,24 @@ import datetime
 import pytest
 from unittest.mock import Mock, patch
 import hashlib
+import threading
+import time
+import argparse
+import io
 
 from vos.commands.vsync import validate, prepare, build_file_list, execute, \
-    TransferReport, compute_md5
+    TransferReport, compute_md5, execute_download, build_remote_file_list, \
+    prepare_download, RemoteListing, run_transfers, upload_dependencies, \
+    plan_transfers, journal_transfers, SizeScheduler, upload_size, \
+    iter_remote_deletions, execute_delete, plan_upload, plan_summary, \
+    TransferProcesses, dispatch_transfers, parse_shard, in_shard, \
+    shard_transfers, shard_report, iter_file_list, FileInfo, read_manifest, \
+    iter_manifest_list, execute_upload, scan_file_list, PathFilter, \
+    WatchedSources, watch_uploads, hash_transfers, check_upload, file_info
+from vos.dir_snapshot import DirectorySnapshots
+from vos import transfer_journal, md5_cache
 from cadcutils import exceptions as transfer_exceptions
-from vos.vos import ZERO_MD5
+from vos.vos import ZERO_MD5, TransferResult
 
 
 def module_patch(*args):
@@ -319,6 +332,7 @@ def test_execute(get_client):
     options.token = None
     options.cache_nodes = False
     options.insecure = False
+    options.verify = False
     expected_report = TransferReport()
     expected_report.files_sent = 1
     assert expected_report == execute(tmp_file.name,
@@ -374,3 +388,1274 @@ def test_execute(get_client):
     expected_report.files_erred = 1
     assert expected_report == execute(tmp_file.name,
                                       'vos:service/path', options)
+
+
+@module_patch('vos.commands.vsync.compute_md5')
+@module_patch('vos.commands.vsync.get_client')
+def test_execute_stream_md5(get_client, compute_md5_mock):
+    now = datetime.datetime.timestamp(datetime.datetime.now())
+    node = Mock(props={'MD5': 'beef'}, attr={'st_size': 2, 'st_ctime': now})
+    client_mock = Mock()
+    client_mock.get_node = Mock(return_value=node)
+    client_mock.copy.return_value = TransferResult('path', 'abcd', 3, now)
+    get_client.return_value = client_mock
+    tmp_file = tempfile.NamedTemporaryFile()
+    open(tmp_file.name, 'w').write('ABC')
+
+    class Options:
+        pass
+
+    options = Options
+    options.overwrite = False
+    options.ignore_checksum = False
+    options.certfile = None
+    options.token = None
+    options.cache_nodes = False
+    options.insecure = False
+    options.verify = False
+    expected_report = TransferReport()
+    expected_report.files_sent = 1
+    expected_report.bytes_sent = 3
+    # different sizes: the file is hashed while uploaded
+    assert expected_report == execute(tmp_file.name, 'vos:service/path',
+                                      options)
+    assert not compute_md5_mock.called
+    client_mock.copy.assert_called_once_with(
+        tmp_file.name, 'vos:service/path', send_md5=True, stream_md5=True,
+        md5_checksum=None, transfer_result=True)
+
+    # same size: the file is hashed to compare it with the remote copy
+    node.attr['st_size'] = 3
+    compute_md5_mock.return_value = 'abcd'
+    client_mock.copy.reset_mock()
+    assert expected_report == execute(tmp_file.name, 'vos:service/path',
+                                      options)
+    compute_md5_mock.assert_called_once_with(tmp_file.name,
+                                             os.stat(tmp_file.name))
+    client_mock.copy.assert_called_once_with(
+        tmp_file.name, 'vos:service/path', send_md5=True, stream_md5=True,
+        md5_checksum='abcd', transfer_result=True)
+
+
+@module_patch('vos.commands.vsync.get_client')
+def test_execute_download(get_client):
+    now = datetime.datetime.timestamp(datetime.datetime.now())
+    node = Mock(props={'MD5': 'beef'}, attr={'st_size': 3, 'st_ctime': now})
+    client_mock = Mock()
+    client_mock.copy.return_value = None
+    get_client.return_value = client_mock
+    tmp_dir = tempfile.mkdtemp()
+    dest = os.path.join(tmp_dir, 'file')
+
+    class Options:
+        pass
+
+    options = Options
+    options.overwrite = False
+    options.ignore_checksum = False
+    options.certfile = None
+    options.token = None
+    options.insecure = False
+
+    # missing local file => download
+    expected_report = TransferReport()
+    expected_report.files_sent = 1
+    expected_report.bytes_sent = 3
+    assert expected_report == execute_download('vos:service/file', dest,
+                                               node, options)
+    client_mock.copy.assert_called_once_with('vos:service/file', dest,
+                                             send_md5=True)
+
+    # same md5 => skip
+    open(dest, 'w').write('ABC')
+    node.props['MD5'] = compute_md5(dest)
+    client_mock.copy.reset_mock()
+    expected_report = TransferReport()
+    expected_report.files_skipped = 1
+    expected_report.bytes_skipped = 3
+    assert expected_report == execute_download('vos:service/file', dest,
+                                               node, options)
+    assert not client_mock.copy.called
+
+    # different md5 => download
+    node.props['MD5'] = 'beef'
+    expected_report = TransferReport()
+    expected_report.files_sent = 1
+    expected_report.bytes_sent = 3
+    assert expected_report == execute_download('vos:service/file', dest,
+                                               node, options)
+
+    # different md5 but ignore checksum and newer local file => skip
+    options.ignore_checksum = True
+    node.attr['st_ctime'] = now - 10000
+    expected_report = TransferReport()
+    expected_report.files_skipped = 1
+    expected_report.bytes_skipped = 3
+    assert expected_report == execute_download('vos:service/file', dest,
+                                               node, options)
+
+    # size mismatch => download
+    node.attr['st_size'] = 7
+    expected_report = TransferReport()
+    expected_report.files_sent = 1
+    expected_report.bytes_sent = 7
+    assert expected_report == execute_download('vos:service/file', dest,
+                                               node, options)
+
+    # errors on download
+    client_mock.copy.side_effect = OSError('NotFound')
+    expected_report = TransferReport()
+    expected_report.files_erred = 1
+    assert expected_report == execute_download('vos:service/file', dest,
+                                               node, options)
+
+
+def test_build_remote_file_list():
+    def mock_node(uri, isdir=False):
+        return Mock(uri=uri, isdir=Mock(return_value=isdir),
+                    islink=Mock(return_value=False))
+
+    def named(node):
+        # name is a special Mock argument
+        node.name = os.path.basename(node.uri)
+        return node
+
+    root = named(mock_node('vos://cadc.nrc.ca~vault/dir', isdir=True))
+    file1 = named(mock_node('vos://cadc.nrc.ca~vault/dir/file1.txt'))
+    subdir = named(mock_node('vos://cadc.nrc.ca~vault/dir/sub', isdir=True))
+    file2 = named(mock_node('vos://cadc.nrc.ca~vault/dir/sub/file2.txt'))
+    ignored = named(mock_node('vos://cadc.nrc.ca~vault/dir/file.tmp'))
+    listings = {root.uri: [file1, subdir, ignored],
+                subdir.uri: [file2]}
+    client = Mock()
+    client.get_node.return_value = root
+    client.get_children_info.side_effect = \
+        lambda uri, force=False: iter(listings[uri])
+
+    # non recursive: only the data nodes in the container
+    assert [(root.uri, '/tmp/dir', root),
+            (file1.uri, '/tmp/dir/file1.txt', file1)] == \
+        build_remote_file_list(client, ['vos:dir'], '/tmp', exclude='tmp')
+
+    # recursive: containers ahead of their content
+    assert [(root.uri, '/tmp/dir', root),
+            (file1.uri, '/tmp/dir/file1.txt', file1),
+            (subdir.uri, '/tmp/dir/sub', subdir),
+            (file2.uri, '/tmp/dir/sub/file2.txt', file2)] == \
+        build_remote_file_list(client, ['vos:dir'], '/tmp', recursive=True,
+                               exclude='tmp')
+
+    # trailing '/' syncs just the content of the container
+    assert [(file1.uri, '/tmp/file1.txt', file1),
+            (subdir.uri, '/tmp/sub', subdir),
+            (file2.uri, '/tmp/sub/file2.txt', file2)] == \
+        build_remote_file_list(client, ['vos:dir/'], '/tmp', recursive=True,
+                               exclude='tmp')
+
+    # containers are created locally, data nodes are returned as transfers
+    tmp_dir = tempfile.mkdtemp()
+    local_dir = os.path.join(tmp_dir, 'sub')
+    assert prepare_download(subdir.uri, local_dir, subdir) is None
+    assert os.path.isdir(local_dir)
+    assert (file2.uri, 'file2.txt', file2) == \
+        prepare_download(file2.uri, 'file2.txt', file2)
+
+
+@module_patch('vos.commands.vsync.get_client')
+def test_remote_listing(get_client):
+    now = datetime.datetime.timestamp(datetime.datetime.now())
+    tmp_file = tempfile.NamedTemporaryFile()
+    open(tmp_file.name, 'w').write('ABC')
+    md5 = compute_md5(tmp_file.name)
+    child = Mock(props={'MD5': md5}, attr={'st_size': 3, 'st_ctime': now})
+    child.name = 'file1.txt'
+    client_mock = Mock()
+    client_mock.get_children_info.return_value = [child]
+    listing = RemoteListing(page_size=10)
+    assert (md5, 3, now) == listing.get(client_mock, 'vos:dir/file1.txt')
+    assert listing.get(client_mock, 'vos:dir/file2.txt') is None
+    # the container is listed only once, page by page
+    client_mock.get_children_info.assert_called_once_with(
+        'vos:dir', force=True, limit=10)
+    assert not client_mock.get_node.called
+
+    # containers that do not exist yet have no children
+    client_mock.get_children_info.side_effect = \
+        transfer_exceptions.NotFoundException('vos:newdir')
+    assert listing.get(client_mock, 'vos:newdir/file1.txt') is None
+
+    # execute makes the skip decisions with the listing
+    client_mock.get_node.return_value = child
+    get_client.return_value = client_mock
+
+    class Options:
+        pass
+
+    options = Options
+    options.overwrite = False
+    options.ignore_checksum = False
+    options.certfile = None
+    options.token = None
+    options.cache_nodes = False
+    options.insecure = False
+    options.verify = False
+    with patch('vos.commands.vsync.global_listing', listing):
+        expected_report = TransferReport()
+        expected_report.files_skipped = 1
+        expected_report.bytes_skipped = 3
+        assert expected_report == execute(tmp_file.name,
+                                          'vos:dir/file1.txt', options)
+        assert not client_mock.copy.called
+        # missing in the listing => upload
+        expected_report = TransferReport()
+        expected_report.files_sent = 1
+        expected_report.bytes_sent = 3
+        assert expected_report == execute(tmp_file.name,
+                                          'vos:dir/file2.txt', options)
+        assert client_mock.copy.called
+
+
+def test_remote_listing_release():
+    child = Mock(props={'MD5': 'beef'}, attr={'st_size': 3, 'st_ctime': 1})
+    child.name = 'file1.txt'
+    child.isdir.return_value = False
+    client = Mock()
+    client.get_children_info.return_value = [child]
+    listing = RemoteListing()
+    looked_up = []
+
+    def worker(src, dest, info, opt):
+        looked_up.append(listing.get(client, dest))
+
+    # both transfers taken from the scan ahead of their completion
+    transfers = list(listing.retain(
+        [('file1.txt', 'vos:dir/file1.txt', None),
+         ('file2.txt', 'vos:dir/file2.txt', None)]))
+    worker = listing.track(worker)
+    for transfer in transfers:
+        worker(*transfer, None)
+        if transfer[0] == 'file1.txt':
+            # kept for the next transfer in the container
+            assert 'vos:dir' in listing._containers
+    assert [('beef', 3, 1), None] == looked_up
+    assert 1 == client.get_children_info.call_count
+    # dropped once all the transfers in the container are done
+    assert {} == listing._containers
+    assert {} == listing._subcontainers
+    assert {} == listing._locks
+
+    # listed again if looked up later
+    assert {'file1.txt': False} == listing.children(client, 'vos:dir/')
+    assert 2 == client.get_children_info.call_count
+    listing.forget('vos:dir/')
+    assert {} == listing._containers
+
+
+def test_run_transfers():
+    class Options:
+        pass
+
+    options = Options
+    options.nstreams = 2
+    produced = []
+
+    def transfers(count):
+        for i in range(count):
+            produced.append(i)
+            yield i, 'file{}'.format(i)
+
+    def worker(size, name, opt):
+        assert opt is options
+        # the scan is never more than the queue ahead of the transfers
+        assert len(produced) <= size + opt.nstreams + 3
+        if name == 'file3':
+            raise RuntimeError('failed')
+        result = TransferReport()
+        result.files_sent = 1
+        result.bytes_sent = size
+        return result
+
+    expected_report = TransferReport()
+    expected_report.files_sent = 99
+    expected_report.bytes_sent = sum(range(100)) - 3
+    expected_report.files_erred = 1
+    assert expected_report == run_transfers(transfers(100), worker, options,
+                                            max_queued=1)
+    assert 100 == len(produced)
+
+
+def test_run_transfers_dependencies():
+    class Options:
+        pass
+
+    options = Options
+    options.nstreams = 3
+    created = set()
+    lock = threading.Lock()
+
+    def worker(dest, is_dir, opt):
+        parent = dest.rsplit('/', 1)[0]
+        with lock:
+            # nothing starts before its container exists
+            assert parent == 'vos:root' or parent in created
+        if is_dir:
+            time.sleep(0.01)
+            with lock:
+                created.add(dest)
+        result = TransferReport()
+        if not is_dir:
+            result.files_sent = 1
+        return result
+
+    def dependencies(transfer):
+        dest, is_dir = transfer
+        return (dest if is_dir else None), dest.rsplit('/', 1)[0]
+
+    transfers = []
+    for i in range(3):
+        transfers.append(('vos:root/dir{}'.format(i), True))
+        transfers.append(('vos:root/dir{}/sub'.format(i), True))
+        for j in range(5):
+            transfers.append(('vos:root/dir{}/file{}'.format(i, j), False))
+            transfers.append(('vos:root/dir{}/sub/file{}'.format(i, j),
+                              False))
+    transfers.append(('vos:root/file', False))
+    expected_report = TransferReport()
+    expected_report.files_sent = 31
+    assert expected_report == run_transfers(
+        transfers, worker, options, max_queued=2, dependencies=dependencies)
+    assert 6 == len(created)
+
+
+def test_run_transfers_duplicate_container():
+    options = argparse.Namespace(nstreams=3)
+    created = []
+
+    def worker(dest, is_dir, opt):
+        result = TransferReport()
+        if is_dir:
+            time.sleep(0.2)
+            created.append(dest)
+        else:
+            assert 'vos:root/a' in created
+            result.files_sent = 1
+        return result
+
+    def dependencies(transfer):
+        dest, is_dir = transfer
+        return (dest if is_dir else None), dest.rsplit('/', 1)[0]
+
+    # the container listed again while it is being created
+    transfers = [('vos:root/a', True), ('vos:root/a/f', False),
+                 ('vos:root/a', True), ('vos:root/a/g', False)]
+    result = []
+    thread = threading.Thread(target=lambda: result.append(run_transfers(
+        transfers, worker, options, dependencies=dependencies)))
+    thread.start()
+    thread.join(10)
+    assert not thread.is_alive()
+    expected_report = TransferReport()
+    expected_report.files_sent = 2
+    assert [expected_report] == result
+    assert ['vos:root/a'] == created
+
+
+def test_upload_dependencies():
+    tmp_dir = tempfile.mkdtemp()
+    tmp_file = os.path.join(tmp_dir, 'file')
+    open(tmp_file, 'w').write('ABC')
+    assert ('vos:root/dir', 'vos:root') == \
+        upload_dependencies((tmp_dir, 'vos:root/dir', None))
+    assert (None, 'vos:root/dir') == \
+        upload_dependencies((tmp_file, 'vos:root/dir/file', None))
+    # files with known info are not checked
+    assert (None, 'vos:root') == upload_dependencies(
+        (tmp_dir, 'vos:root/file', FileInfo(3, None, None)))
+
+
+def test_prepare_listed_containers():
+    tmp_dir = tempfile.mkdtemp()
+    client = Mock()
+    client.get_children_info.return_value = []
+    listing = RemoteListing()
+    with patch('vos.commands.vsync.global_listing', listing):
+        # containers missing from the listing are created and remembered
+        # as empty
+        assert prepare(tmp_dir, 'vos:root/dir', client) is None
+        client.mkdir.assert_called_once_with('vos:root/dir')
+        assert listing.get(client, 'vos:root/dir/file') is None
+        client.get_children_info.assert_called_once_with(
+            'vos:root', force=True, limit=500)
+
+        # containers in the listing are not created again
+        client.mkdir.reset_mock()
+        existing = Mock(props={}, attr={'st_size': 0, 'st_ctime': 0})
+        existing.name = 'dir'
+        listing = RemoteListing()
+        client.get_children_info.return_value = [existing]
+        with patch('vos.commands.vsync.global_listing', listing):
+            assert prepare(tmp_dir, 'vos:root/dir', client) is None
+        assert not client.mkdir.called
+
+
+@module_patch('vos.commands.vsync.get_client')
+def test_execute_transfer_result(get_client):
+    now = datetime.datetime.timestamp(datetime.datetime.now())
+    client_mock = Mock()
+    client_mock.copy.return_value = TransferResult('path', 'abcd', 3, now)
+    get_client.return_value = client_mock
+    cache = Mock()
+    tmp_file = tempfile.NamedTemporaryFile()
+    open(tmp_file.name, 'w').write('ABC')
+
+    class Options:
+        pass
+
+    options = Options
+    options.overwrite = True
+    options.ignore_checksum = False
+    options.certfile = None
+    options.token = None
+    options.cache_nodes = True
+    options.insecure = False
+    options.verify = False
+    expected_report = TransferReport()
+    expected_report.files_sent = 1
+    expected_report.bytes_sent = 3
+    with patch('vos.commands.vsync.global_md5_cache', cache):
+        # the details of the upload are cached without asking VOSpace
+        assert expected_report == execute(tmp_file.name, 'vos:service/path',
+                                          options)
+        assert not client_mock.get_node.called
+        cache.update.assert_any_call('vos:service/path', 'abcd', 3, now,
+                                     remote=True)
+
+        # verification of the upload
+        options.verify = True
+        node = Mock(props={'MD5': 'abcd'},
+                    attr={'st_size': 3, 'st_ctime': now + 1})
+        client_mock.get_node.return_value = node
+        cache.reset_mock()
+        assert expected_report == execute(tmp_file.name, 'vos:service/path',
+                                          options)
+        client_mock.get_node.assert_called_once_with(
+            'vos:service/path', limit=None, force=True)
+        cache.update.assert_any_call('vos:service/path', 'abcd', 3, now + 1,
+                                     remote=True)
+
+        # failed verification
+        node.props['MD5'] = 'beef'
+        cache.reset_mock()
+        expected_report = TransferReport()
+        expected_report.files_erred = 1
+        assert expected_report == execute(tmp_file.name, 'vos:service/path',
+                                          options)
+        for call in cache.update.call_args_list:
+            assert call[0][0] != 'vos:service/path'
+
+
+def test_journal():
+    tmp_dir = tempfile.mkdtemp()
+    journal = transfer_journal.TransferJournal(
+        os.path.join(tmp_dir, 'journal.db'))
+    journal.start('job')
+    transfers = [('a', 'vos:a'), ('b', 'vos:b'), ('c', 'vos:c')]
+    journal.plan('job', 'b', 'vos:b')
+    journal.update('job', 'b', 'vos:b', transfer_journal.DONE)
+    # transfers done by a previous run are not repeated
+    planned = plan_transfers(iter(transfers), journal, 'job')
+    assert ('a', 'vos:a') == next(planned)
+    assert not journal.is_scanned('job')
+    assert [('c', 'vos:c')] == list(planned)
+    assert journal.is_scanned('job')
+
+    class Options:
+        pass
+
+    def worker(src, dest, opt):
+        assert transfer_journal.IN_FLIGHT == \
+            journal.plan('job', src, dest)
+        if src == 'c':
+            raise OSError('failed')
+        result = TransferReport()
+        if src == 'b':
+            result.files_erred = 1
+        return result
+
+    journaled_worker = journal_transfers(worker, journal, 'job')
+    journaled_worker('a', 'vos:a', Options)
+    journaled_worker('b', 'vos:b', Options)
+    with pytest.raises(OSError):
+        journaled_worker('c', 'vos:c', Options)
+    assert [] == list(journal.get('job', [transfer_journal.PLANNED,
+                                          transfer_journal.IN_FLIGHT]))
+    assert [('b', 'vos:b'), ('c', 'vos:c')] == \
+        list(journal.get('job', [transfer_journal.FAILED]))
+
+
+def test_size_scheduler():
+    sizes = {'d1': None, 'a': 5, 'b': 100, 'c': 1, 'd2': None, 'e': 200,
+             'f': 2}
+    transfers = [(name, 'vos:' + name) for name in sizes]
+
+    def sizer(transfer):
+        return sizes[transfer[0]]
+
+    def names(scheduled):
+        return [transfer[0] for transfer in scheduled]
+
+    with pytest.raises(ValueError):
+        SizeScheduler('random', 4, sizer)
+
+    # directories are not delayed
+    scheduler = SizeScheduler('largest-first', 4, sizer)
+    assert ['d1', 'd2', 'e', 'b', 'a', 'f', 'c'] == \
+        names(scheduler.schedule(transfers))
+    scheduler = SizeScheduler('smallest-first', 4, sizer)
+    assert ['d1', 'd2', 'c', 'f', 'a', 'b', 'e'] == \
+        names(scheduler.schedule(transfers))
+    # ordered within windows
+    scheduler = SizeScheduler('largest-first', 4, sizer, window=2)
+    assert ['d1', 'b', 'a', 'd2', 'e', 'f', 'c'] == \
+        names(scheduler.schedule(transfers))
+
+    # balanced: one stream for the large files while it is busy
+    scheduler = SizeScheduler('balanced', 4, sizer, large_file_size=100)
+    scheduled = scheduler.schedule(transfers)
+    assert ['d1', 'd2', 'e', 'c', 'f'] == \
+        [next(scheduled)[0] for _ in range(5)]
+
+    def worker(src, dest):
+        return src
+
+    # the large file stream is available again
+    assert 'e' == scheduler.track(worker)('e', 'vos:e')
+    assert ['b', 'a'] == names(scheduled)
+
+    # large files are transferred by all the streams when there are no
+    # small files left
+    scheduler = SizeScheduler('balanced', 4, sizer, large_file_size=100)
+    assert ['d1', 'd2', 'e', 'c', 'f', 'a', 'b'] == \
+        names(scheduler.schedule(transfers))
+
+
+def test_upload_size():
+    tmp_dir = tempfile.mkdtemp()
+    tmp_file = os.path.join(tmp_dir, 'file')
+    open(tmp_file, 'w').write('ABC')
+    assert 3 == upload_size((tmp_file, 'vos:file', None))
+    assert upload_size((tmp_dir, 'vos:dir', None)) is None
+    assert 0 == upload_size((os.path.join(tmp_dir, 'nofile'), 'vos:file',
+                             None))
+    assert 10 == upload_size((tmp_file, 'vos:file',
+                              FileInfo(10, None, None)))
+
+
+def test_iter_remote_deletions():
+    tmp_dir = tempfile.mkdtemp()
+    src_dir = os.path.join(tmp_dir, 'src')
+    os.makedirs(os.path.join(src_dir, 'dir1'))
+    open(os.path.join(src_dir, 'file1'), 'w').write('ABC')
+    open(os.path.join(src_dir, 'dir1', 'file2'), 'w').write('ABC')
+
+    def child(name, isdir=False):
+        node = Mock(props={}, attr={'st_size': 0, 'st_ctime': 0})
+        node.name = name
+        node.isdir.return_value = isdir
+        return node
+
+    remote = {
+        'vos:dest': [child('file1'), child('dir1', True),
+                     child('olddir', True), child('oldfile'),
+                     child('keep.log')],
+        'vos:dest/dir1': [child('file2'), child('file3')]}
+    client = Mock()
+    client.get_children_info.side_effect = \
+        lambda container, force, limit: remote[container]
+    with patch('vos.commands.vsync.global_listing', RemoteListing()):
+        # whole subtrees gone locally are deleted as containers
+        assert [('vos:dest/keep.log', False),
+                ('vos:dest/olddir', True),
+                ('vos:dest/oldfile', False)] == \
+            list(iter_remote_deletions(client, [src_dir + '/'], 'vos:dest'))
+        assert [('vos:dest/olddir', True),
+                ('vos:dest/oldfile', False),
+                ('vos:dest/dir1/file3', False)] == \
+            list(iter_remote_deletions(client, [src_dir + '/'], 'vos:dest',
+                                       recursive=True, exclude='.log'))
+
+    # sources synced into the same container are compared together
+    other_dir = os.path.join(tmp_dir, 'other')
+    os.makedirs(other_dir)
+    open(os.path.join(other_dir, 'oldfile'), 'w').write('ABC')
+    with patch('vos.commands.vsync.global_listing', RemoteListing()):
+        assert [('vos:dest/keep.log', False),
+                ('vos:dest/olddir', True)] == \
+            list(iter_remote_deletions(client,
+                                       [src_dir + '/', other_dir + '/'],
+                                       'vos:dest'))
+
+
+@patch('vos.commands.vsync.get_client', autospec=True)
+def test_execute_delete(get_client):
+    client = Mock()
+    client.recursive_delete.return_value = (3, 1)
+    get_client.return_value = client
+    opt = argparse.Namespace(certfile='cert.pem', token=None, insecure=False)
+    expected_report = TransferReport()
+    expected_report.files_deleted = 1
+    assert expected_report == execute_delete('vos:dir/file', False, opt)
+    client.delete.assert_called_once_with('vos:dir/file')
+    assert not client.recursive_delete.called
+    get_client.assert_called_with('cert.pem', None, False)
+
+    expected_report = TransferReport()
+    expected_report.files_deleted = 3
+    expected_report.files_erred = 1
+    assert expected_report == execute_delete('vos:dir/subdir', True, opt)
+    client.recursive_delete.assert_called_once_with('vos:dir/subdir')
+
+
+@patch('vos.commands.vsync.get_client')
+def test_plan_upload(get_client):
+    tmp_dir = tempfile.mkdtemp()
+    os.makedirs(os.path.join(tmp_dir, 'newdir'))
+    os.makedirs(os.path.join(tmp_dir, 'dir'))
+    same_file = os.path.join(tmp_dir, 'same')
+    open(same_file, 'w').write('ABC')
+    new_file = os.path.join(tmp_dir, 'new')
+    open(new_file, 'w').write('ABCD')
+
+    def child(name, md5=None, size=0):
+        node = Mock(props={'MD5': md5}, attr={'st_size': size,
+                                              'st_ctime': 0})
+        node.name = name
+        node.isdir.return_value = md5 is None
+        return node
+
+    client = Mock()
+    client.get_children_info.return_value = [
+        child('dir'), child('same', compute_md5(same_file), 3)]
+    get_client.return_value = client
+
+    class Options:
+        pass
+
+    options = Options
+    options.overwrite = False
+    options.ignore_checksum = False
+    options.certfile = None
+    options.token = None
+    options.cache_nodes = False
+    options.insecure = False
+    options.nstreams = 2
+    with patch('vos.commands.vsync.global_listing', RemoteListing()):
+        transfers = [(os.path.join(tmp_dir, name), 'vos:dest/' + name, None)
+                     for name in ['dir', 'newdir', 'same', 'new']]
+        expected_report = TransferReport()
+        expected_report.containers_created = 1
+        expected_report.files_skipped = 1
+        expected_report.bytes_skipped = 3
+        expected_report.files_sent = 1
+        expected_report.bytes_sent = 4
+        assert expected_report == run_transfers(transfers, plan_upload,
+                                                options)
+        # nothing is transferred or created
+        assert not client.mkdir.called
+        assert not client.copy.called
+
+        expected_report = TransferReport()
+        expected_report.files_sent = 1
+        expected_report.bytes_sent = 3
+        options.overwrite = True
+        assert expected_report == plan_upload(same_file, 'vos:dest/same',
+                                              None, options)
+
+
+def test_plan_summary():
+    report = TransferReport()
+    report.files_sent = 2
+    report.bytes_sent = 3000
+    report.files_skipped = 1
+    report.bytes_skipped = 10
+    report.containers_created = 1
+    summary = plan_summary(report, 4, None)
+    assert {'to_upload': {'files': 2, 'bytes': 3000},
+            'to_skip': {'files': 1, 'bytes': 10},
+            'to_mkdir': {'containers': 1},
+            'errors': 0,
+            'nstreams': 4,
+            'throughput': None,
+            'estimated_duration': None} == summary
+
+    summary = plan_summary(report, 4, 100, deletions=5)
+    assert 400 == summary['throughput']
+    assert 7.5 == summary['estimated_duration']
+    assert {'nodes': 5} == summary['to_delete']
+    # the bandwidth cap bounds the throughput
+    summary = plan_summary(report, 4, 100, max_rate=300)
+    assert 300 == summary['throughput']
+    assert 10 == summary['estimated_duration']
+
+
+def sized_transfer(name, size, opt):
+    # worker of the transfer processes, importable by them
+    result = TransferReport()
+    if size < 0:
+        raise RuntimeError('failed')
+    result.files_sent = 1
+    result.bytes_sent = size
+    return result
+
+
+def transfer_size(transfer):
+    return transfer[1]
+
+
+def test_transfer_processes():
+    tmp_dir = tempfile.mkdtemp()
+    journal_db = os.path.join(tmp_dir, 'journal.db')
+    journal = transfer_journal.TransferJournal(journal_db)
+    journal.start('job')
+    options = argparse.Namespace(
+        nstreams=2, processes=3, debug=False, verbose=False, warning=False,
+        vos_debug=False, cache_nodes=False, adaptive=False, max_rate=None,
+        schedule=None)
+    transfers = [('file{}'.format(i), i) for i in range(20)]
+    transfers.append(('bad', -1))
+    for name, size in transfers:
+        journal.plan('job', name, size)
+
+    def check(name, size, opt):
+        # small files are not passed on
+        if 0 <= size < 5:
+            result = TransferReport()
+            result.files_skipped = 1
+            result.bytes_skipped = size
+            return result, None
+        return None, (name, size)
+
+    processes = TransferProcesses(3, sized_transfer, options, journal_db,
+                                  'job', transfer_size)
+    expected_report = TransferReport()
+    expected_report.files_skipped = 5
+    expected_report.bytes_skipped = 10
+    assert expected_report == run_transfers(
+        transfers, dispatch_transfers(processes, check, journal, 'job'),
+        options)
+    expected_report = TransferReport()
+    expected_report.files_sent = 15
+    expected_report.bytes_sent = sum(range(5, 20))
+    expected_report.files_erred = 1
+    assert expected_report == processes.join()
+    # the processes journal the transfers passed on, the checked ones are
+    # journaled by the main process
+    assert [('bad', '-1')] == list(journal.get('job', [
+        transfer_journal.FAILED]))
+    assert not list(journal.get('job', [transfer_journal.PLANNED,
+                                        transfer_journal.IN_FLIGHT]))
+    assert 20 == len(list(journal.get('job', [transfer_journal.DONE])))
+
+
+@patch('vos.commands.vsync.compare')
+@patch('vos.commands.vsync.get_client')
+def test_check_upload(get_client, compare_mock):
+    tmp_file = tempfile.NamedTemporaryFile()
+    open(tmp_file.name, 'wb').write(b'abc')
+    opt = argparse.Namespace(certfile=None, token=None, insecure=False,
+                             overwrite=False)
+    engine = Mock()
+    vsync_module = importlib.import_module('vos.commands.vsync')
+    info = FileInfo(3, 1.5, None)
+    with patch.object(vsync_module, 'global_hash_engine', engine):
+        compare_mock.return_value = (3, 'beef')
+        result, transfer = check_upload(tmp_file.name, 'vos:file', info, opt)
+        assert 1 == result.files_skipped
+        assert transfer is None
+
+        # the MD5 of the comparison is passed on with the upload
+        compare_mock.return_value = (None, 'beef')
+        assert (None, (tmp_file.name, 'vos:file', FileInfo(3, 1.5, 'beef'))) \
+            == check_upload(tmp_file.name, 'vos:file', info, opt)
+        stat = os.stat(tmp_file.name)
+        assert (None, (tmp_file.name, 'vos:file',
+                       file_info(stat, 'beef'))) == \
+            check_upload(tmp_file.name, 'vos:file', None, opt)
+        assert not engine.discard.called
+
+        # not hashed, the hash prefetched is dropped
+        compare_mock.return_value = (None, None)
+        assert (None, (tmp_file.name, 'vos:file', info)) == \
+            check_upload(tmp_file.name, 'vos:file', info, opt)
+        engine.discard.assert_called_once_with(tmp_file.name)
+
+
+def test_parse_shard():
+    assert (1, 8) == parse_shard('1/8')
+    assert (8, 8) == parse_shard('8/8')
+    for shard in ['0/8', '9/8', '1', 'a/b', '1/2/3']:
+        with pytest.raises(ValueError):
+            parse_shard(shard)
+
+
+def test_shard_transfers():
+    tmp_dir = tempfile.mkdtemp()
+    for dirname in ['a', 'b', os.path.join('a', 'c')]:
+        os.makedirs(os.path.join(tmp_dir, dirname))
+        for i in range(10):
+            open(os.path.join(tmp_dir, dirname, 'file{}'.format(i)),
+                 'w').write('ABC')
+    transfers = [(src, dest, None) for src, dest in iter_file_list(
+        [tmp_dir + '/'], 'vos:dest/', recursive=True)]
+    files = {dest for src, dest, _ in transfers if os.path.isfile(src)}
+    dirs = {dest for src, dest, _ in transfers if os.path.isdir(src)}
+    # the partition does not depend on the slashes around the destination
+    assert in_shard('vos:dest/a/file1', 'vos:dest', (1, 3)) == \
+        in_shard('vos:dest/a/file1', '/vos:dest/', (1, 3))
+
+    sharded_files = []
+    for index in range(1, 4):
+        shard = (index, 3)
+        sharded = list(shard_transfers(transfers, 'vos:dest/', shard))
+        created = set()
+        for src, dest, _ in sharded:
+            if dest in dirs:
+                # directories of other shards only ahead of their content
+                assert in_shard(dest, 'vos:dest', shard) or any(
+                    other.startswith(dest + '/') and
+                    in_shard(other, 'vos:dest', shard)
+                    for _, other, _ in sharded)
+                created.add(dest)
+            else:
+                sharded_files.append(dest)
+                assert in_shard(dest, 'vos:dest', shard)
+                # the container of the file is created before it
+                parent = dest.rsplit('/', 1)[0]
+                assert parent == 'vos:dest' or parent in created
+        # the shard creates all the directories it owns
+        assert {dest for dest in dirs
+                if in_shard(dest, 'vos:dest', shard)} <= created
+    # every file is in exactly one shard
+    assert sorted(files) == sorted(sharded_files)
+
+
+def test_shard_report():
+    tmp_dir = tempfile.mkdtemp()
+    with pytest.raises(RuntimeError):
+        shard_report(tmp_dir, 'job')
+
+    def shard_journal(index, count):
+        return transfer_journal.TransferJournal(os.path.join(
+            tmp_dir, 'vsync_journal.{}of{}.db'.format(index, count)))
+
+    journal = shard_journal(1, 3)
+    journal.start('job')
+    journal.plan('job', 'a', 'vos:a')
+    journal.plan('job', 'b', 'vos:b')
+    journal.update('job', 'a', 'vos:a', transfer_journal.DONE)
+    journal.update('job', 'b', 'vos:b', transfer_journal.DONE)
+    journal.set_scanned('job')
+    journal.close()
+    journal = shard_journal(2, 3)
+    journal.start('job')
+    journal.plan('job', 'c', 'vos:c')
+    journal.update('job', 'c', 'vos:c', transfer_journal.FAILED)
+    journal.set_scanned('job')
+    journal.close()
+    # journal of another sync
+    journal = shard_journal(3, 3)
+    journal.start('other_job')
+    journal.close()
+
+    report = shard_report(tmp_dir, 'job')
+    assert 3 == report['shards']
+    assert [3] == report['missing']
+    assert [] == report['unfinished']
+    assert not report['complete']
+    assert {transfer_journal.PLANNED: 0, transfer_journal.IN_FLIGHT: 0,
+            transfer_journal.DONE: 2, transfer_journal.FAILED: 1} == \
+        report['totals']
+    assert ['1/3', '2/3'] == sorted(report['per_shard'])
+
+    journal = shard_journal(3, 3)
+    journal.start('job')
+    journal.close()
+    report = shard_report(tmp_dir, 'job')
+    assert [] == report['missing']
+    assert [3] == report['unfinished']
+
+    # journals of different shardings of the same sync
+    journal = shard_journal(1, 2)
+    journal.start('job')
+    journal.close()
+    with pytest.raises(RuntimeError):
+        shard_report(tmp_dir, 'job')
+
+
+def test_read_manifest():
+    # new line separated, with and without columns
+    manifest = io.BytesIO(b'a/file1\nfile2\t3\t1.5\tABCD\n\n'
+                          b'file3\t-\t\tabcd\r\nfile 4\t5')
+    assert [('a/file1', None),
+            ('file2', FileInfo(3, 1.5, 'abcd')),
+            ('file3', FileInfo(None, None, 'abcd')),
+            ('file 4', FileInfo(5, None, None))] == \
+        list(read_manifest(manifest))
+
+    # NUL separated, across blocks
+    names = ['file\n{}'.format(i) for i in range(100)]
+    manifest = io.BytesIO('\0'.join(names).encode('utf-8') + b'\0')
+    with patch('vos.commands.vsync.MANIFEST_BLOCK_SIZE', 20):
+        assert [(name, None) for name in names] == \
+            list(read_manifest(manifest))
+
+    with pytest.raises(ValueError):
+        list(read_manifest(io.BytesIO(b'file\tsize\n')))
+
+
+def test_iter_manifest_list():
+    tmp_dir = tempfile.mkdtemp()
+    src_dir = os.path.join(tmp_dir, 'src')
+    info = FileInfo(3, 1.5, None)
+    entries = [('a/b/file1', info),
+               ('a/file2', None),
+               (os.path.join(src_dir, 'a', 'b', 'file3'), info),
+               ('../outside', info),
+               ('c', None),
+               ('c/file4.log', None)]
+    with pytest.raises(ValueError):
+        list(iter_manifest_list(entries, src_dir, 'vos:dest'))
+    os.makedirs(src_dir)
+
+    # the containers come once, ahead of their content
+    assert [(os.path.join(src_dir, 'a'), 'vos:dest/a', None),
+            (os.path.join(src_dir, 'a', 'b'), 'vos:dest/a/b', None),
+            (os.path.join(src_dir, 'a', 'b', 'file1'),
+             'vos:dest/a/b/file1', info),
+            (os.path.join(src_dir, 'a', 'file2'), 'vos:dest/a/file2', None),
+            (os.path.join(src_dir, 'a', 'b', 'file3'),
+             'vos:dest/a/b/file3', info),
+            (os.path.join(src_dir, 'c'), 'vos:dest/c', None),
+            (os.path.join(src_dir, 'c', 'file4.log'),
+             'vos:dest/c/file4.log', None)] == \
+        list(iter_manifest_list(entries, src_dir + '/', 'vos:dest/'))
+
+    # the source directory itself is synced without a trailing /
+    assert [(src_dir, 'vos:dest/src', None),
+            (os.path.join(src_dir, 'c'), 'vos:dest/src/c', None)] == \
+        list(iter_manifest_list(entries, src_dir, 'vos:dest',
+                                exclude='.log,a/'))
+
+    # directories after their content, as listed by find -depth, and
+    # repeated entries come once
+    entries = [('a/file1', None), ('a', None), ('a/file1', None),
+               ('b/file2', info), ('b/file2', info), ('b', None)]
+    assert [(os.path.join(src_dir, 'a'), 'vos:dest/a', None),
+            (os.path.join(src_dir, 'a', 'file1'), 'vos:dest/a/file1', None),
+            (os.path.join(src_dir, 'b'), 'vos:dest/b', None),
+            (os.path.join(src_dir, 'b', 'file2'), 'vos:dest/b/file2',
+             info)] == \
+        list(iter_manifest_list(entries, src_dir + '/', 'vos:dest'))
+
+
+@patch('vos.commands.vsync.compute_md5')
+@patch('vos.commands.vsync.get_client')
+def test_execute_file_info(get_client, compute_md5_mock):
+    # the file is not read when its info is known
+    src = os.path.join(tempfile.mkdtemp(), 'missing')
+    child = Mock(props={'MD5': 'abcd'}, attr={'st_size': 3, 'st_ctime': 2})
+    child.name = 'file'
+    client = Mock()
+    client.get_children_info.return_value = [child]
+    get_client.return_value = client
+    options = argparse.Namespace(
+        overwrite=False, ignore_checksum=False, certfile=None, token=None,
+        cache_nodes=False, insecure=False, verify=False)
+    expected_report = TransferReport()
+    expected_report.files_skipped = 1
+    expected_report.bytes_skipped = 3
+    with patch('vos.commands.vsync.global_listing', RemoteListing()):
+        assert expected_report == execute_upload(
+            src, 'vos:dir/file', FileInfo(3, 1, 'abcd'), options)
+        assert not compute_md5_mock.called
+
+        # known MD5 sent along with the file
+        client.copy.return_value = TransferResult('file', 'ef01', 3, 3)
+        expected_report = TransferReport()
+        expected_report.files_sent = 1
+        expected_report.bytes_sent = 3
+        assert expected_report == execute_upload(
+            src, 'vos:dir/file', FileInfo(3, 1, 'ef01'), options)
+        assert not compute_md5_mock.called
+        assert 'ef01' == client.copy.call_args[1]['md5_checksum']
+
+
+def test_path_filter():
+    path_filter = PathFilter(include=r'\.fits$', exclude='tmp,.git')
+    assert path_filter.accepts('dir/file.fits')
+    assert not path_filter.accepts('dir/file.txt')
+    assert not path_filter.accepts('tmp/file.fits')
+    assert not path_filter.accepts('dir/file #1.fits')
+    # only exclusions and illegal characters apply to a whole tree
+    assert not path_filter.prunes('dir')
+    assert path_filter.prunes('dir/.git')
+    assert path_filter.prunes('dir #1')
+    assert PathFilter().accepts('dir/file.txt')
+
+
+def test_scan_file_list():
+    tmp_dir = tempfile.mkdtemp()
+    src_dir = os.path.join(tmp_dir, 'src')
+    expected = {}
+    for i in range(5):
+        for dirname in ['dir{}'.format(i), os.path.join('dir{}'.format(i),
+                                                        'sub'), 'tmp']:
+            dir_path = os.path.join(src_dir, dirname)
+            os.makedirs(dir_path, exist_ok=True)
+            file_path = os.path.join(dir_path, 'file{}.txt'.format(i))
+            open(file_path, 'w').write('A' * i)
+            if dirname != 'tmp':
+                expected[file_path] = i
+    os.symlink(os.path.join(src_dir, 'dir0'), os.path.join(src_dir, 'link'))
+
+    scanned = []
+
+    def scan_directory(path):
+        scanned.append(path)
+        return orig_scan_directory(path)
+
+    orig_scan_directory = importlib.import_module(
+        'vos.commands.vsync').scan_directory
+    with patch('vos.commands.vsync.scan_directory', scan_directory), \
+            patch('vos.commands.vsync.SCAN_AHEAD', 2):
+        uploads = list(scan_file_list([src_dir + '/'], 'vos:dest',
+                                      recursive=True, exclude='tmp',
+                                      nthreads=4))
+    # excluded directories are not scanned
+    assert os.path.join(src_dir, 'tmp') not in scanned
+    files = {}
+    created = {'vos:dest'}
+    for src, dest, info in uploads:
+        assert dest.rsplit('/', 1)[0] in created
+        if info is None:
+            assert os.path.isdir(src)
+            created.add(dest)
+        else:
+            # the stat of the scan is carried along
+            assert file_info(os.stat(src)) == info
+            files[src] = info.st_size
+    assert expected == files
+    assert 11 == len(created)
+
+    # directories not included are scanned for files that are
+    uploads = list(scan_file_list([src_dir], 'vos:dest', recursive=True,
+                                  include=r'sub/file1'))
+    assert [(os.path.join(src_dir, 'dir1', 'sub', 'file1.txt'),
+             'vos:dest/src/dir1/sub/file1.txt')] == \
+        [(src, dest) for src, dest, info in uploads if info is not None]
+
+    # not recursive
+    uploads = list(scan_file_list([src_dir + '/'], 'vos:dest'))
+    assert [] == uploads
+
+
+def test_scan_file_list_incremental():
+    tmp_dir = tempfile.mkdtemp()
+    src_dir = os.path.join(tmp_dir, 'src')
+    for dirname in ['dir1', 'dir2']:
+        os.makedirs(os.path.join(src_dir, dirname))
+        open(os.path.join(src_dir, dirname, 'file'), 'w').write('ABC')
+    snapshots = DirectorySnapshots(os.path.join(tmp_dir, 'cache.db'))
+    scanned = []
+
+    def scan_directory(path):
+        scanned.append(path)
+        return orig_scan_directory(path)
+
+    def scan():
+        del scanned[:]
+        with patch('vos.commands.vsync.scan_directory', scan_directory):
+            return sorted(scan_file_list([src_dir + '/'], 'vos:dest',
+                                         recursive=True,
+                                         snapshots=snapshots))
+
+    orig_scan_directory = importlib.import_module(
+        'vos.commands.vsync').scan_directory
+    first = scan()
+    assert 4 == len(first)
+    assert 3 == len(scanned)
+    # nothing changed: the snapshots stand for the directories and the
+    # stat of their files
+    with patch('os.stat', wraps=os.stat) as stat_mock:
+        assert first == scan()
+    assert not [args for args, _ in stat_mock.call_args_list
+                if not os.path.isdir(args[0])]
+    assert [] == scanned
+
+    # only the directory that changed is listed
+    new_file = os.path.join(src_dir, 'dir2', 'new')
+    open(new_file, 'w').write('ABCD')
+    stat = os.stat(new_file)
+    dir_stat = os.stat(os.path.join(src_dir, 'dir2'))
+    os.utime(os.path.join(src_dir, 'dir2'),
+             ns=(dir_stat.st_atime_ns, dir_stat.st_mtime_ns + 1))
+    assert sorted(first + [(new_file, 'vos:dest/dir2/new',
+                            file_info(stat))]) == scan()
+    assert [os.path.join(src_dir, 'dir2')] == scanned
+
+
+def test_watch_uploads():
+    tmp_dir = tempfile.mkdtemp()
+    src_dir = os.path.join(tmp_dir, 'src')
+    os.makedirs(os.path.join(src_dir, 'dir1', 'sub'))
+    os.makedirs(os.path.join(src_dir, 'tmp'))
+    for name in [os.path.join('dir1', 'sub', 'file1.txt'),
+                 os.path.join('dir1', 'sub', 'file2.txt'),
+                 os.path.join('tmp', 'file3.txt'), 'file4.txt']:
+        open(os.path.join(src_dir, name), 'w').write('ABC')
+    sources = WatchedSources([src_dir], 'vos:dest/', exclude='tmp')
+    assert [src_dir] == sources.roots
+    assert sources.prunes(os.path.join(src_dir, 'tmp'))
+    assert not sources.prunes(os.path.join(src_dir, 'dir1'))
+    assert sources.prunes(tmp_dir)
+
+    stop = threading.Event()
+    events = [
+        ([os.path.join(src_dir, 'dir1', 'sub', 'file1.txt'),
+          os.path.join(src_dir, 'tmp', 'file3.txt')], False),
+        # still written
+        ([os.path.join(src_dir, 'dir1', 'sub', 'file1.txt')], False),
+        ([os.path.join(src_dir, 'dir1', 'sub', 'file2.txt'),
+          os.path.join(src_dir, 'dir1', 'sub'),
+          os.path.join(src_dir, 'removed.txt')], False),
+        ([], True)]
+
+    class Watcher(object):
+        def changes(self, timeout):
+            if events:
+                return events.pop(0)
+            stop.set()
+            return [], False
+
+    batches = list(watch_uploads(Watcher(), sources, settle=0, stop=stop))
+    # the containers come ahead of their content and only once
+    assert [
+        [(os.path.join(src_dir), 'vos:dest/src', None),
+         (os.path.join(src_dir, 'dir1'), 'vos:dest/src/dir1', None),
+         (os.path.join(src_dir, 'dir1', 'sub'), 'vos:dest/src/dir1/sub',
+          None),
+         (os.path.join(src_dir, 'dir1', 'sub', 'file1.txt'),
+          'vos:dest/src/dir1/sub/file1.txt', None)],
+        [(os.path.join(src_dir, 'dir1', 'sub', 'file1.txt'),
+          'vos:dest/src/dir1/sub/file1.txt', None)],
+        [(os.path.join(src_dir, 'dir1', 'sub', 'file2.txt'),
+          'vos:dest/src/dir1/sub/file2.txt', None)],
+        None] == batches
+
+    # the content of a source ending in / is synced to the destination
+    sources = WatchedSources([src_dir + '/'], 'vos:dest')
+    assert [(os.path.join(src_dir, 'file4.txt'), 'vos:dest/file4.txt',
+             None)] == sources.uploads(os.path.join(src_dir, 'file4.txt'))
+
+
+def test_hash_transfers():
+    vsync_module = importlib.import_module('vos.commands.vsync')
+    engine = Mock()
+    listing = RemoteListing()
+    # container listed: 'same' has the size of the file, 'other' does not
+    listing.created('vos:dest/listed')
+    listing._containers['vos:dest/listed'] = {
+        'same': ('beef', 3, 1), 'other': ('beef', 4, 1)}
+    cache = Mock()
+    transfers = [
+        ('dir', 'vos:dest/dir', None),
+        ('same', 'vos:dest/listed/same', FileInfo(3, 1, None)),
+        ('other', 'vos:dest/listed/other', FileInfo(3, 1, None)),
+        ('new', 'vos:dest/listed/new', FileInfo(3, 1, None)),
+        ('unlisted', 'vos:dest/unlisted/file', FileInfo(3, 1, None)),
+        ('known', 'vos:dest/unlisted/known', FileInfo(3, 1, 'beef')),
+        ('cached', 'vos:dest/unlisted/cached', FileInfo(3, 5, None)),
+        ('stale', 'vos:dest/unlisted/stale', FileInfo(3, 10, None)),
+        ('missing', 'vos:dest/unlisted/missing', FileInfo(3, 1, None)),
+        ('first', 'vos:dest/new/first', FileInfo(3, 1, None))]
+    cache.get.side_effect = lambda src: {'cached': ('beef', 3, 5),
+                                         'stale': ('beef', 3, 5)}.get(src)
+
+    def get_children_info(container, force=False, limit=None):
+        # the containers not listed yet are listed once, here
+        if container != 'vos:dest/unlisted':
+            raise transfer_exceptions.NotFoundException(container)
+        nodes = []
+        for name in ['file', 'stale']:
+            node = Mock()
+            node.name = name
+            node.props = {'MD5': 'beef'}
+            node.attr = {'st_size': 3, 'st_ctime': 1}
+            node.isdir.return_value = False
+            nodes.append(node)
+        return nodes
+    client = Mock()
+    client.get_children_info.side_effect = get_children_info
+    opt = argparse.Namespace(overwrite=False, ignore_checksum=False,
+                             certfile=None, token=None, insecure=False)
+    with patch.object(vsync_module, 'global_hash_engine', engine), \
+            patch.object(vsync_module, 'global_listing', listing), \
+            patch.object(vsync_module, 'global_md5_cache', cache), \
+            patch.object(vsync_module, 'get_client', return_value=client):
+        # the transfers are passed on unchanged
+        assert transfers == list(hash_transfers(transfers, opt))
+        # the files with no destination yet, in particular those of a
+        # new tree, are not hashed ahead of their upload
+        assert [call[0][0] for call in engine.prefetch.call_args_list] == \
+            ['same', 'unlisted', 'stale']
+        assert sorted(call[0][0] for call in
+                      client.get_children_info.call_args_list) == \
+            ['vos:dest/new', 'vos:dest/unlisted']
+
+        # no hashes needed
+        engine.reset_mock()
+        opt.overwrite = True
+        assert transfers == list(hash_transfers(transfers, opt))
+        assert not engine.prefetch.called
+
+    # the hashes are computed by the engine once prefetched
+    tmp_file = tempfile.NamedTemporaryFile()
+    open(tmp_file.name, 'wb').write(b'abc')
+    engine = md5_cache.HashEngine(nthreads=2)
+    try:
+        with patch.object(vsync_module, 'global_hash_engine', engine):
+            engine.prefetch(tmp_file.name)
+            assert hashlib.md5(b'abc').hexdigest() == \
+                compute_md5(tmp_file.name)
+            assert not engine._pending
+    finally:
+        engine.close()
+
+
+def test_compute_md5_fingerprint():
+    tmp_dir = tempfile.mkdtemp()
+    filename = os.path.join(tmp_dir, 'file')
+    open(filename, 'wb').write(b'abc')
+    cache = md5_cache.MD5Cache(os.path.join(tmp_dir, 'cache.db'))
+    vsync_module = importlib.import_module('vos.commands.vsync')
+    expected = hashlib.md5(b'abc').hexdigest()
+    try:
+        with patch.object(vsync_module, 'global_md5_cache', cache):
+            # the stat of the scan has no fingerprint
+            assert expected == compute_md5(filename, FileInfo(3, 1, None))
+            with patch('vos.md5_cache.hash_file') as hash_mock:
+                # unchanged file, not read again
+                assert expected == compute_md5(filename)
+                assert not hash_mock.called
+                # rewritten file
+                open(filename, 'wb').write(b'abd')
+                hash_mock.return_value = 'new'
+                assert 'new' == compute_md5(filename)
+                hash_mock.assert_called_once_with(filename)
+            # the fingerprint of the scan is used as is
+            info = file_info(os.stat(filename))
+            with patch('os.stat', wraps=os.stat) as stat_mock:
+                assert 'new' == compute_md5(filename, info)
+                assert ((filename,),) not in stat_mock.call_args_list
+    finally:
+        cache.close()
@@ -69,6 +69,8 @@
 """copy files vospace to local or local to VOSpace"""
 from .. import md5_cache
 from .. import vos
+from ..concurrency import AdaptiveConcurrency
+from .. import rate_limit
 from ..commonparser import CommonParser, set_logging_level_from_args, \
     exit_on_exception, URI_DESCRIPTION
 
@@ -79,6 +81,8 @@ except ImportError:
 import logging
 import sys
 import errno
+import threading
+import concurrent.futures
 import os
 import re
 import glob
@@ -150,6 +154,17 @@ def vcp():
     parser.add_argument(
         "--ignore", action="store_true", default=False,
         help="ignore errors and continue with recursive copy")
+    parser.add_argument(
+        "--nstreams", type=int, default=1,
+        help="number of parallel streams used to copy the content of "
+             "directories (MAX: 30)")
+    parser.add_argument(
+        "--max-rate", type=int, default=None,
+        help="maximum bandwidth of all the streams together in bytes/sec")
+    parser.add_argument(
+        "--adaptive", action="store_true",
+        help="adjust the number of parallel streams to the load of the "
+             "service, up to --nstreams")
     parser.add_argument(
         "--head", action="store_true",
         help="copy only the headers of a file from vospace. Format of the "
@@ -161,6 +176,15 @@ def vcp():
 
     set_logging_level_from_args(args)
 
+    if args.nstreams < 1 or args.nstreams > 30:
+        parser.error("Number of streams must be between 1 and 30")
+
+    if args.max_rate is not None:
+        if args.max_rate <= 0:
+            parser.error("--max-rate must be a positive number of bytes/sec")
+        rate_limit.set_max_rate(args.max_rate)
+        rate_limit.start_rate_log()
+
     dest = args.destination
     this_destination = dest
 
@@ -171,6 +195,40 @@ def vcp():
         vospace_certfile=args.certfile, vospace_token=args.token,
         insecure=args.insecure)
 
+    # vos.Client uses a requests session which is not thread safe hence
+    # each thread of a parallel copy gets its own instance of the client
+    thread_local = threading.local()
+    thread_local.client = client
+
+    # number of concurrent copies adjusted to the load of the service
+    controller = None
+    if args.adaptive and args.nstreams > 1 and not args.interrogate:
+        controller = AdaptiveConcurrency(args.nstreams)
+        client.add_response_hook(controller.response_hook)
+
+    def get_client():
+        if not hasattr(thread_local, 'client'):
+            thread_local.client = vos.Client(
+                vospace_certfile=args.certfile, vospace_token=args.token,
+                insecure=args.insecure)
+            if controller is not None:
+                thread_local.client.add_response_hook(
+                    controller.response_hook)
+        return thread_local.client
+
+    # state of a parallel (--nstreams) copy
+    exit_code_lock = threading.Lock()
+    abort = threading.Event()
+    futures = []
+    executor = None
+    if args.nstreams > 1 and not args.interrogate:
+        executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=args.nstreams)
+
+    def add_exit_code(code):
+        with exit_code_lock:
+            Nonlocal.exit_code += code
+
     if not client.is_remote_file(dest):
         dest = os.path.abspath(dest)
 
@@ -198,7 +256,7 @@ def vcp():
 
     def get_node(filename, limit=None):
         """Get node, from cache if possible"""
-        return client.get_node(filename, limit=limit)
+        return get_client().get_node(filename, limit=limit)
 
     # here are a series of methods that choose between calling the system
     # version or the vos version of various
@@ -207,14 +265,14 @@ def vcp():
 
     def isdir(filename):
         logging.debug("Doing an isdir on %s" % filename)
-        if client.is_remote_file(filename):
-            return client.isdir(filename)
+        if get_client().is_remote_file(filename):
+            return get_client().isdir(filename)
         else:
             return os.path.isdir(filename)
 
     def islink(filename):
         logging.debug("Doing an islink on %s" % filename)
-        if client.is_remote_file(filename):
+        if get_client().is_remote_file(filename):
             try:
                 return get_node(filename).islink()
             except exceptions.NotFoundException:
@@ -230,7 +288,7 @@ def vcp():
         @return: True/False
         """
         logging.debug("checking for access %s " % filename)
-        if client.is_remote_file(filename):
+        if get_client().is_remote_file(filename):
             try:
                 node = get_node(filename, limit=0)
                 return node is not None
@@ -241,32 +299,39 @@ def vcp():
         else:
             return os.access(filename, mode)
 
-    def listdir(dirname):
-        """Walk through the directory structure a al os.walk"""
-        logging.debug("getting a dirlist %s " % dirname)
-
-        if client.is_remote_file(dirname):
-            return client.listdir(dirname, force=True)
+    def listdir_types(dirname):
+        """
+        Content of a directory with the type of the entries, taken from the
+        listing so that the entries do not need a lookup each
+        :return: list of (name, is_dir) with is_dir None for the remote
+        links whose type is only known by following them
+        """
+        logging.debug("getting a typed dirlist %s " % dirname)
+        if get_client().is_remote_file(dirname):
+            return [(node.name, None if node.islink() else node.isdir())
+                    for node in get_client().get_children_info(dirname,
+                                                               force=True)]
         else:
-            return os.listdir(dirname)
+            with os.scandir(dirname) as entries:
+                return [(entry.name, entry.is_dir()) for entry in entries]
 
     def mkdir(filename):
         logging.debug("Making directory %s " % filename)
-        if client.is_remote_file(filename):
-            return client.mkdir(filename)
+        if get_client().is_remote_file(filename):
+            return get_client().mkdir(filename)
         else:
             return os.mkdir(filename)
 
     def get_md5(filename):
         logging.debug("getting the MD5 for %s" % filename)
-        if client.is_remote_file(filename):
+        if get_client().is_remote_file(filename):
             return get_node(filename).props.get('MD5', vos.ZERO_MD5)
         else:
             return md5_cache.MD5Cache.compute_md5(filename)
 
     def lglob(pathname):
-        if client.is_remote_file(pathname):
-            return client.glob(pathname)
+        if get_client().is_remote_file(pathname):
+            return get_client().glob(pathname)
         else:
             return glob.glob(pathname)
 
@@ -308,12 +373,26 @@ def vcp():
                     mkdir(destination_name)
                 # for all files in the current source directory copy them to
                 # the destination directory
-                for filename in listdir(source_name):
+                for filename, child_is_dir in listdir_types(source_name):
+                    if abort.is_set():
+                        break
                     logging.debug("%s -> %s" % (filename, source_name))
-                    copy(os.path.join(source_name, filename),
-                         os.path.join(destination_name, filename),
-                         exclude, include, interrogate, overwrite, ignore,
-                         head)
+                    child_source = os.path.join(source_name, filename)
+                    child_destination = os.path.join(destination_name,
+                                                     filename)
+                    if child_is_dir is None:
+                        child_is_dir = isdir(child_source)
+                    if executor is not None and not child_is_dir:
+                        # files are copied by the workers while this
+                        # thread continues to walk the directories
+                        futures.append(executor.submit(
+                            copy_task, child_source, child_destination,
+                            exclude, include, interrogate, overwrite, ignore,
+                            head))
+                    else:
+                        copy(child_source, child_destination,
+                             exclude, include, interrogate, overwrite, ignore,
+                             head)
             else:
                 if interrogate:
                     if access(destination_name, os.F_OK):
@@ -344,7 +423,7 @@ def vcp():
                 while not skip:
                     try:
                         logging.debug("Starting call to copy")
-                        client.copy(source_name, destination_name, head=head)
+                        get_client().copy(source_name, destination_name, head=head)
                         logging.debug("Call to copy returned")
                         break
                     except Exception as client_exception:
@@ -353,8 +432,8 @@ def vcp():
                             # 104 is connection reset by peer.
                             # Try again on this error
                             logging.warning(str(client_exception))
-                            Nonlocal.exit_code += \
-                                getattr(client_exception, 'errno', -1)
+                            add_exit_code(
+                                getattr(client_exception, 'errno', -1))
                         elif getattr(client_exception, 'errno',
                                      -1) == errno.EIO:
                             # retry on IO errors
@@ -380,10 +459,59 @@ def vcp():
             if getattr(os_exception, 'errno', -1) == errno.EINVAL:
                 # not a valid uri, just skip those...
                 logging.warning("%s: Skipping" % str(os_exception))
-                Nonlocal.exit_code += getattr(os_exception, 'errno', -1)
+                add_exit_code(getattr(os_exception, 'errno', -1))
             else:
                 exit_on_exception(os_exception)
 
+    def copy_task(*copy_args):
+        """
+        Runs copy in a worker thread of a parallel copy. A failure stops
+        the scheduling of the remaining files, same as in a serial copy.
+        """
+        if abort.is_set():
+            return
+        if controller is not None:
+            controller.acquire()
+        nbytes = 0
+        try:
+            copy(*copy_args)
+            nbytes = copied_size(*copy_args[:2])
+        except BaseException:
+            abort.set()
+            raise
+        finally:
+            if controller is not None:
+                controller.release(nbytes)
+
+    def copied_size(source_name, destination_name):
+        """
+        Size of the local side of a copy
+        """
+        if get_client().is_remote_file(source_name):
+            local_name = destination_name
+        else:
+            local_name = source_name
+        try:
+            return os.stat(local_name).st_size
+        except OSError:
+            return 0
+
+    def wait_for_copies():
+        """
+        Waits for the files queued with the workers and re-raises the
+        first error encountered by any of them.
+        """
+        try:
+            for future in concurrent.futures.as_completed(futures):
+                future.result()
+        except BaseException:
+            abort.set()
+            for future in futures:
+                future.cancel()
+            raise
+        finally:
+            executor.shutdown(wait=True)
+
     # main loop
     # Set source to the initial value of args so that if we have any issues
     # in the try before source gets defined at least we know where we were
@@ -466,6 +594,8 @@ def vcp():
                      include=args.include,
                      interrogate=args.interrogate, overwrite=args.overwrite,
                      ignore=args.ignore, head=args.head)
+        if executor is not None:
+            wait_for_copies()
 
     except KeyboardInterrupt as ke:
         logging.info("Received keyboard interrupt. Execution aborted...\n")
@@ -486,6 +616,9 @@ def vcp():
             exit_on_exception(e, msg)
         else:
             exit_on_exception(e)
+    finally:
+        # files still queued with the workers are skipped on errors
+        abort.set()
     if Nonlocal.exit_code:
         sys.exit(Nonlocal.exit_code)
 
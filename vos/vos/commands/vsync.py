@@ -66,6 +66,8 @@
 # ***********************************************************************
 #
 
+import copy
+import errno
 import os
 import sys
 from vos.commonparser import CommonParser, set_logging_level_from_args, \
@@ -74,12 +76,24 @@ import logging
 import time
 import signal
 import threading
+import zlib
+from collections import namedtuple
 import concurrent.futures
+import collections
+import multiprocessing
+import queue
+import bisect
+import json
 import re
 
 from vos import vos
 from cadcutils import exceptions as transfer_exceptions
 from .. import md5_cache
+from .. import transfer_journal
+from .. import rate_limit
+from .. import dir_snapshot
+from .. import watch
+from ..concurrency import AdaptiveConcurrency
 
 DESCRIPTION = """A script for sending files to VOSpace via multiple connection
 streams.
@@ -93,44 +107,160 @@ to be copied to VOSpace.  vsync launches mutlple threads that listen to the
 queue and transfer files independently to VOSpace and report success if the
 file successfully copies to VOSpace.
 
+When the sources are in VOSpace and the destination is a local directory,
+vsync works the other way around: the MD5 sums in the VOSpace listings are
+compared to those of the local files and only the data nodes that are
+missing or differ locally are downloaded.
+
 At the completion of vsync an error report indicates if there were failures.
 Run vsync repeatedly until no errors are reported.
 
+The progress of the transfers is recorded in a journal next to the cache
+database. After an interruption, the same vsync command with --resume
+continues with the transfers that did not complete and, with --retry-failed,
+repeats only the transfers that failed.
+
+With --delete, the VOSpace nodes that are no longer in the local copy are
+deleted once the files are synced. Run with --dry-run first to review the
+list of the nodes that would be deleted.
+
+With --plan, vsync only compares the local copy with VOSpace and prints, as
+JSON, the number of files and bytes to upload or skip and of containers to
+create. The duration of the sync is estimated from the throughput of the
+previous syncs recorded in the journal.
+
+With --processes, the transfers are shared by several processes, each
+running --nstreams streams, which makes use of several cores on large
+syncs. The containers are created and the skip decisions made by the main
+process.
+
+With --shard i/N, several hosts seeing the same files share a sync: each
+host transfers the files of its shard and creates the directories of its
+shard, along with those its files need. With a shared --journal-dir, a
+final run with --shard-report merges the journals of the shards.
+
+The local files are hashed by a pool of --hash-threads threads, or of
+--hash-processes processes, ahead of their comparison with VOSpace so that
+hashing overlaps with the transfers.
+
+With --from-manifest, the files to sync are read from a list, for instance
+produced by the pipeline that changed them, instead of scanning the source
+directory. The sizes, modification times and MD5s given in the list are
+used as they are, so the files are not hashed locally.
+
 eg:
   vsync --cache_nodes --recursive --verbose ./local_dir vos:VOSPACE/remote_dir
 
 Using cache_nodes option will greatly improve the speed of repeated calls but
 does result in a  cache database file: $HOME/.config/vos/node_cache.db
+A file is hashed again only when its device, inode, size, modification or
+change time differ from the ones recorded in the cache.
+
+The --incremental option records the content of the local directories in the
+same database so that the next syncs only list the directories that changed.
+
+With --watch, vsync keeps running after the sync and uploads the files that
+change in the source directories once they have not changed for a couple of
+seconds. The changes are reported by inotify on Linux and found by scanning
+the directories periodically elsewhere. Stop the watch with CTRL-C.
 """.format(URI_DESCRIPTION)
 
 HOME = os.getenv("HOME", "./")
 
+# number of nodes requested in each page of a destination container listing
+LISTING_PAGE_SIZE = 500
+# number of transfers queued ahead of each stream
+QUEUED_TRANSFERS_PER_STREAM = 10
+# name of the transfer journal db, stored in the directory of the cache db
+JOURNAL_FILENAME = 'vsync_journal.db'
+# journal of a shard of a sync, in the same directory
+SHARD_JOURNAL_FILENAME = 'vsync_journal.{}of{}.db'
+SHARD_JOURNAL_PATTERN = re.compile(r'^vsync_journal\.(\d+)of(\d+)\.db$')
+# scheduling policies: number of files ordered at once and size of the files
+# that get dedicated streams in the balanced policy
+SCHEDULE_WINDOW = 10000
+LARGE_FILE_SIZE = 1024 ** 3
+SCHEDULES = ['largest-first', 'smallest-first', 'balanced']
+# size of the blocks a manifest is read in
+MANIFEST_BLOCK_SIZE = 2 ** 16
+# threads listing the source directories and number of directories listed
+# ahead of the transfers
+SCAN_THREADS = 8
+SCAN_AHEAD = 64
+# seconds a watched file must stay unchanged before its upload and maximum
+# time to wait for changes
+WATCH_SETTLE = 2
+WATCH_TIMEOUT = 1
+# characters allowed in the names of the nodes
+VALID_PATH = re.compile(r'^[A-Za-z0-9._\-();:&*$@!+=/]*$')
+
+# size, modification time and MD5 of a local file known ahead of its
+# upload, None for the unknown values. The files found by the scan also
+# carry the rest of the fingerprint of their stat in the MD5 cache.
+FileInfo = namedtuple('FileInfo', ['st_size', 'st_mtime', 'md5', 'st_dev',
+                                   'st_ino', 'st_mtime_ns', 'st_ctime_ns'],
+                      defaults=(None, None, None, None))
+
 global_md5_cache = None
+global_hash_engine = None
+global_listing = None
+global_controller = None
 node_dict = {}
 
 # placeholder for data local to a thread
 thread_local = threading.local()
 
 
-def compute_md5(filename):
+def compute_md5(filename, stat=None):
     """"
     Computes the md5 of a file and caches the value for subsequent calls
+    :param filename: local path to file
+    :param stat: os.stat() of the file if already known
     """
     md5 = None
     if global_md5_cache is not None:
-        md5 = global_md5_cache.get(filename)
-    if md5 is None or md5[2] < os.stat(filename).st_mtime:
-        md5 = md5_cache.MD5Cache.compute_md5(filename,
-                                             block_size=2**19)
+        stat = fingerprint_stat(filename, stat)
+        # the files of a directory are looked up in memory
+        global_md5_cache.prefetch(os.path.dirname(filename))
+        # the file is hashed again only if its fingerprint changed
+        md5 = global_md5_cache.get_md5(filename, stat)
+    if md5 is None:
+        if global_hash_engine is not None:
+            md5 = global_hash_engine.md5(filename)
+        else:
+            md5 = md5_cache.hash_file(filename)
         if global_md5_cache is not None:
-            stat = os.stat(filename)
             global_md5_cache.update(filename, md5, stat.st_size,
-                                    stat.st_mtime)
-    else:
-        md5 = md5[0]
+                                    stat.st_mtime, stat=stat)
+    elif global_hash_engine is not None:
+        global_hash_engine.discard(filename)
     return md5
 
 
+def fingerprint_stat(filename, stat=None):
+    """
+    Stat of a local file with the fields of its fingerprint in the MD5
+    cache
+    :param filename: local path to file
+    :param stat: os.stat() or FileInfo of the file if already known
+    :return: os.stat() of the file, or stat if it holds the fingerprint
+    """
+    if stat is None or getattr(stat, 'st_ino', None) is None:
+        return os.stat(filename)
+    return stat
+
+
+def file_info(stat, md5=None):
+    """
+    FileInfo of a local file with the fingerprint of its stat
+    :param stat: os.stat() of the file
+    :param md5: MD5 of the file if known
+    :return: FileInfo
+    """
+    return FileInfo(stat.st_size, stat.st_mtime, md5, stat.st_dev,
+                    stat.st_ino, stat.st_mtime_ns, stat.st_ctime_ns)
+
+
 def get_client(certfile, token, insecure):
     """
     Returns a VOS client instance for each thread. VOS Client uses requests
@@ -145,6 +275,9 @@ def get_client(certfile, token, insecure):
         thread_local.client = vos.Client(vospace_certfile=certfile,
                                          vospace_token=token,
                                          insecure=insecure)
+        if global_controller is not None:
+            thread_local.client.add_response_hook(
+                global_controller.response_hook)
     return thread_local.client
 
 
@@ -158,77 +291,481 @@ class TransferReport:
         self.bytes_skipped = 0
         self.files_skipped = 0
         self.files_erred = 0
+        self.files_deleted = 0
+        self.containers_created = 0
 
     def __eq__(self, other):
         return (self.bytes_sent == other.bytes_sent) and \
                (self.files_sent == other.files_sent) and \
                (self.bytes_skipped == other.bytes_skipped) and \
                (self.files_skipped == other.files_skipped) and \
-               (self.files_erred == other.files_erred)
+               (self.files_erred == other.files_erred) and \
+               (self.files_deleted == other.files_deleted) and \
+               (self.containers_created == other.containers_created)
+
+    def __iadd__(self, other):
+        self.bytes_sent += other.bytes_sent
+        self.files_sent += other.files_sent
+        self.bytes_skipped += other.bytes_skipped
+        self.files_skipped += other.files_skipped
+        self.files_erred += other.files_erred
+        self.files_deleted += other.files_deleted
+        self.containers_created += other.containers_created
+        return self
+
+
+def run_transfers(transfers, worker, opt, max_queued=None,
+                  dependencies=None):
+    """
+    Streams the transfers to a pool of opt.nstreams threads. The transfers
+    are consumed from the iterable only as fast as the pool can take them and
+    the results are folded into the report as they complete so that the
+    memory used does not depend on the number of transfers.
+
+    Transfers that create containers and the transfers into those
+    containers share the pool: a transfer is held back only while the
+    container it goes into is still being created and started as soon
+    as that is done.
+    :param transfers: iterable of the arguments of the worker
+    :param worker: function performing a transfer and returning a
+    TransferReport
+    :param opt: command line parameters
+    :param max_queued: maximum number of transfers waiting for a thread
+    :param dependencies: function returning the (container, parent) of a
+    transfer, container being the container created by the transfer (None
+    if not a container) and parent the container the transfer goes into.
+    None if the transfers are independent
+    :return: TransferReport() of all the transfers
+    """
+    if max_queued is None:
+        max_queued = QUEUED_TRANSFERS_PER_STREAM * opt.nstreams
+    end_result = TransferReport()
+    lock = threading.Lock()
+    total_slots = opt.nstreams + max_queued
+    slots = threading.BoundedSemaphore(total_slots)
+    # containers being created -> transfers waiting for them
+    waiting = {}
+
+    def submit(transfer, container):
+        executor.submit(worker, *transfer, opt).add_done_callback(
+            lambda future: done(future, container))
+
+    def done(future, container):
+        nonlocal end_result
+        try:
+            res = future.result()
+        except Exception as ex:
+            logging.error('Transfer failed: {}'.format(str(ex)))
+            res = TransferReport()
+            res.files_erred = 1
+        with lock:
+            end_result += res
+            children = waiting.pop(container, [])
+        for child in children:
+            submit(*child)
+        slots.release()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=opt.nstreams) \
+            as executor:
+        transfers = iter(transfers)
+        while True:
+            # a transfer is taken from the iterable only once there is room
+            # for it so that schedulers decide with the latest information
+            slots.acquire()
+            transfer = next(transfers, None)
+            if transfer is None:
+                slots.release()
+                break
+            container, parent = (None, None) if dependencies is None \
+                else dependencies(transfer)
+            with lock:
+                if container in waiting:
+                    # already being created
+                    slots.release()
+                    continue
+                if container is not None:
+                    waiting[container] = []
+                if parent in waiting:
+                    waiting[parent].append((transfer, container))
+                    continue
+            submit(transfer, container)
+        # transfers held back are submitted by the threads so wait for all
+        # of them to complete before shutting down the pool
+        for _ in range(total_slots):
+            slots.acquire()
+    return end_result
+
+
+class SizeScheduler(object):
+    """
+    Orders the transfers according to the size of the files:
+
+    - largest-first: the largest files are transferred first so that no
+      large file is left running alone at the end of the sync
+    - smallest-first: the smallest files are transferred first
+    - balanced: files larger than LARGE_FILE_SIZE are transferred by a
+      quarter of the streams while the other streams go through the small
+      files. Streams take whatever is left once either kind runs out.
+
+    The files are ordered within windows of SCHEDULE_WINDOW files to bound
+    the memory used. Transfers without size (directories) are not delayed.
+    """
+    def __init__(self, policy, nstreams, sizer, window=SCHEDULE_WINDOW,
+                 large_file_size=LARGE_FILE_SIZE):
+        """
+        :param policy: one of SCHEDULES
+        :param nstreams: number of transfer streams
+        :param sizer: function returning the size of a transfer or None if
+        it is not a file
+        :param window: maximum number of files waiting to be scheduled
+        :param large_file_size: size of the files with dedicated streams
+        """
+        if policy not in SCHEDULES:
+            raise ValueError('Unknown schedule {}'.format(policy))
+        self.policy = policy
+        self.sizer = sizer
+        self.window = window
+        self.large_file_size = large_file_size
+        self.large_streams = max(1, nstreams // 4)
+        self._large_in_flight = set()
+        self._lock = threading.Lock()
+
+    def schedule(self, transfers):
+        """
+        Generator of the transfers in the order of the policy
+        :param transfers: iterable of transfers
+        :return: the transfers
+        """
+        pending = []  # sorted (size, sequence, transfer)
+        sequence = 0
+        transfers = iter(transfers)
+        exhausted = False
+        while True:
+            while not exhausted and len(pending) < self.window:
+                transfer = next(transfers, None)
+                if transfer is None:
+                    exhausted = True
+                    break
+                size = self.sizer(transfer)
+                if size is None:
+                    yield transfer
+                    continue
+                bisect.insort(pending, (size, sequence, transfer))
+                sequence += 1
+            if not pending:
+                return
+            yield self._pick(pending)
+
+    def track(self, worker):
+        """
+        Wraps a worker so that the scheduler knows when the transfers of
+        large files complete
+        :param worker: function performing a transfer
+        :return: the wrapped worker
+        """
+        def tracked_worker(*args):
+            try:
+                return worker(*args)
+            finally:
+                with self._lock:
+                    self._large_in_flight.discard((args[0], args[1]))
+        return tracked_worker
+
+    def _pick(self, pending):
+        if self.policy == 'largest-first':
+            return pending.pop()[2]
+        if self.policy == 'smallest-first':
+            return pending.pop(0)[2]
+        with self._lock:
+            large_streams_busy = \
+                len(self._large_in_flight) >= self.large_streams
+        if pending[0][0] >= self.large_file_size or (
+                pending[-1][0] >= self.large_file_size and
+                not large_streams_busy):
+            # only large files left or a large file stream is available
+            transfer = pending.pop()[2]
+            if self.sizer(transfer) >= self.large_file_size:
+                with self._lock:
+                    self._large_in_flight.add((transfer[0], transfer[1]))
+            return transfer
+        return pending.pop(0)[2]
+
+
+def upload_size(transfer):
+    """
+    Size of the file of an upload
+    :param transfer: (src, dest, info) of the upload
+    :return: the size of src or None if src is not a file
+    """
+    info = transfer[2]
+    if info is not None and info.st_size is not None:
+        return info.st_size
+    try:
+        stat = os.stat(transfer[0])
+    except OSError:
+        # reported by the transfer
+        return 0
+    return stat.st_size if os.path.isfile(transfer[0]) else None
+
+
+def download_size(transfer):
+    """
+    Size of the data node of a download
+    :param transfer: (src, dest, node) of the download
+    :return: the size of the node, 0 if not known
+    """
+    node = transfer[2]
+    return 0 if node is None else node.attr['st_size']
 
 
-def execute(src, dest, opt):
+class RemoteListing(object):
+    """
+    Map of the destination nodes built from the listings of their containers.
+    Each container is listed once, page by page, the first time one of its
+    children is looked up so that the skip decisions do not require a
+    request per file. The listing of a container is dropped once all the
+    transfers retained in it are done, a container looked up again later
+    is listed again.
+    """
+    def __init__(self, page_size=LISTING_PAGE_SIZE):
+        self.page_size = page_size
+        self._containers = {}
+        self._subcontainers = {}
+        self._locks = {}
+        self._retained = {}
+        self._lock = threading.Lock()
+
+    def get(self, client, uri):
+        """
+        Returns the (MD5, length, date) of a destination node
+        :param client: vos client to list the container with if required
+        :param uri: vospace location of the node
+        :return: (MD5, length, date) tuple or None if the node does not exist
+        """
+        container, name = uri.rstrip('/').rsplit('/', 1)
+        return self._list(client, container)[0].get(name)
+
+    def children(self, client, container):
+        """
+        Returns the children of a destination container
+        :param client: vos client to list the container with if required
+        :param container: vospace location of the container
+        :return: dictionary of the child names and whether they are
+        containers
+        """
+        children, subcontainers = self._list(client, container.rstrip('/'))
+        return {name: name in subcontainers for name in children}
+
+    def retain(self, transfers):
+        """
+        Keeps the listings of the containers of the transfers until they
+        are done
+        :param transfers: iterable of the (src, dest, ...) of the transfers
+        :return: iterable of the same transfers
+        """
+        for transfer in transfers:
+            container = transfer[1].rstrip('/').rsplit('/', 1)[0]
+            with self._lock:
+                self._retained[container] = \
+                    self._retained.get(container, 0) + 1
+            yield transfer
+
+    def track(self, worker):
+        """
+        Wraps a worker so that the listing of a container is dropped once
+        the last transfer retained in it is done
+        :param worker: function performing a transfer
+        :return: the wrapped worker
+        """
+        def tracked_worker(*args):
+            try:
+                return worker(*args)
+            finally:
+                container = args[1].rstrip('/').rsplit('/', 1)[0]
+                with self._lock:
+                    retained = self._retained.get(container, 0) - 1
+                    if retained > 0:
+                        self._retained[container] = retained
+                    else:
+                        self._retained.pop(container, None)
+                        self._forget(container)
+        return tracked_worker
+
+    def forget(self, container):
+        """
+        Drops the listing of a container no longer looked up
+        :param container: vospace location of the container
+        """
+        with self._lock:
+            self._forget(container.rstrip('/'))
+
+    def _forget(self, container):
+        self._containers.pop(container, None)
+        self._subcontainers.pop(container, None)
+        self._locks.pop(container, None)
+
+    def created(self, uri):
+        """
+        Records a container created by this process, hence empty, so that it
+        does not need listing
+        :param uri: vospace location of the container
+        """
+        container = uri.rstrip('/')
+        with self._lock:
+            self._locks.setdefault(container, threading.Lock())
+            self._containers.setdefault(container, {})
+            self._subcontainers.setdefault(container, set())
+
+    def _list(self, client, container):
+        with self._lock:
+            lock = self._locks.setdefault(container, threading.Lock())
+        with lock:
+            with self._lock:
+                children = self._containers.get(container)
+                subcontainers = self._subcontainers.get(container)
+            if children is None:
+                children = {}
+                subcontainers = set()
+                try:
+                    for node in client.get_children_info(
+                            container, force=True, limit=self.page_size):
+                        children[node.name] = (
+                            node.props.get('MD5', vos.ZERO_MD5),
+                            node.attr['st_size'],
+                            node.attr['st_ctime'])
+                        if node.isdir():
+                            subcontainers.add(node.name)
+                except transfer_exceptions.NotFoundException:
+                    pass
+                with self._lock:
+                    self._subcontainers[container] = subcontainers
+                    self._containers[container] = children
+            return children, subcontainers
+
+
+def compare(src, dest, stat, client, opt, src_md5=None):
+    """
+    Compares a local file with its destination node
+    :param src: local path to file
+    :param dest: vospace location
+    :param stat: os.stat() of the local file
+    :param client: vos client to get the node with if required
+    :param opt: command line parameters
+    :param src_md5: MD5 of the file if already known
+    :return: (length, src_md5) with length the length of the destination
+    node if it matches the file, None otherwise, and src_md5 the MD5 of the
+    file if known or computed, None otherwise
+    """
+    try:
+        node_info = None
+        if opt.cache_nodes:
+            global_md5_cache.prefetch(dest.rsplit('/', 1)[0], remote=True)
+            node_info = global_md5_cache.get(dest, remote=True)
+        if node_info is None:
+            logging.debug(str(dest))
+            if global_listing is not None:
+                logging.debug('Getting node info from container listing')
+                node_info = global_listing.get(client, dest)
+                if node_info is None:
+                    raise transfer_exceptions.NotFoundException(dest)
+            else:
+                logging.debug('Getting node info from VOSpace')
+                logging.debug(str(node_dict.keys()))
+                node = client.get_node(dest, limit=None)
+                node_info = (node.props.get('MD5', vos.ZERO_MD5),
+                             node.attr['st_size'],
+                             node.attr['st_ctime'])
+            if opt.cache_nodes:
+                global_md5_cache.update(dest, *node_info, remote=True)
+        dest_md5 = node_info[0]
+        dest_length = node_info[1]
+        dest_time = node_info[2]
+        logging.debug('Destination MD5: {}'.format(
+            dest_md5))
+        if not opt.ignore_checksum and dest_length == stat.st_size and \
+                src_md5 is None:
+            # files of different sizes differ, no need to hash them
+            src_md5 = compute_md5(src, stat)
+        if ((not opt.ignore_checksum and src_md5 == dest_md5) or
+                (opt.ignore_checksum and
+                 dest_time >= stat.st_mtime and
+                 dest_length == stat.st_size)):
+            return dest_length, src_md5
+    except (transfer_exceptions.AlreadyExistsException,
+            transfer_exceptions.NotFoundException):
+        pass
+    return None, src_md5
+
+
+def file_stat(src, info=None):
+    """
+    Size and modification time of a local file
+    :param src: local path to file
+    :param info: FileInfo of the file if known
+    :return: os.stat() of the file or info if it has the size and time
+    """
+    if info is not None and info.st_size is not None and \
+            info.st_mtime is not None:
+        return info
+    return os.stat(src)
+
+
+def execute(src, dest, opt, info=None):
     """
     Transfer a file from source to destination
     :param src: local path to file to transfer
     :param dest: vospace location
     :param opt: command line parameters
+    :param info: FileInfo of the file if known
     :return: TransferReport()
     """
     result = TransferReport()
-    src_md5 = None
-    stat = os.stat(src)
-    if not opt.ignore_checksum and not opt.overwrite:
-        src_md5 = compute_md5(src)
+    src_md5 = None if info is None else info.md5
+    stat = file_stat(src, info)
     client = get_client(opt.certfile, opt.token, opt.insecure)
     if not opt.overwrite:
         # Check if the file is the same
-        try:
-            node_info = None
-            if opt.cache_nodes:
-                node_info = global_md5_cache.get(dest)
-            if node_info is None:
-                logging.debug('Getting node info from VOSpace')
-                logging.debug(str(node_dict.keys()))
-                logging.debug(str(dest))
-                node = client.get_node(dest, limit=None)
-                dest_md5 = node.props.get(
-                    'MD5', 'd41d8cd98f00b204e9800998ecf8427e')
-                dest_length = node.attr['st_size']
-                dest_time = node.attr['st_ctime']
-                if opt.cache_nodes:
-                    global_md5_cache.update(
-                        dest,
-                        dest_md5,
-                        dest_length,
-                        dest_time)
-            else:
-                dest_md5 = node_info[0]
-                dest_length = node_info[1]
-                dest_time = node_info[2]
-            logging.debug('Destination MD5: {}'.format(
-                dest_md5))
-            if ((not opt.ignore_checksum and src_md5 == dest_md5) or
-                    (opt.ignore_checksum and
-                     dest_time >= stat.st_mtime and
-                     dest_length == stat.st_size)):
-                logging.info('skipping: {}  matches {}'.format(src, dest))
-                result.files_skipped = 1
-                result.bytes_skipped = dest_length
-                return result
-        except (transfer_exceptions.AlreadyExistsException,
-                transfer_exceptions.NotFoundException):
-            pass
+        dest_length, src_md5 = compare(src, dest, stat, client, opt,
+                                       src_md5)
+        if src_md5 is None and global_hash_engine is not None:
+            # hashed ahead of time but not needed for the comparison
+            global_hash_engine.discard(src)
+        if dest_length is not None:
+            logging.info('skipping: {}  matches {}'.format(src, dest))
+            result.files_skipped = 1
+            result.bytes_skipped = dest_length
+            return result
     logging.info('{} -> {}'.format(src, dest))
     try:
-        client.copy(src, dest)
-        node = client.get_node(dest, limit=None)
-        dest_md5 = node.props.get(
-            'MD5', 'd41d8cd98f00b204e9800998ecf8427e')
-        dest_length = node.attr['st_size']
-        dest_time = node.attr['st_ctime']
+        cache_stat = None
+        if global_md5_cache is not None and src_md5 is None:
+            # the fingerprint of the file before the upload reads it
+            cache_stat = fingerprint_stat(src, stat)
+        # the md5 of the source is computed during the upload unless
+        # already known
+        transfer = client.copy(src, dest, send_md5=True, stream_md5=True,
+                               md5_checksum=src_md5, transfer_result=True)
+        if cache_stat is not None and transfer.md5:
+            global_md5_cache.update(src, transfer.md5, cache_stat.st_size,
+                                    cache_stat.st_mtime, stat=cache_stat)
+        dest_md5 = transfer.md5
+        dest_length = transfer.length
+        dest_time = transfer.timestamp
+        if opt.verify:
+            # check the transfer against the node in VOSpace
+            node = client.get_node(dest, limit=None, force=True)
+            dest_md5 = node.props.get('MD5', vos.ZERO_MD5)
+            dest_length = node.attr['st_size']
+            dest_time = node.attr['st_ctime']
+            if dest_md5 != transfer.md5 or dest_length != stat.st_size:
+                raise OSError(
+                    errno.EIO, 'Verification failed: {} (MD5 {}, {} bytes) '
+                    'does not match {} (MD5 {}, {} bytes)'.format(
+                        dest, dest_md5, dest_length, src, transfer.md5,
+                        stat.st_size))
         if opt.cache_nodes:
-            global_md5_cache.update(dest, dest_md5, dest_length, dest_time)
+            global_md5_cache.update(dest, dest_md5, dest_length, dest_time,
+                                    remote=True)
         result.files_sent += 1
         result.bytes_sent += stat.st_size
         return result
@@ -244,6 +781,98 @@ def execute(src, dest, opt):
     return result
 
 
+def execute_download(src, dest, node, opt):
+    """
+    Transfer a data node from VOSpace to a local file
+    :param src: vospace location of the data node
+    :param dest: local path to the file to transfer to
+    :param node: the data node as found in the listing of its container
+    :param opt: command line parameters
+    :return: TransferReport()
+    """
+    result = TransferReport()
+    client = get_client(opt.certfile, opt.token, opt.insecure)
+    if node is None:
+        # transfer replayed from the journal
+        node = client.get_node(src, limit=0, force=True)
+    src_md5 = node.props.get('MD5', vos.ZERO_MD5)
+    src_length = node.attr['st_size']
+    src_time = node.attr['st_ctime']
+    if not opt.overwrite and os.path.isfile(dest):
+        # Check if the file is the same
+        stat = os.stat(dest)
+        if stat.st_size == src_length and (
+                (opt.ignore_checksum and stat.st_mtime >= src_time) or
+                (not opt.ignore_checksum and compute_md5(dest) == src_md5)):
+            logging.info('skipping: {}  matches {}'.format(dest, src))
+            result.files_skipped = 1
+            result.bytes_skipped = src_length
+            return result
+    logging.info('{} -> {}'.format(src, dest))
+    try:
+        md5 = client.copy(src, dest, send_md5=True)
+        if global_md5_cache is not None and md5:
+            stat = os.stat(dest)
+            global_md5_cache.update(dest, md5, stat.st_size, stat.st_mtime,
+                                    stat=stat)
+        result.files_sent += 1
+        result.bytes_sent += src_length
+        return result
+    except (IOError, OSError) as exc:
+        logging.error(
+            'Error reading {} from server, skipping'.format(src))
+        logging.debug(str(exc))
+    result.files_erred += 1
+    return result
+
+
+class PathFilter(object):
+    """
+    The include and exclude patterns of a sync, compiled once for all the
+    paths
+    """
+    def __init__(self, include=None, exclude=None):
+        """
+        :param include: pattern for names to include
+        :param exclude: comma separated strings to exclude when occuring in
+        names
+        """
+        self.include = None if include is None else re.compile(include)
+        self.exclude = exclude.split(',') if exclude else []
+
+    def accepts(self, path):
+        """
+        Determines whether a directory or filename should be included or not
+        :param path: path to consider
+        :return: True if filename is to be included, False otherwise
+        """
+        if VALID_PATH.match(path) is None:
+            logging.error("filename {} contains illegal characters, "
+                          "skipping".format(path))
+            return False
+        if self.include is not None and not self.include.search(path):
+            logging.info("{} not included".format(path))
+            return False
+        if self._excludes(path):
+            logging.info("excluding: {}".format(path))
+            return False
+        return True
+
+    def prunes(self, path):
+        """
+        Determines whether the content of a directory is left out as a whole
+        :param path: path of the directory
+        :return: True if none of the paths under the directory is included
+        """
+        return VALID_PATH.match(path) is None or self._excludes(path)
+
+    def _excludes(self, path):
+        for pattern in self.exclude:
+            if pattern in path:
+                return True
+        return False
+
+
 def validate(path, include=None, exclude=None):
     """
     Determines whether a directory or filename should be included or not
@@ -252,19 +881,7 @@ def validate(path, include=None, exclude=None):
     :param exclude: pattern for names to exclude
     :return: True if filename is to be included, False otherwise
     """
-    if re.match(r'^[A-Za-z0-9._\-();:&*$@!+=/]*$', path) is None:
-        logging.error("filename {} contains illegal characters, "
-                      "skipping".format(path))
-        return False
-    if include is not None and not re.search(include, path):
-        logging.info("{} not included".format(path))
-        return False
-    if exclude:
-        for thisIgnore in exclude.split(','):
-            if not path.find(thisIgnore) < 0:
-                logging.info("excluding: {}".format(path))
-                return False
-    return True
+    return PathFilter(include, exclude).accepts(path)
 
 
 def prepare(src, dest, client):
@@ -287,9 +904,15 @@ def prepare(src, dest, client):
 
     if os.path.isdir(src):
         # make directory but nothing to transfer
+        if global_listing is not None and \
+                global_listing.get(client, dest) is not None:
+            # already listed in its container
+            return
         try:
             client.mkdir(dest)
             logging.info("Made directory {}".format(dest))
+            if global_listing is not None:
+                global_listing.created(dest)
         except transfer_exceptions.AlreadyExistsException:
             # OK, must already have existed, add to list
             pass
@@ -297,6 +920,104 @@ def prepare(src, dest, client):
     return src, dest
 
 
+def execute_upload(src, dest, info, opt):
+    """
+    Creates the VOSpace container of a local directory or transfers a file
+    to VOSpace
+    :param src: local path to directory or file to transfer
+    :param dest: vospace location
+    :param info: FileInfo of the file if known. Files with a FileInfo are
+    not checked before their transfer.
+    :param opt: command line parameters
+    :return: TransferReport()
+    """
+    client = get_client(opt.certfile, opt.token, opt.insecure)
+    if info is not None or prepare(src, dest, client):
+        return execute(src, dest, opt, info)
+    return TransferReport()
+
+
+def plan_upload(src, dest, info, opt):
+    """
+    Decides what the upload of a local directory or file would do without
+    doing it
+    :param src: local path to directory or file to transfer
+    :param dest: vospace location
+    :param info: FileInfo of the file if known
+    :param opt: command line parameters
+    :return: TransferReport() of the planned upload
+    """
+    result = TransferReport()
+    client = get_client(opt.certfile, opt.token, opt.insecure)
+    if info is None and os.path.isdir(src) and not os.path.islink(src):
+        if global_listing is not None and \
+                global_listing.get(client, dest) is None:
+            # the content of a new container does not need listing
+            global_listing.created(dest)
+            result.containers_created = 1
+        return result
+    if info is None and not prepare(src, dest, client):
+        return result
+    stat = file_stat(src, info)
+    if not opt.overwrite and compare(
+            src, dest, stat, client, opt,
+            None if info is None else info.md5)[0] is not None:
+        result.files_skipped = 1
+        result.bytes_skipped = stat.st_size
+    else:
+        result.files_sent = 1
+        result.bytes_sent = stat.st_size
+    return result
+
+
+def plan_summary(report, nstreams, stream_throughput, max_rate=None,
+                 deletions=None):
+    """
+    Summary of a planned sync
+    :param report: TransferReport() of the planned uploads
+    :param nstreams: number of streams of the sync
+    :param stream_throughput: throughput of a stream in bytes/sec, None if
+    unknown
+    :param max_rate: maximum bandwidth of the sync in bytes/sec
+    :param deletions: number of nodes to delete, None if not deleting
+    :return: dictionary of the counts and estimated duration of the sync
+    """
+    throughput = None
+    duration = None
+    if stream_throughput:
+        throughput = stream_throughput * nstreams
+        if max_rate is not None:
+            throughput = min(throughput, max_rate)
+        duration = round(report.bytes_sent / throughput, 1)
+    summary = {
+        'to_upload': {'files': report.files_sent,
+                      'bytes': report.bytes_sent},
+        'to_skip': {'files': report.files_skipped,
+                    'bytes': report.bytes_skipped},
+        'to_mkdir': {'containers': report.containers_created},
+        'errors': report.files_erred,
+        'nstreams': nstreams,
+        'throughput': throughput,
+        'estimated_duration': duration}
+    if deletions is not None:
+        summary['to_delete'] = {'nodes': deletions}
+    return summary
+
+
+def upload_dependencies(transfer):
+    """
+    Dependencies of an upload between the VOSpace containers
+    :param transfer: (src, dest, info) of the upload
+    :return: (container, parent) with container the container created by
+    the upload, None for files, and parent the container of dest
+    """
+    src, dest, info = transfer
+    container = None
+    if info is None and os.path.isdir(src):
+        container = dest
+    return container, dest.rsplit('/', 1)[0]
+
+
 def build_file_list(paths, vos_root, recursive=False, include=None,
                     exclude=None):
     """
@@ -308,51 +1029,1082 @@ def build_file_list(paths, vos_root, recursive=False, include=None,
     :param exclude: comma separated strings to exclude when occuring in names
     :return: set of expanded (src, dest) pairs
     """
+    return list(iter_file_list(paths, vos_root, recursive=recursive,
+                               include=include, exclude=exclude))
+
+
+def iter_file_list(paths, vos_root, recursive=False, include=None,
+                   exclude=None):
+    """
+    Generator of the files that should be copied into VOSpace. The entries
+    are produced while the source trees are being scanned.
+    :param paths: source paths
+    :param vos_root: directory container on vospace service to sync to
+    :param recursive: True if recursive sync, False otherwise
+    :param include: patterns to include
+    :param exclude: comma separated strings to exclude when occuring in names
+    :return: expanded (src, dest) pairs, directories ahead of their content
+    """
+    for src, dest, _ in scan_file_list(paths, vos_root, recursive=recursive,
+                                       include=include, exclude=exclude):
+        yield src, dest
+
+
+def scan_directory(path):
+    """
+    Lists a local directory. The files are stat'ed here, in the scanning
+    thread, and their stat is not looked up again.
+    :param path: local directory
+    :return: list of the (name, is_dir, stat) of the entries sorted by name,
+    stat None for directories, or None if the directory cannot be listed
+    """
+    entries = []
+    try:
+        with os.scandir(path) as directory:
+            for entry in directory:
+                try:
+                    if entry.is_symlink():
+                        logging.error(
+                            "{} is a link, skipping".format(entry.path))
+                    elif entry.is_dir(follow_symlinks=False):
+                        entries.append((entry.name, True, None))
+                    elif entry.is_file(follow_symlinks=False):
+                        entries.append((entry.name, False,
+                                        entry.stat(follow_symlinks=False)))
+                    else:
+                        logging.error(
+                            "{} is not a file, skipping".format(entry.path))
+                except OSError as ex:
+                    # removed while being scanned
+                    logging.debug('{}: {}'.format(entry.path, str(ex)))
+    except OSError as ex:
+        logging.error('Failed to list {}: {}'.format(path, str(ex)))
+        return None
+    entries.sort()
+    return entries
+
+
+def scan_directory_incremental(path, snapshots):
+    """
+    Lists a local directory unless it did not change since its last
+    snapshot, in which case the entries of the snapshot are returned
+    :param path: local directory
+    :param snapshots: DirectorySnapshots of the previous scans
+    :return: list of the (name, is_dir, stat) of the entries sorted by name,
+    stat None for directories, or None if the directory cannot be listed
+    """
+    try:
+        # before listing so that changes made during the listing show
+        # in the next scan
+        dir_stat = os.stat(path)
+    except OSError as ex:
+        logging.error('Failed to list {}: {}'.format(path, str(ex)))
+        return None
+    recorded = snapshots.get(path, dir_stat)
+    if recorded is not None:
+        return [(name, is_dir,
+                 None if is_dir else FileInfo(st_size, st_mtime, None,
+                                              *fingerprint))
+                for name, is_dir, st_size, st_mtime, *fingerprint
+                in recorded]
+    entries = scan_directory(path)
+    if entries is not None:
+        snapshots.update(path, dir_stat, [
+            (name, True) + (None,) * 6 if is_dir else
+            (name, False, stat.st_size, stat.st_mtime, stat.st_dev,
+             stat.st_ino, stat.st_mtime_ns, stat.st_ctime_ns)
+            for name, is_dir, stat in entries])
+    return entries
+
+
+def scan_file_list(paths, vos_root, recursive=False, include=None,
+                   exclude=None, nthreads=SCAN_THREADS, snapshots=None):
+    """
+    Generator of the uploads of the files that should be copied into
+    VOSpace. The directories are listed with os.scandir by a pool of threads
+    while the entries are being consumed and the excluded directories are
+    not scanned.
+    :param paths: source paths
+    :param vos_root: directory container on vospace service to sync to
+    :param recursive: True if recursive sync, False otherwise
+    :param include: patterns to include
+    :param exclude: comma separated strings to exclude when occuring in names
+    :param nthreads: number of scanning threads
+    :param snapshots: DirectorySnapshots to list only the directories that
+    changed since the previous scan, None to list them all
+    :return: (src, dest, info) of the uploads, directories ahead of their
+    content. The FileInfo of the files holds their size, modification time
+    and the fingerprint of their stat.
+    """
+
+    def scan_dir(dir_path):
+        if snapshots is None:
+            return scan_directory(dir_path)
+        return scan_directory_incremental(dir_path, snapshots)
+
+    def unique(entry):
+        # only overlapping source paths can produce duplicates
+        if seen is None:
+            return True
+        if entry[:2] in seen:
+            return False
+        seen.add(entry[:2])
+        return True
+
+    path_filter = PathFilter(include, exclude)
+    seen = set() if len(paths) > 1 else None
+    vos_root = vos_root.strip('/')
+    with concurrent.futures.ThreadPoolExecutor(max_workers=nthreads) \
+            as executor:
+        for path in paths:
+            content = False
+            if path.endswith('/'):
+                # vsync just the content and not the source dir
+                content = True
+                base_path = os.path.abspath(path)
+                path = path[:-1]
+            else:
+                base_path = os.path.dirname(path)
+            path = os.path.abspath(path)
+            rel_path = os.path.relpath(path, base_path)
+            if not os.path.exists(path):
+                raise ValueError('{} not found'.format(path))
+            if not os.path.isdir(path):
+                stat = os.stat(path)
+                entry = (path, '{}/{}'.format(vos_root, rel_path),
+                         file_info(stat))
+                if unique(entry):
+                    yield entry
+                continue
+            if not content:
+                entry = (path, '{}/{}'.format(vos_root, rel_path), None)
+                if unique(entry):
+                    yield entry
+            # the content of a directory is produced after its own entry so
+            # the directories stay ahead of their content
+            to_scan = collections.deque(
+                [(path, '' if rel_path == os.curdir else rel_path)])
+            scans = collections.deque()
+            while to_scan or scans:
+                while to_scan and len(scans) < SCAN_AHEAD:
+                    dir_path, rel_dir = to_scan.popleft()
+                    scans.append((dir_path, rel_dir,
+                                  executor.submit(scan_dir, dir_path)))
+                dir_path, rel_dir, scan = scans.popleft()
+                for name, is_dir, stat in scan.result() or []:
+                    src = os.path.join(dir_path, name)
+                    rel_name = os.path.join(rel_dir, name)
+                    if is_dir:
+                        if not recursive:
+                            continue
+                        if path_filter.accepts(rel_name):
+                            entry = (src, '{}/{}'.format(vos_root, rel_name),
+                                     None)
+                            if unique(entry):
+                                yield entry
+                        elif path_filter.prunes(rel_name):
+                            continue
+                        to_scan.append((src, rel_name))
+                    elif path_filter.accepts(rel_name):
+                        entry = (src, '{}/{}'.format(vos_root, rel_name),
+                                 stat if isinstance(stat, FileInfo) else
+                                 file_info(stat))
+                        if unique(entry):
+                            yield entry
+
+
+def parse_manifest_entry(record):
+    """
+    Parses an entry of a manifest
+    :param record: the entry, as bytes
+    :return: (path, info) with info the FileInfo of the file or None if the
+    entry only has the path. None if the entry is empty.
+    :raises ValueError: if the entry is not valid
+    """
+    columns = os.fsdecode(record).rstrip('\r').split('\t')
+    if not columns[0]:
+        return None
+    if len(columns) == 1:
+        return columns[0], None
+    if len(columns) > 4:
+        raise ValueError('Invalid manifest entry: {}'.format(columns))
+    values = [None if value in ('', '-') else value
+              for value in columns[1:]] + [None] * (4 - len(columns))
+    try:
+        size = None if values[0] is None else int(values[0])
+        mtime = None if values[1] is None else float(values[1])
+    except ValueError:
+        raise ValueError('Invalid manifest entry: {}'.format(columns))
+    md5 = None if values[2] is None else values[2].lower()
+    return columns[0], FileInfo(size, mtime, md5)
+
+
+def read_manifest(stream):
+    """
+    Generator of the entries of a manifest of the files to sync. The
+    entries are separated by NUL characters, or by new lines in manifests
+    without NUL in their first block, and have tab separated columns: the
+    path of the file and optionally its size, modification time and MD5.
+    Empty or '-' columns are unknown.
+    :param stream: binary file object of the manifest
+    :return: (path, info) with info the FileInfo of the file or None if the
+    entry only has the path
+    """
+    separator = None
+    remainder = b''
+    while True:
+        block = stream.read(MANIFEST_BLOCK_SIZE)
+        remainder += block
+        if separator is None:
+            # paths may contain new lines but not NUL
+            if b'\0' in remainder:
+                separator = b'\0'
+            elif b'\n' in remainder:
+                separator = b'\n'
+        if separator is not None:
+            records = remainder.split(separator)
+            remainder = records.pop()
+            for record in records:
+                entry = parse_manifest_entry(record)
+                if entry is not None:
+                    yield entry
+        if not block:
+            break
+    entry = parse_manifest_entry(remainder)
+    if entry is not None:
+        yield entry
 
-    count = 0
-    results = []  # order is important to create the directories first
+
+def read_manifest_file(filename):
+    """
+    Generator of the entries of a manifest file
+    :param filename: name of the manifest file, '-' for the standard input
+    :return: (path, info) entries as returned by read_manifest
+    """
+    if filename == '-':
+        yield from read_manifest(sys.stdin.buffer)
+        return
+    with open(filename, 'rb') as stream:
+        yield from read_manifest(stream)
+
+
+def iter_manifest_list(entries, path, vos_root, include=None, exclude=None):
+    """
+    Generator of the uploads of the files of a manifest. The source
+    directory is not scanned and the files are not checked.
+    :param entries: (path, info) entries of the manifest, with paths
+    relative to the source directory or absolute within it
+    :param path: source directory
+    :param vos_root: directory container on vospace service to sync to
+    :param include: patterns to include
+    :param exclude: comma separated strings to exclude when occuring in names
+    :return: (src, dest, info) of the uploads, containers of the files
+    ahead of them
+    """
     vos_root = vos_root.strip('/')
+    if path.endswith('/'):
+        # vsync just the content and not the source dir
+        base_path = os.path.abspath(path)
+    else:
+        base_path = os.path.dirname(os.path.abspath(path))
+    source = os.path.abspath(path)
+    if not os.path.isdir(source):
+        raise ValueError('{} is not a directory'.format(source))
+    containers = set()
+    files = set()
+    for entry_path, info in entries:
+        src = os.path.normpath(os.path.join(source, entry_path))
+        if os.path.relpath(src, source).split(os.sep)[0] in \
+                (os.curdir, os.pardir):
+            logging.error('{} is not in {}, skipping'.format(src, source))
+            continue
+        rel_name = os.path.relpath(src, base_path)
+        if (include or exclude) and \
+                not validate(rel_name, include=include, exclude=exclude):
+            continue
+        parents = []
+        parent = os.path.dirname(rel_name)
+        while parent and parent not in containers:
+            containers.add(parent)
+            parents.append(parent)
+            parent = os.path.dirname(parent)
+        for parent in reversed(parents):
+            yield (os.path.join(base_path, parent),
+                   '{}/{}'.format(vos_root, parent), None)
+        if rel_name in containers or rel_name in files:
+            # repeated, or a directory listed after its content as in the
+            # output of find -depth
+            continue
+        if info is None:
+            # might be a directory
+            containers.add(rel_name)
+        else:
+            files.add(rel_name)
+        yield src, '{}/{}'.format(vos_root, rel_name), info
+
+
+def iter_local_containers(paths, vos_root, recursive=False):
+    """
+    Generator of the destination containers of the scanned source
+    directories. The containers that several source paths go into are
+    produced once, with the entries of all of them.
+    :param paths: source paths
+    :param vos_root: directory container on vospace service to sync to
+    :param recursive: True if recursive sync, False otherwise
+    :return: (container, rel_dir, names) with rel_dir the path of the
+    directory relative to vos_root and names the set of its entries
+    """
+
+    def scan():
+        for path in paths:
+            if path.endswith('/'):
+                base_path = os.path.abspath(path)
+                path = path[:-1]
+            else:
+                base_path = os.path.dirname(path)
+            path = os.path.abspath(path)
+            if not os.path.isdir(path):
+                continue
+            for (root, dirs, filenames) in os.walk(path):
+                rel_dir = os.path.relpath(root, base_path)
+                if rel_dir == '.':
+                    container = vos_root
+                else:
+                    container = '{}/{}'.format(vos_root, rel_dir)
+                yield container, rel_dir, set(dirs).union(filenames)
+                if not recursive:
+                    break
+
+    vos_root = vos_root.strip('/')
+    if len(paths) == 1:
+        yield from scan()
+        return
+    # only overlapping source paths need merging
+    containers = {}
+    for container, rel_dir, names in scan():
+        if container in containers:
+            containers[container][1].update(names)
+        else:
+            containers[container] = (rel_dir, names)
+    for container, (rel_dir, names) in containers.items():
+        yield container, rel_dir, names
+
+
+def iter_remote_deletions(client, paths, vos_root, recursive=False,
+                          include=None, exclude=None):
+    """
+    Generator of the destination nodes that no longer have a source. Each
+    scanned directory is compared with the listing of its container in
+    global_listing. Nodes excluded from the sync are left alone.
+    :param client: vos client to list the containers with
+    :param paths: source paths
+    :param vos_root: directory container on vospace service to sync to
+    :param recursive: True if recursive sync, False otherwise
+    :param include: patterns to include
+    :param exclude: comma separated strings to exclude when occuring in names
+    :return: (uri, is_container) of the nodes to delete. Containers are
+    deleted with their content.
+    """
+    for container, rel_dir, names in iter_local_containers(
+            paths, vos_root, recursive):
+        children = global_listing.children(client, container)
+        # each container is compared once
+        global_listing.forget(container)
+        for name in sorted(children):
+            if name in names:
+                continue
+            rel_name = os.path.normpath(os.path.join(rel_dir, name))
+            if not validate(rel_name, include=include, exclude=exclude):
+                continue
+            yield '{}/{}'.format(container, name), children[name]
+
+
+def execute_delete(uri, is_container, opt):
+    """
+    Deletes a destination node that no longer has a source
+    :param uri: vospace location of the node
+    :param is_container: True to delete the node with its content
+    :param opt: command line parameters
+    :return: TransferReport() of the deletion
+    """
+    result = TransferReport()
+    client = get_client(opt.certfile, opt.token, opt.insecure)
+    if is_container:
+        logging.info('Deleting {} and its content'.format(uri))
+        successes, failures = client.recursive_delete(uri)
+        result.files_deleted = successes
+        result.files_erred = failures
+    else:
+        logging.info('Deleting {}'.format(uri))
+        client.delete(uri)
+        result.files_deleted = 1
+    return result
+
+
+def prepare_download(src, dest, node):
+    """
+    If node is a container it creates the corresponding local directory
+    otherwise prepares the transfer of the data node
+    :param src: VOSpace location of the node
+    :param dest: local destination
+    :param node: the node to transfer
+    :return: (src, dest, node) tuple to be sync if required or None otherwise
+    """
+    if node.isdir():
+        if not os.path.isdir(dest):
+            os.makedirs(dest)
+            logging.info("Made directory {}".format(dest))
+        return
+    return src, dest, node
+
+
+def build_remote_file_list(client, paths, local_root, recursive=False,
+                           include=None, exclude=None):
+    """
+    Build a list of the nodes that should be copied from VOSpace
+    :param client: vos client to list the containers with
+    :param paths: VOSpace source paths
+    :param local_root: local directory to sync to
+    :param recursive: True if recursive sync, False otherwise
+    :param include: patterns to include
+    :param exclude: comma separated strings to exclude when occuring in names
+    :return: list of (src, dest, node) with containers ahead of their content
+    """
+    return list(iter_remote_file_list(client, paths, local_root,
+                                      recursive=recursive, include=include,
+                                      exclude=exclude))
+
+
+def iter_remote_file_list(client, paths, local_root, recursive=False,
+                          include=None, exclude=None):
+    """
+    Generator of the nodes that should be copied from VOSpace. The entries
+    are produced while the containers are being listed.
+    :param client: vos client to list the containers with
+    :param paths: VOSpace source paths
+    :param local_root: local directory to sync to
+    :param recursive: True if recursive sync, False otherwise
+    :param include: patterns to include
+    :param exclude: comma separated strings to exclude when occuring in names
+    :return: (src, dest, node) tuples with containers ahead of their content
+    """
     for path in paths:
-        content = False
+        node = client.get_node(path, limit=0, force=True)
+        if node.islink():
+            logging.error("{} is a link, skipping".format(path))
+            continue
+        if not node.isdir():
+            yield node.uri, os.path.join(local_root, node.name), node
+            continue
         if path.endswith('/'):
-            # vsync just the content and not the source dir
-            content = True
-            base_path = os.path.abspath(path)
-            path = path[:-1]
+            # vsync just the content and not the source container
+            rel_path = ''
         else:
-            base_path = os.path.dirname(path)
-        path = os.path.abspath(path)
-        rel_path = os.path.relpath(path, base_path)
-        if not os.path.exists(path):
-            raise ValueError('{} not found'.format(path))
-        if os.path.isfile(path):
-            results.append((path, '{}/{}'.format(vos_root, rel_path)))
-            continue
-        elif not content:
-            results.append((path, '{}/{}'.format(vos_root, rel_path)))
-        for (root, dirs, filenames) in os.walk(path):
-            if recursive:
-                for this_dirname in dirs:
-                    this_dirname = os.path.join(root, this_dirname)
-                    rel_dirname = os.path.relpath(this_dirname, base_path)
-                    if not validate(rel_dirname, include=include,
-                                    exclude=exclude):
-                        continue
-                    results.append((this_dirname, '{}/{}'.format(
-                        vos_root, rel_dirname)))
-            for this_filename in filenames:
-                srcfilename = os.path.normpath(os.path.join(root,
-                                                            this_filename))
-                rel_name = os.path.relpath(srcfilename, base_path)
+            rel_path = node.name
+            yield node.uri, os.path.join(local_root, rel_path), node
+        containers = [(node.uri, rel_path)]
+        while containers:
+            uri, rel_path = containers.pop()
+            for child in client.get_children_info(uri, force=True):
+                rel_name = os.path.join(rel_path, child.name)
                 if not validate(rel_name, include=include, exclude=exclude):
                     continue
-                count += 1
-                results.append((srcfilename, '{}/{}'.format(
-                    vos_root, rel_name)))
-            if not recursive:
-                break
-    # remove duplicates while maintaining the order
-    return list(dict.fromkeys(results))
+                if child.islink():
+                    logging.error("{} is a link, skipping".format(child.uri))
+                elif child.isdir():
+                    if recursive:
+                        yield (child.uri, os.path.join(local_root, rel_name),
+                               child)
+                        containers.append((child.uri, rel_name))
+                else:
+                    yield (child.uri, os.path.join(local_root, rel_name),
+                           child)
+
+
+def journal_job(client, opt):
+    """
+    Identifier of a sync job in the transfer journal
+    :param client: vos client used to tell VOSpace and local paths apart
+    :param opt: command line parameters
+    :return: job identifier
+    """
+    def normalize(path):
+        if client.is_remote_file(path):
+            return path
+        # keep the trailing '/' that tells to sync the content of a directory
+        return os.path.abspath(path) + ('/' if path.endswith('/') else '')
+
+    return json.dumps([[normalize(path) for path in opt.files],
+                       normalize(opt.destination)])
+
+
+def parse_shard(shard):
+    """
+    Parses the shard of a sync
+    :param shard: shard as 'i/N', i from 1 to N
+    :return: (i, N) tuple
+    :raises ValueError: if the shard is not valid
+    """
+    try:
+        index, count = [int(value) for value in shard.split('/')]
+    except ValueError:
+        raise ValueError('Invalid shard {}, expected i/N'.format(shard))
+    if not 1 <= index <= count:
+        raise ValueError(
+            'Invalid shard {}, expected 1 <= i <= N'.format(shard))
+    return index, count
+
+
+def in_shard(uri, vos_root, shard):
+    """
+    Tells whether a node belongs to a shard. The nodes are partitioned by a
+    hash of their path relative to the sync destination so that every host
+    computes the same partition.
+    :param uri: vospace location of the node
+    :param vos_root: directory container on vospace service to sync to
+    :param shard: (i, N) tuple
+    :return: True if the node belongs to the shard, False otherwise
+    """
+    rel_path = uri[len(vos_root.strip('/')):].strip('/')
+    index, count = shard
+    return zlib.crc32(rel_path.encode('utf-8')) % count == index - 1
+
+
+def shard_transfers(transfers, vos_root, shard):
+    """
+    Filters the uploads of a shard. The directories of other shards are
+    left to their shard unless they are needed by the transfers of this
+    shard, in which case they are created, if they do not exist yet, ahead
+    of the first of them.
+    :param transfers: (src, dest, info) of all the uploads
+    :param vos_root: directory container on vospace service to sync to
+    :param shard: (i, N) tuple
+    :return: the (src, dest, info) of the uploads of the shard
+    """
+    vos_root = vos_root.strip('/')
+    # directories of the other shards not needed yet
+    pending = {}
+    for transfer in transfers:
+        dest = transfer[1]
+        if not in_shard(dest, vos_root, shard):
+            if upload_dependencies(transfer)[0] is not None:
+                pending[dest] = transfer
+            continue
+        ancestors = []
+        parent = dest.rsplit('/', 1)[0]
+        while len(parent) > len(vos_root):
+            if parent in pending:
+                ancestors.append(pending.pop(parent))
+            parent = parent.rsplit('/', 1)[0]
+        yield from reversed(ancestors)
+        yield transfer
+
+
+def shard_report(journal_dir, job):
+    """
+    Merges the journals of the shards of a sync
+    :param journal_dir: directory of the shard journals
+    :param job: identifier of the job
+    :return: dictionary of the state of each shard and of the whole sync
+    """
+    shards = {}
+    counts = set()
+    for filename in sorted(os.listdir(journal_dir)):
+        match = SHARD_JOURNAL_PATTERN.match(filename)
+        if match is None:
+            continue
+        journal = transfer_journal.TransferJournal(
+            os.path.join(journal_dir, filename))
+        try:
+            summary = journal.summary(job)
+        finally:
+            journal.close()
+        if summary is not None:
+            shards[int(match.group(1))] = summary
+            counts.add(int(match.group(2)))
+    if not counts:
+        raise RuntimeError(
+            'No shard journal of this sync in {}'.format(journal_dir))
+    if len(counts) > 1:
+        raise RuntimeError(
+            'Shard journals of this sync for {} shards in {}'.format(
+                ' and '.join(str(count) for count in sorted(counts)),
+                journal_dir))
+    count = counts.pop()
+    states = [transfer_journal.PLANNED, transfer_journal.IN_FLIGHT,
+              transfer_journal.DONE, transfer_journal.FAILED]
+    totals = {state: sum(summary[state] for summary in shards.values())
+              for state in states}
+    missing = [index for index in range(1, count + 1)
+               if index not in shards]
+    unfinished = [index for index, summary in sorted(shards.items())
+                  if not summary['scanned'] or
+                  summary[transfer_journal.PLANNED] or
+                  summary[transfer_journal.IN_FLIGHT]]
+    return {'shards': count,
+            'missing': missing,
+            'unfinished': unfinished,
+            'complete': not (missing or unfinished or
+                             totals[transfer_journal.FAILED]),
+            'totals': totals,
+            'per_shard': {'{}/{}'.format(index, count): summary
+                          for index, summary in sorted(shards.items())}}
+
+
+def plan_transfers(transfers, journal, job):
+    """
+    Records the transfers in the journal as they are scanned. Transfers
+    already done by a previous run of the job are skipped.
+    :param transfers: iterable of the transfers of the job
+    :param journal: transfer journal
+    :param job: identifier of the job
+    :return: the transfers left to do
+    """
+    for transfer in transfers:
+        if journal.plan(job, transfer[0], transfer[1]) != \
+                transfer_journal.DONE:
+            yield transfer
+    journal.set_scanned(job)
+
+
+def hash_transfers(transfers, opt):
+    """
+    Stage of the uploads starting the hash of the files in the hashing
+    engine as they are taken from the scan so that the hashes are ready by
+    the time the upload workers compare the files with their destination.
+    Files that do not need a hash, because their MD5 is cached or their
+    destination node is missing or of a different size, are not hashed.
+    The containers of the destination are listed here when required, ahead
+    of the upload workers that look them up next.
+    :param transfers: iterable of the (src, dest, info) of the uploads
+    :param opt: command line parameters
+    :return: iterable of the same uploads
+    """
+    if global_hash_engine is None or opt.overwrite or opt.ignore_checksum:
+        yield from transfers
+        return
+    for transfer in transfers:
+        src, dest, info = transfer
+        if info is not None and info.md5 is None and \
+                info.st_size is not None:
+            needed = True
+            if global_md5_cache is not None:
+                global_md5_cache.prefetch(os.path.dirname(src))
+                cached = global_md5_cache.get(src)
+                # the fingerprint is checked by the upload worker
+                needed = cached is None or \
+                    (cached[1], cached[2]) != (info.st_size, info.st_mtime)
+            if needed and global_listing is not None:
+                node_info = global_listing.get(
+                    get_client(opt.certfile, opt.token, opt.insecure), dest)
+                needed = node_info is not None and \
+                    node_info[1] == info.st_size
+            if needed:
+                global_hash_engine.prefetch(src)
+        yield transfer
+
+
+def journal_transfers(worker, journal, job):
+    """
+    Wraps a worker so that it records the progress of its transfers in the
+    journal
+    :param worker: function performing a transfer and returning a
+    TransferReport
+    :param journal: transfer journal
+    :param job: identifier of the job
+    :return: the wrapped worker
+    """
+    def journaled_worker(src, dest, *args):
+        journal.update(job, src, dest, transfer_journal.IN_FLIGHT)
+        try:
+            result = worker(src, dest, *args)
+        except Exception:
+            journal.update(job, src, dest, transfer_journal.FAILED)
+            raise
+        journal.update(job, src, dest, transfer_journal.FAILED
+                       if result.files_erred else transfer_journal.DONE)
+        return result
+    return journaled_worker
+
+
+def adapt_transfers(worker, controller):
+    """
+    Wraps a worker so that the number of transfers running at once is set
+    by the adaptive concurrency controller
+    :param worker: function performing a transfer and returning a
+    TransferReport
+    :param controller: AdaptiveConcurrency instance
+    :return: the wrapped worker
+    """
+    def adapted_worker(*args):
+        controller.acquire()
+        nbytes = 0
+        try:
+            result = worker(*args)
+            nbytes = result.bytes_sent
+            return result
+        finally:
+            controller.release(nbytes)
+    return adapted_worker
+
+
+class WatchedSources(object):
+    """
+    The source directories of a sync watched for changes and the uploads of
+    their changed files
+    """
+    def __init__(self, paths, vos_root, include=None, exclude=None):
+        """
+        :param paths: source paths, only the directories are watched
+        :param vos_root: directory container on vospace service to sync to
+        :param include: patterns to include
+        :param exclude: comma separated strings to exclude when occuring in
+        names
+        """
+        self.vos_root = vos_root.strip('/')
+        self.path_filter = PathFilter(include, exclude)
+        # (root, base_path) of the directories
+        self.sources = []
+        for path in paths:
+            if path.endswith('/'):
+                # the content and not the source dir
+                root = os.path.abspath(path)
+                base_path = root
+            else:
+                root = os.path.abspath(path)
+                base_path = os.path.dirname(root)
+            if os.path.isdir(root):
+                self.sources.append((root, base_path))
+        # destination containers known to exist
+        self._containers = set()
+
+    @property
+    def roots(self):
+        return [root for root, _ in self.sources]
+
+    def prunes(self, path):
+        """
+        :param path: local directory
+        :return: True if the directory is left out of the sync with its
+        content
+        """
+        base_path = self._base_path(path)
+        return base_path is None or \
+            self.path_filter.prunes(os.path.relpath(path, base_path))
+
+    def uploads(self, path):
+        """
+        Uploads of a changed file or directory
+        :param path: local path of the file or directory
+        :return: list of the (src, dest, info) of the uploads, with the
+        containers not known to exist ahead of the file
+        """
+        base_path = self._base_path(path)
+        if base_path is None or path == base_path:
+            return []
+        rel_path = os.path.relpath(path, base_path)
+        if not os.path.lexists(path) or \
+                not self.path_filter.accepts(rel_path):
+            return []
+        parts = rel_path.split(os.sep)
+        is_container = os.path.isdir(path) and not os.path.islink(path)
+        uploads = []
+        for index in range(1, len(parts) + 1):
+            rel_dir = os.path.join(*parts[:index])
+            dest = '{}/{}'.format(self.vos_root, rel_dir)
+            if index < len(parts) or is_container:
+                if dest in self._containers:
+                    continue
+                self._containers.add(dest)
+                uploads.append((os.path.join(base_path, rel_dir), dest, None))
+            else:
+                uploads.append((path, dest, None))
+        return uploads
+
+    def _base_path(self, path):
+        for root, base_path in self.sources:
+            if path == root or path.startswith(root + os.sep):
+                return base_path
+        return None
+
+
+def watch_uploads(watcher, sources, settle=WATCH_SETTLE, stop=None):
+    """
+    Generator of the uploads of the files that change in the watched source
+    directories. A file is uploaded once it has not changed for settle
+    seconds so that the files being written are uploaded once complete.
+    :param watcher: watch.InotifyWatcher or watch.PollingWatcher of the
+    source directories
+    :param sources: WatchedSources
+    :param settle: seconds a file must stay unchanged before its upload
+    :param stop: threading.Event that stops the watch, None to watch until
+    interrupted
+    :return: lists of (src, dest, info) uploads, containers ahead of their
+    content, or None when changes were lost and all the files need a sync
+    """
+    debouncer = watch.Debouncer(settle)
+    while stop is None or not stop.is_set():
+        next_ready = debouncer.next_ready()
+        timeout = WATCH_TIMEOUT
+        if next_ready is not None:
+            timeout = min(timeout, max(0, next_ready - time.monotonic()))
+        changed, lost = watcher.changes(timeout)
+        if lost:
+            yield None
+        debouncer.add(changed)
+        uploads = []
+        for path in debouncer.ready():
+            uploads.extend(sources.uploads(path))
+        if uploads:
+            yield uploads
+
+
+def sync_changes(watcher, sources, opt, shard=None):
+    """
+    Uploads the changes of the watched source directories as they settle
+    until interrupted
+    :param watcher: watch.InotifyWatcher or watch.PollingWatcher of the
+    source directories
+    :param sources: WatchedSources
+    :param opt: command line options. The changed files are uploaded
+    regardless of their copy on the server
+    :param shard: (i, N) shard of the files to sync, None for all
+    """
+    settle = WATCH_SETTLE
+    if isinstance(watcher, watch.PollingWatcher):
+        settle = max(settle, watcher.interval)
+    watch_opt = copy.copy(opt)
+    watch_opt.overwrite = True
+    logging.info("Watching {} for changes".format(', '.join(sources.roots)))
+    for uploads in watch_uploads(watcher, sources, settle=settle):
+        if uploads is None:
+            # the changes are not known, compare all the files again
+            logging.warning("Changes were lost, syncing all the files")
+            global global_listing
+            global_listing = RemoteListing()
+            uploads = scan_file_list(paths=opt.files,
+                                     vos_root=opt.destination,
+                                     recursive=opt.recursive,
+                                     include=opt.include,
+                                     exclude=opt.exclude)
+            worker_opt = opt
+        else:
+            worker_opt = watch_opt
+        if shard is not None:
+            uploads = shard_transfers(uploads, opt.destination, shard)
+        worker = execute_upload
+        if global_listing is not None:
+            uploads = global_listing.retain(uploads)
+            worker = global_listing.track(worker)
+        result = run_transfers(uploads, worker, worker_opt,
+                               dependencies=upload_dependencies)
+        logging.info("Sent {} files ({} bytes), {} errors".format(
+            result.files_sent, result.bytes_sent, result.files_erred))
+
+
+def transfer_all(transfers, worker, opt, journal, job, sizer,
+                 dependencies=None):
+    """
+    Runs the transfers recording them in the journal, with the concurrency
+    and the order set on the command line
+    :param transfers: iterable of the arguments of the worker
+    :param worker: function performing a transfer and returning a
+    TransferReport
+    :param opt: command line parameters
+    :param journal: transfer journal
+    :param job: identifier of the job
+    :param sizer: function returning the size of a transfer
+    :param dependencies: function returning the (container, parent) of a
+    transfer or None if the transfers are independent
+    :return: TransferReport() of all the transfers
+    """
+    worker = journal_transfers(worker, journal, job)
+    if global_controller is not None:
+        worker = adapt_transfers(worker, global_controller)
+    max_queued = None
+    if opt.schedule:
+        scheduler = SizeScheduler(opt.schedule, opt.nstreams, sizer)
+        transfers = scheduler.schedule(transfers)
+        worker = scheduler.track(worker)
+        # the next transfer is picked when a stream becomes available
+        max_queued = 0
+    return run_transfers(transfers, worker, opt, max_queued=max_queued,
+                         dependencies=dependencies)
+
+
+def run_process(transfers, results, worker, opt, journal_db, job, sizer):
+    """
+    Entry point of a transfer process: runs the transfers received from the
+    main process with its own threads and vos clients
+    :param transfers: queue of the arguments of the worker, None at the end
+    :param results: queue to put the TransferReport of the process into
+    :param worker: function performing a transfer and returning a
+    TransferReport
+    :param opt: command line parameters
+    :param journal_db: path of the transfer journal
+    :param job: identifier of the job
+    :param sizer: function returning the size of a transfer
+    """
+    global global_md5_cache, global_controller
+    set_logging_level_from_args(opt)
+    if opt.cache_nodes:
+        global_md5_cache = md5_cache.MD5Cache(cache_db=opt.cache_filename,
+                                              sample=opt.sample_check)
+    if opt.adaptive:
+        global_controller = AdaptiveConcurrency(opt.nstreams)
+    if opt.max_rate is not None:
+        # the processes share the bandwidth
+        rate_limit.set_max_rate(opt.max_rate / opt.processes)
+    journal = transfer_journal.TransferJournal(journal_db)
+    try:
+        results.put(transfer_all(iter(transfers.get, None), worker, opt,
+                                 journal, job, sizer))
+    finally:
+        journal.close()
+        if global_md5_cache is not None:
+            global_md5_cache.close()
+
+
+class TransferProcesses(object):
+    """
+    Pool of processes sharing the transfers passed on by the main process.
+    Each process runs opt.nstreams threads, so the Python work of the
+    transfers is not serialized by a single interpreter.
+    """
+    def __init__(self, nprocesses, worker, opt, journal_db, job, sizer):
+        """
+        :param nprocesses: number of processes
+        :param worker: function performing a transfer and returning a
+        TransferReport. It must be importable by the processes.
+        :param opt: command line parameters
+        :param journal_db: path of the transfer journal
+        :param job: identifier of the job
+        :param sizer: function returning the size of a transfer
+        """
+        # processes started from scratch do not inherit the connections
+        # of the main process
+        context = multiprocessing.get_context('spawn')
+        self._transfers = context.Queue(
+            nprocesses * opt.nstreams * QUEUED_TRANSFERS_PER_STREAM)
+        self._results = context.Queue()
+        self._processes = [
+            context.Process(target=run_process,
+                            args=(self._transfers, self._results, worker,
+                                  opt, journal_db, job, sizer),
+                            daemon=True)
+            for _ in range(nprocesses)]
+        for process in self._processes:
+            process.start()
+
+    def put(self, transfer):
+        """
+        Passes a transfer on to the processes, waiting while they are busy
+        :param transfer: arguments of the worker
+        """
+        while True:
+            try:
+                self._transfers.put(transfer, timeout=1)
+                return
+            except queue.Full:
+                self._check()
+
+    def join(self):
+        """
+        Waits for the transfers to complete
+        :return: TransferReport() of the transfers of all the processes
+        """
+        for _ in self._processes:
+            self.put(None)
+        result = TransferReport()
+        for _ in self._processes:
+            while True:
+                try:
+                    result += self._results.get(timeout=1)
+                    break
+                except queue.Empty:
+                    self._check()
+        for process in self._processes:
+            process.join()
+        return result
+
+    def _check(self):
+        for process in self._processes:
+            if process.exitcode:
+                raise RuntimeError(
+                    'Transfer process {} failed with exit code {}'.format(
+                        process.pid, process.exitcode))
+
+
+def check_upload(src, dest, info, opt):
+    """
+    Creates the VOSpace container of a local directory or checks whether a
+    file needs to be uploaded
+    :param src: local path to directory or file to transfer
+    :param dest: vospace location
+    :param info: FileInfo of the file if known
+    :param opt: command line parameters
+    :return: (result, transfer) with result the TransferReport() if there
+    is nothing to upload, None otherwise, and transfer the (src, dest, info)
+    of the upload, info including the MD5 of the file if computed
+    """
+    client = get_client(opt.certfile, opt.token, opt.insecure)
+    if info is None and not prepare(src, dest, client):
+        return TransferReport(), None
+    if not opt.overwrite:
+        stat = file_stat(src, info)
+        dest_length, src_md5 = compare(src, dest, stat, client, opt,
+                                       None if info is None else info.md5)
+        if dest_length is not None:
+            logging.info('skipping: {}  matches {}'.format(src, dest))
+            result = TransferReport()
+            result.files_skipped = 1
+            result.bytes_skipped = dest_length
+            return result, None
+        if src_md5 is None:
+            if global_hash_engine is not None:
+                # hashed ahead of time but not needed for the comparison
+                global_hash_engine.discard(src)
+        elif info is None:
+            info = file_info(stat, src_md5)
+        else:
+            # the process uploading the file does not hash it again
+            info = info._replace(md5=src_md5)
+    return None, (src, dest, info)
+
+
+def dispatch_transfers(processes, check=None, journal=None, job=None):
+    """
+    Worker of the main process that passes the transfers on to the
+    transfer processes
+    :param processes: TransferProcesses
+    :param check: function returning (result, transfer) with result the
+    TransferReport of a transfer that does not need to be passed on, None
+    otherwise, and transfer the arguments to pass on
+    :param journal: transfer journal to record the transfers completed by
+    check in, None to not record them. The processes record the others.
+    :param job: identifier of the job
+    :return: the worker
+    """
+    def dispatcher(*args):
+        transfer = args[:-1]
+        if check is not None:
+            try:
+                result, transfer = check(*args)
+            except Exception:
+                if journal is not None:
+                    journal.update(job, args[0], args[1],
+                                   transfer_journal.FAILED)
+                raise
+            if result is not None:
+                if journal is not None:
+                    journal.update(job, args[0], args[1],
+                                   transfer_journal.FAILED
+                                   if result.files_erred
+                                   else transfer_journal.DONE)
+                return result
+        processes.put(transfer)
+        return TransferReport()
+    return dispatcher
 
 
 def vsync():
@@ -367,19 +2119,48 @@ def vsync():
 
     start_time = time.time()
     parser = CommonParser(description=DESCRIPTION)
-    parser.add_option('files', nargs='+', help='Files to copy to VOSpace')
-    parser.add_option('destination', help='VOSpace location to sync files to')
+    parser.add_option('files', nargs='+',
+                      help='Files to copy to VOSpace or VOSpace nodes to '
+                           'copy from')
+    parser.add_option('destination',
+                      help='VOSpace location or local directory to sync '
+                           'files to')
     parser.add_option('--ignore-checksum', action="store_true",
                       help='dont check MD5 sum, use size and time instead')
+    parser.add_option('--hash-threads', type=int,
+                      help="Number of threads hashing the local files",
+                      default=md5_cache.HASH_THREADS)
+    parser.add_option('--hash-processes', type=int,
+                      help=("Number of processes hashing the local files "
+                            "instead of threads, faster for many small "
+                            "files. Default: hash in threads"),
+                      default=0)
     parser.add_option('--cache_nodes', action='store_true',
                       help='cache node MD5 sum in an sqllite db')
+    parser.add_option(
+        '--sample-check', action='store_true',
+        help=("with --cache_nodes, also compare a checksum of the start and "
+              "the end of the files to notice the rewrites that keep their "
+              "size and times"))
     parser.add_option('--cache_filename',
                       help="Name of file to use for node cache",
                       default="{}/.config/vos/node_cache.db".format(HOME))
     parser.add_option('--recursive', '-r', help="Do a recursive sync",
                       action="store_true")
+    parser.add_option(
+        '--incremental', action='store_true',
+        help=("record the content of the local directories, with the stat "
+              "of their files, in the cache db and only list again the "
+              "directories that changed since the previous sync. The files "
+              "of the other directories are not stat'ed again: files "
+              "modified in place, without changing their directory, are "
+              "not noticed"))
     parser.add_option('--nstreams', '-n', type=int,
                       help="Number of streams to run (MAX: 30)", default=5)
+    parser.add_option('--processes', '-p', type=int,
+                      help=("Number of processes to share the transfers, "
+                            "each running --nstreams streams"),
+                      default=1)
     parser.add_option(
         '--exclude',
         help="ignore directories or files containing this pattern",
@@ -387,11 +2168,84 @@ def vsync():
     parser.add_option('--include',
                       help="only include files matching this pattern",
                       default=None)
+    parser.add_option(
+        '--verify',
+        help=("get each uploaded node from VOSpace to check its MD5 and size "
+              "against the transferred file"),
+        action="store_true")
     parser.add_option(
         '--overwrite',
         help=("overwrite copy on server regardless of modification/size/md5 "
               "checks"),
         action="store_true")
+    parser.add_option(
+        '--delete',
+        help=("delete the VOSpace nodes that are not in the local copy. "
+              "Nodes matching --exclude or not matching --include are kept"),
+        action="store_true")
+    parser.add_option(
+        '--dry-run',
+        help=("print the nodes that --delete would delete without "
+              "transferring or deleting anything"),
+        action="store_true")
+    parser.add_option(
+        '--plan',
+        help=("compare the local copy with VOSpace without transferring "
+              "anything and print the number of files and bytes to upload, "
+              "skip and create along with the estimated duration, as JSON"),
+        action="store_true")
+    parser.add_option(
+        '--max-rate', type=int,
+        help="maximum bandwidth of all the streams together in bytes/sec",
+        default=None)
+    parser.add_option(
+        '--adaptive', action='store_true',
+        help=("adjust the number of streams to the load of the service, up "
+              "to --nstreams"))
+    parser.add_option(
+        '--schedule', choices=SCHEDULES,
+        help=("order of the file transfers: largest-first, smallest-first or "
+              "balanced (large files get dedicated streams while the other "
+              "streams transfer the small files). Default: scan order"),
+        default=None)
+    parser.add_option(
+        '--from-manifest', metavar='FILE|-',
+        help=("sync the files listed in FILE, or on the standard input with "
+              "'-', instead of scanning the source directory. The entries "
+              "are separated by new lines or NUL characters and have tab "
+              "separated columns: the path relative to the source directory "
+              "and optionally the size, modification time and MD5 of the "
+              "file"),
+        default=None)
+    parser.add_option(
+        '--shard',
+        help=("sync only the shard i of N (i from 1 to N) of the files, for "
+              "hosts sharing the sync of a tree"),
+        default=None)
+    parser.add_option(
+        '--shard-report',
+        help=("merge the journals of the shards of the sync and print the "
+              "state of the sync as JSON"),
+        action="store_true")
+    parser.add_option(
+        '--journal-dir',
+        help=("directory of the transfer journal, shared by the hosts of a "
+              "sharded sync. Default: the directory of --cache_filename"),
+        default=None)
+    parser.add_option(
+        '--watch',
+        help=("keep running after the sync and upload the files that "
+              "change in the source directories"),
+        action="store_true")
+    parser.add_option(
+        '--resume',
+        help=("continue an interrupted sync with the transfers that did not "
+              "complete"),
+        action="store_true")
+    parser.add_option(
+        '--retry-failed',
+        help="repeat only the transfers that failed in the previous sync",
+        action="store_true")
 
     opt = parser.parse_args()
     set_logging_level_from_args(opt)
@@ -399,65 +2253,291 @@ def vsync():
     if opt.nstreams > 30:
         parser.error("Maximum of 30 streams exceeded")
 
+    if opt.processes < 1:
+        parser.error("--processes must be at least 1")
+
+    if opt.hash_threads < 1 or opt.hash_processes < 0:
+        parser.error("--hash-threads must be at least 1 and "
+                     "--hash-processes at least 0")
+
+    if opt.from_manifest is not None and len(opt.files) > 1:
+        parser.error("--from-manifest requires a single source directory")
+
+    if opt.from_manifest is not None and opt.incremental:
+        parser.error("--from-manifest and --incremental are mutually "
+                     "exclusive")
+
+    shard = None
+    if opt.shard is not None:
+        try:
+            shard = parse_shard(opt.shard)
+        except ValueError as ex:
+            parser.error(str(ex))
+
+    if opt.resume and opt.retry_failed:
+        parser.error("--resume and --retry-failed are mutually exclusive")
+
+    if opt.dry_run and not opt.delete:
+        parser.error("--dry-run requires --delete")
+
+    if opt.plan and opt.dry_run:
+        parser.error("--plan and --dry-run are mutually exclusive")
+
+    if opt.watch and (opt.plan or opt.dry_run or
+                      opt.from_manifest is not None):
+        parser.error("--watch cannot be used with --plan, --dry-run or "
+                     "--from-manifest")
+
+    if opt.max_rate is not None:
+        if opt.max_rate <= 0:
+            parser.error("--max-rate must be a positive number of bytes/sec")
+        if opt.processes == 1:
+            rate_limit.set_max_rate(opt.max_rate)
+            rate_limit.start_rate_log()
+
     if opt.cache_nodes:
         global global_md5_cache
-        global_md5_cache = md5_cache.MD5Cache(cache_db=opt.cache_filename)
+        global_md5_cache = md5_cache.MD5Cache(cache_db=opt.cache_filename,
+                                              sample=opt.sample_check)
+
+    if not opt.ignore_checksum:
+        global global_hash_engine
+        global_hash_engine = md5_cache.HashEngine(
+            nthreads=opt.hash_threads, nprocesses=opt.hash_processes)
+
+    if opt.adaptive and opt.processes == 1:
+        global global_controller
+        global_controller = AdaptiveConcurrency(opt.nstreams)
 
     destination = opt.destination
+    watcher = None
     try:
         client = vos.Client(
             vospace_certfile=opt.certfile, vospace_token=opt.token,
             insecure=opt.insecure)
-        if not client.is_remote_file(destination):
-            parser.error("Only allows sync FROM local copy TO VOSpace")
-        # Currently we don't create nodes in sync and we don't sync onto files
-        logging.info("Connecting to VOSpace")
-        logging.info("Confirming Destination is a directory")
-        if client.isfile(destination):
-            if len(opt.files) == 1:
-                if os.path.isfile(opt.files):
-                    files = [(opt.files, destination)]
+        journal_dir = opt.journal_dir or \
+            os.path.dirname(os.path.abspath(opt.cache_filename))
+        job = journal_job(client, opt)
+        if opt.shard_report:
+            print(json.dumps(shard_report(journal_dir, job), indent=2))
+            return
+        if not os.path.isdir(journal_dir):
+            os.makedirs(journal_dir)
+        if shard is None:
+            journal_db = os.path.join(journal_dir, JOURNAL_FILENAME)
+        else:
+            # each host writes its own journal
+            journal_db = os.path.join(
+                journal_dir, SHARD_JOURNAL_FILENAME.format(*shard))
+        journal = transfer_journal.TransferJournal(journal_db)
+        if opt.retry_failed:
+            logging.info("Retrying the failed transfers")
+            journaled = journal.get(job, [transfer_journal.FAILED])
+        elif opt.resume and journal.is_scanned(job):
+            logging.info("Resuming the unfinished transfers")
+            journaled = journal.get(job, [transfer_journal.PLANNED,
+                                          transfer_journal.IN_FLIGHT])
+        else:
+            # the scan of an interrupted sync is resumed by scanning again
+            # and skipping the transfers already done
+            journaled = None
+            if not opt.resume and not (opt.dry_run or opt.plan):
+                journal.start(job)
+        if client.is_remote_file(destination):
+            # Currently we don't create nodes in sync and we don't sync onto
+            # files
+            logging.info("Connecting to VOSpace")
+            logging.info("Confirming Destination is a directory")
+            if client.isfile(destination):
+                if len(opt.files) == 1:
+                    if os.path.isfile(opt.files):
+                        files = [(opt.files, destination, None)]
+                    else:
+                        raise RuntimeError(
+                            'Cannot sync directory into a remote file')
                 else:
                     raise RuntimeError(
-                        'Cannot sync directory into a remote file')
+                        'Cannot sync multiple sources into a single remote '
+                        'file')
             else:
-                raise RuntimeError(
-                    'Cannot sync multiple sources into a single remote file')
+                # the destination nodes are looked up in the listings of
+                # their containers
+                global global_listing
+                global_listing = RemoteListing()
+                if opt.watch:
+                    # watching before the scan so that the files changed
+                    # during the sync are not missed
+                    sources = WatchedSources(paths=opt.files,
+                                             vos_root=destination,
+                                             include=opt.include,
+                                             exclude=opt.exclude)
+                    watcher = watch.watcher(sources.roots,
+                                            recursive=opt.recursive,
+                                            prune=sources.prunes)
+                if opt.from_manifest is not None:
+                    files = iter_manifest_list(
+                        read_manifest_file(opt.from_manifest),
+                        path=opt.files[0],
+                        vos_root=destination,
+                        include=opt.include,
+                        exclude=opt.exclude)
+                else:
+                    snapshots = None
+                    if opt.incremental:
+                        cache_dir = os.path.dirname(
+                            os.path.abspath(opt.cache_filename))
+                        if not os.path.isdir(cache_dir):
+                            os.makedirs(cache_dir)
+                        snapshots = dir_snapshot.DirectorySnapshots(
+                            opt.cache_filename)
+                    files = scan_file_list(paths=opt.files,
+                                           vos_root=destination,
+                                           recursive=opt.recursive,
+                                           include=opt.include,
+                                           exclude=opt.exclude,
+                                           snapshots=snapshots)
+
+            if shard is not None:
+                files = shard_transfers(files, destination, shard)
+
+            # directories are created by the same threads as the uploads
+            if journaled is not None:
+                transfers = ((src, dest, None) for src, dest in journaled)
+            elif opt.plan:
+                transfers = files
+            else:
+                transfers = plan_transfers(files, journal, job)
+            if global_listing is not None:
+                # the listings are kept until the transfers in their
+                # containers are done
+                transfers = global_listing.retain(transfers)
+            # the files are hashed ahead of their comparison
+            transfers = hash_transfers(transfers, opt)
+            worker = execute_upload
+            dependencies = upload_dependencies
+            sizer = upload_size
         else:
-            files = build_file_list(paths=opt.files,
-                                    vos_root=destination,
-                                    recursive=opt.recursive,
-                                    include=opt.include,
-                                    exclude=opt.exclude)
-
-        # build the list of transfers
-        transfers = []
-        for src_path, vos_dest in files:
-            transfer = prepare(src_path, vos_dest, client)
-            if transfer:
-                transfers.append(transfer)
+            for src_path in opt.files:
+                if not client.is_remote_file(src_path):
+                    parser.error("Only allows sync FROM local copy TO VOSpace "
+                                 "or FROM VOSpace TO local copy")
+            if opt.delete:
+                parser.error("--delete is only supported when syncing to "
+                             "VOSpace")
+            if opt.plan:
+                parser.error("--plan is only supported when syncing to "
+                             "VOSpace")
+            if shard is not None:
+                parser.error("--shard is only supported when syncing to "
+                             "VOSpace")
+            if opt.from_manifest is not None:
+                parser.error("--from-manifest is only supported when syncing "
+                             "to VOSpace")
+            if opt.incremental:
+                parser.error("--incremental is only supported when syncing "
+                             "to VOSpace")
+            if opt.watch:
+                parser.error("--watch is only supported when syncing to "
+                             "VOSpace")
+            logging.info("Listing the VOSpace sources")
+            if os.path.isdir(destination) or len(opt.files) > 1 or \
+                    client.isdir(opt.files[0]):
+                if not os.path.isdir(destination):
+                    os.makedirs(destination)
+                files = iter_remote_file_list(client,
+                                              paths=opt.files,
+                                              local_root=destination,
+                                              recursive=opt.recursive,
+                                              include=opt.include,
+                                              exclude=opt.exclude)
+            else:
+                # single data node synced to a local file
+                node = client.get_node(opt.files[0], limit=0, force=True)
+                files = [(node.uri, destination, node)]
 
-        # main execution loop
-        futures = []
-        with concurrent.futures.ThreadPoolExecutor(max_workers=opt.nstreams) \
-                as executor:
-            for file_src, vos_dest in transfers:
-                futures.append(executor.submit(
-                    execute, file_src, vos_dest, opt))
+            # the transfers are prepared as the containers are listed
+            if journaled is not None:
+                transfers = ((src_uri, local_dest, None)
+                             for src_uri, local_dest in journaled)
+            else:
+                transfers = plan_transfers(filter(None, (
+                    prepare_download(src_uri, local_dest, node)
+                    for src_uri, local_dest, node in files)), journal, job)
+            worker = execute_download
+            dependencies = None
+            sizer = download_size
 
+        deletions = None
+        if opt.delete:
+            if global_listing is None:
+                logging.warning('Nothing to delete in a remote file')
+            else:
+                deletions = iter_remote_deletions(client,
+                                                  paths=opt.files,
+                                                  vos_root=destination,
+                                                  recursive=opt.recursive,
+                                                  include=opt.include,
+                                                  exclude=opt.exclude)
+                if shard is not None:
+                    deletions = (
+                        deletion for deletion in deletions
+                        if in_shard(deletion[0], destination, shard))
+        if opt.dry_run:
+            for uri, is_container in deletions or []:
+                print('delete {}{}'.format(uri, '/' if is_container else ''))
+            return
+        if opt.plan:
+            logging.info("Comparing the files with VOSpace")
+            plan_worker = plan_upload
+            if global_listing is not None:
+                plan_worker = global_listing.track(plan_worker)
+            planned = run_transfers(transfers, plan_worker, opt,
+                                    dependencies=dependencies)
+            if deletions is not None:
+                deletions = sum(1 for _ in deletions)
+            print(json.dumps(plan_summary(
+                planned, opt.nstreams, journal.stream_throughput(),
+                max_rate=opt.max_rate, deletions=deletions), indent=2))
+            return
+
+        # main execution loop
         logging.info(
-            ("Waiting for transfers to complete "
+            ("Transferring files while scanning "
              r"********  CTRL-\ to interrupt  ********"))
-
+        if opt.processes > 1:
+            # the containers are created and the skip decisions made here
+            # so that each container is listed once. The transfers passed
+            # on are journaled by the processes.
+            check = None
+            process_opt = opt
+            if worker == execute_upload:
+                check = check_upload
+                if global_listing is not None:
+                    check = global_listing.track(check)
+                # the files passed on do not need checking again
+                process_opt = copy.copy(opt)
+                process_opt.overwrite = True
+            processes = TransferProcesses(opt.processes, worker, process_opt,
+                                          journal_db, job, sizer)
+            end_result = run_transfers(
+                transfers, dispatch_transfers(processes, check, journal, job),
+                opt, dependencies=dependencies)
+            end_result += processes.join()
+        else:
+            if global_listing is not None:
+                worker = global_listing.track(worker)
+            end_result = transfer_all(transfers, worker, opt, journal, job,
+                                      sizer, dependencies=dependencies)
+        if deletions is not None:
+            # the nodes are deleted once the sync is complete so that an
+            # interrupted sync does not leave the destination missing data
+            logging.info("Deleting the nodes without a local copy")
+            end_result += run_transfers(deletions, execute_delete, opt)
         end_time = time.time()
-        end_result = TransferReport()
-        for r in concurrent.futures.as_completed(futures):
-            res = r.result()
-            end_result.bytes_sent += res.bytes_sent
-            end_result.bytes_skipped += res.bytes_skipped
-            end_result.files_sent += res.files_sent
-            end_result.files_skipped += res.files_skipped
-            end_result.files_erred += res.files_erred
+        if end_result.bytes_sent > 0:
+            # history of the estimates of --plan
+            journal.record_run(job, opt.nstreams, end_result.files_sent,
+                               end_result.bytes_sent, end_time - start_time)
 
         logging.info("==== TRANSFER REPORT ====")
 
@@ -474,12 +2554,28 @@ def vsync():
         if end_result.bytes_sent == 0:
             logging.info("No files needed sending ")
 
+        if end_result.files_deleted > 0:
+            logging.info("Deleted {} nodes".format(end_result.files_deleted))
+
         if end_result.files_erred > 0:
             logging.info(
-                "Error transferring {} files, please try again".format(
-                    end_result.files_erred))
+                "Error transferring {} files, please try again with "
+                "--retry-failed".format(end_result.files_erred))
+
+        if watcher is not None:
+            sync_changes(watcher, sources, opt, shard)
+        elif opt.watch:
+            logging.warning('Nothing to watch in a remote file')
     except Exception as ex:
         exit_on_exception(ex)
+    finally:
+        if watcher is not None:
+            watcher.close()
+        if global_hash_engine is not None:
+            global_hash_engine.close()
+        if global_md5_cache is not None:
+            # writes the pending updates
+            global_md5_cache.close()
 
 
 vsync.__doc__ = DESCRIPTION
@@ -0,0 +1,219 @@
+# ***********************************************************************
+# ******************  CANADIAN ASTRONOMY DATA CENTRE  *******************
+# *************  CENTRE CANADIEN DE DONNÉES ASTRONOMIQUES  **************
+#
+#  (c) 2026.                            (c) 2026.
+#  Government of Canada                 Gouvernement du Canada
+#  National Research Council            Conseil national de recherches
+#  Ottawa, Canada, K1A 0R6              Ottawa, Canada, K1A 0R6
+#  All rights reserved                  Tous droits réservés
+#
+#  NRC disclaims any warranties,        Le CNRC dénie toute garantie
+#  expressed, implied, or               énoncée, implicite ou légale,
+#  statutory, of any kind with          de quelque nature que ce
+#  respect to the software,             soit, concernant le logiciel,
+#  including without limitation         y compris sans restriction
+#  any warranty of merchantability      toute garantie de valeur
+#  or fitness for a particular          marchande ou de pertinence
+#  purpose. NRC shall not be            pour un usage particulier.
+#  liable in any event for any          Le CNRC ne pourra en aucun cas
+#  damages, whether direct or           être tenu responsable de tout
+#  indirect, special or general,        dommage, direct ou indirect,
+#  consequential or incidental,         particulier ou général,
+#  arising from the use of the          accessoire ou fortuit, résultant
+#  software.  Neither the name          de l'utilisation du logiciel. Ni
+#  of the National Research             le nom du Conseil National de
+#  Council of Canada nor the            Recherches du Canada ni les noms
+#  names of its contributors may        de ses  participants ne peuvent
+#  be used to endorse or promote        être utilisés pour approuver ou
+#  products derived from this           promouvoir les produits dérivés
+#  software without specific prior      de ce logiciel sans autorisation
+#  written permission.                  préalable et particulière
+#                                       par écrit.
+#
+#  This file is part of the             Ce fichier fait partie du projet
+#  OpenCADC project.                    OpenCADC.
+#
+#  OpenCADC is free software:           OpenCADC est un logiciel libre ;
+#  you can redistribute it and/or       vous pouvez le redistribuer ou le
+#  modify it under the terms of         modifier suivant les termes de
+#  the GNU Affero General Public        la “GNU Affero General Public
+#  License as published by the          License” telle que publiée
+#  Free Software Foundation,            par la Free Software Foundation
+#  either version 3 of the              : soit la version 3 de cette
+#  License, or (at your option)         licence, soit (à votre gré)
+#  any later version.                   toute version ultérieure.
+#
+#  OpenCADC is distributed in the       OpenCADC est distribué
+#  hope that it will be useful,         dans l’espoir qu’il vous
+#  but WITHOUT ANY WARRANTY;            sera utile, mais SANS AUCUNE
+#  without even the implied             GARANTIE : sans même la garantie
+#  warranty of MERCHANTABILITY          implicite de COMMERCIALISABILITÉ
+#  or FITNESS FOR A PARTICULAR          ni d’ADÉQUATION À UN OBJECTIF
+#  PURPOSE.  See the GNU Affero         PARTICULIER. Consultez la Licence
+#  General Public License for           Générale Publique GNU Affero
+#  more details.                        pour plus de détails.
+#
+#  You should have received             Vous devriez avoir reçu une
+#  a copy of the GNU Affero             copie de la Licence Générale
+#  General Public License along         Publique GNU Affero avec
+#  with OpenCADC.  If not, see          OpenCADC ; si ce n’est
+#  <http://www.gnu.org/licenses/>.      pas le cas, consultez :
+#                                       <http://www.gnu.org/licenses/>.
+#
+#  $Revision: 4 $
+#
+# ***********************************************************************
+#
+
+"""
+ Adaptive control of the number of concurrent transfers.
+
+ The number of transfers running at once is adjusted with an additive
+ increase / multiplicative decrease (AIMD) policy: it is raised by one while
+ the aggregate throughput keeps improving and halved when the service shows
+ signs of overload, i.e. it responds with 503, 408 or 504 or the latency
+ of its metadata requests rises. The configured number of streams is the ceiling.
+"""
+import logging
+import threading
+import time
+
+logger = logging.getLogger('vos')
+
+# HTTP status codes that tell the service is overloaded
+THROTTLE_CODES = (503, 408, 504)
+# minimum throughput gain between windows to add a transfer
+MIN_THROUGHPUT_GAIN = 0.05
+# latency, relative to the lowest seen, that is considered congestion
+LATENCY_FACTOR = 3.0
+# weight of the last response in the average latency
+LATENCY_SMOOTHING = 0.2
+# the latency is measured on the metadata requests only: their request
+# body is at most this size and their response is a document of one of
+# these types. The time of the data transfers depends on their size.
+MAX_METADATA_BODY = 2 ** 16
+METADATA_TYPES = ('xml', 'json', 'text/')
+
+
+class AdaptiveConcurrency(object):
+    """
+    AIMD controller of the number of concurrent transfers. Each transfer is
+    wrapped in acquire/release calls and response_hook is registered with
+    the clients so that the controller sees every HTTP response, including
+    the ones retried internally.
+    """
+    def __init__(self, ceiling, initial=None):
+        """
+        :param ceiling: maximum number of concurrent transfers
+        :param initial: number of concurrent transfers to start with. Half
+        of the ceiling by default.
+        """
+        self.ceiling = max(1, ceiling)
+        self.limit = max(1, min(self.ceiling, initial or self.ceiling // 2))
+        self.in_flight = 0
+        self._cond = threading.Condition()
+        # current measurement window
+        self._window_start = time.time()
+        self._window_bytes = 0
+        self._window_count = 0
+        self._last_throughput = None
+        self._latency = None
+        self._min_latency = None
+        # set after a reduction until the transfers started before it are
+        # done
+        self._backing_off = False
+
+    def acquire(self):
+        """
+        Waits until a transfer can be started
+        """
+        with self._cond:
+            while self.in_flight >= self.limit:
+                self._cond.wait()
+            self.in_flight += 1
+
+    def release(self, nbytes=0):
+        """
+        Records the completion of a transfer
+        :param nbytes: number of bytes transferred
+        """
+        with self._cond:
+            self.in_flight -= 1
+            self._window_bytes += nbytes
+            self._window_count += 1
+            if self._window_count >= self.limit:
+                self._end_window()
+            self._cond.notify_all()
+
+    def throttled(self):
+        """
+        Records a sign of overload of the service
+        """
+        with self._cond:
+            if not self._backing_off:
+                self._decrease()
+
+    def response_hook(self, response, *args, **kwargs):
+        """
+        requests response hook: records throttling responses and the
+        latency of the metadata requests
+        """
+        if response.status_code in THROTTLE_CODES:
+            self.throttled()
+            return
+        if not _is_metadata(response):
+            return
+        elapsed = response.elapsed.total_seconds()
+        with self._cond:
+            if self._latency is None:
+                self._latency = elapsed
+            else:
+                self._latency += LATENCY_SMOOTHING * (elapsed - self._latency)
+            if self._min_latency is None or elapsed < self._min_latency:
+                self._min_latency = elapsed
+            rising = self._min_latency > 0 and \
+                self._latency > LATENCY_FACTOR * self._min_latency
+        if rising:
+            self.throttled()
+
+    def _decrease(self):
+        limit = max(1, self.limit // 2)
+        if limit != self.limit:
+            logger.info('Service overloaded, reducing concurrent transfers '
+                        'from {} to {}'.format(self.limit, limit))
+        self.limit = limit
+        self._backing_off = True
+        self._reset_window()
+        self._last_throughput = None
+        # do not count the latency of the overload against the next window
+        self._latency = self._min_latency
+
+    def _end_window(self):
+        elapsed = max(time.time() - self._window_start, 1e-6)
+        throughput = self._window_bytes / elapsed
+        if not self._backing_off and self.limit < self.ceiling and (
+                self._last_throughput is None or throughput >
+                self._last_throughput * (1 + MIN_THROUGHPUT_GAIN)):
+            self.limit += 1
+            logger.debug('Increasing concurrent transfers to {}'.format(
+                self.limit))
+        self._last_throughput = throughput
+        self._backing_off = False
+        self._reset_window()
+
+    def _reset_window(self):
+        self._window_start = time.time()
+        self._window_bytes = 0
+        self._window_count = 0
+
+
+def _is_metadata(response):
+    # responses to the requests that do not transfer data
+    body = response.request.body
+    if body is not None and (not isinstance(body, (bytes, str)) or
+                             len(body) > MAX_METADATA_BODY):
+        # streamed or large upload
+        return False
+    content_type = response.headers.get('Content-Type', '')
+    return any(doc_type in content_type for doc_type in METADATA_TYPES)
@@ -0,0 +1,175 @@
+# ***********************************************************************
+# ******************  CANADIAN ASTRONOMY DATA CENTRE  *******************
+# *************  CENTRE CANADIEN DE DONNÉES ASTRONOMIQUES  **************
+#
+#  (c) 2026.                            (c) 2026.
+#  Government of Canada                 Gouvernement du Canada
+#  National Research Council            Conseil national de recherches
+#  Ottawa, Canada, K1A 0R6              Ottawa, Canada, K1A 0R6
+#  All rights reserved                  Tous droits réservés
+#
+#  NRC disclaims any warranties,        Le CNRC dénie toute garantie
+#  expressed, implied, or               énoncée, implicite ou légale,
+#  statutory, of any kind with          de quelque nature que ce
+#  respect to the software,             soit, concernant le logiciel,
+#  including without limitation         y compris sans restriction
+#  any warranty of merchantability      toute garantie de valeur
+#  or fitness for a particular          marchande ou de pertinence
+#  purpose. NRC shall not be            pour un usage particulier.
+#  liable in any event for any          Le CNRC ne pourra en aucun cas
+#  damages, whether direct or           être tenu responsable de tout
+#  indirect, special or general,        dommage, direct ou indirect,
+#  consequential or incidental,         particulier ou général,
+#  arising from the use of the          accessoire ou fortuit, résultant
+#  software.  Neither the name          de l'utilisation du logiciel. Ni
+#  of the National Research             le nom du Conseil National de
+#  Council of Canada nor the            Recherches du Canada ni les noms
+#  names of its contributors may        de ses  participants ne peuvent
+#  be used to endorse or promote        être utilisés pour approuver ou
+#  products derived from this           promouvoir les produits dérivés
+#  software without specific prior      de ce logiciel sans autorisation
+#  written permission.                  préalable et particulière
+#                                       par écrit.
+#
+#  This file is part of the             Ce fichier fait partie du projet
+#  OpenCADC project.                    OpenCADC.
+#
+#  OpenCADC is free software:           OpenCADC est un logiciel libre ;
+#  you can redistribute it and/or       vous pouvez le redistribuer ou le
+#  modify it under the terms of         modifier suivant les termes de
+#  the GNU Affero General Public        la “GNU Affero General Public
+#  License as published by the          License” telle que publiée
+#  Free Software Foundation,            par la Free Software Foundation
+#  either version 3 of the              : soit la version 3 de cette
+#  License, or (at your option)         licence, soit (à votre gré)
+#  any later version.                   toute version ultérieure.
+#
+#  OpenCADC is distributed in the       OpenCADC est distribué
+#  hope that it will be useful,         dans l’espoir qu’il vous
+#  but WITHOUT ANY WARRANTY;            sera utile, mais SANS AUCUNE
+#  without even the implied             GARANTIE : sans même la garantie
+#  warranty of MERCHANTABILITY          implicite de COMMERCIALISABILITÉ
+#  or FITNESS FOR A PARTICULAR          ni d’ADÉQUATION À UN OBJECTIF
+#  PURPOSE.  See the GNU Affero         PARTICULIER. Consultez la Licence
+#  General Public License for           Générale Publique GNU Affero
+#  more details.                        pour plus de détails.
+#
+#  You should have received             Vous devriez avoir reçu une
+#  a copy of the GNU Affero             copie de la Licence Générale
+#  General Public License along         Publique GNU Affero avec
+#  with OpenCADC.  If not, see          OpenCADC ; si ce n’est
+#  <http://www.gnu.org/licenses/>.      pas le cas, consultez :
+#                                       <http://www.gnu.org/licenses/>.
+#
+#  $Revision: 4 $
+#
+# ***********************************************************************
+#
+
+
+"""
+ Snapshots of the local directories scanned by a sync.
+
+ The entries of a directory are recorded along with its inode, modification
+ time and number of entries, the files with their size, modification time
+ and the fingerprint of their stat. As long as the inode and modification
+ time of the directory do not change, no entry was added, removed or renamed
+ and the recorded entries can be used instead of listing the directory and
+ stat'ing its files again. Files modified in place do not change their directory and
+ are not noticed.
+"""
+import sqlite3
+import threading
+
+# fingerprint of the recorded files, see md5_cache.fingerprint
+FINGERPRINT_COLUMNS = ['st_dev', 'st_ino', 'st_mtime_ns', 'st_ctime_ns']
+
+
+class DirectorySnapshots:
+    def __init__(self, cache_db):
+        """Setup the sqlDB that will contain the snapshot tables.
+
+        :param cache_db: The path and filename where the SQL db is stored,
+        usually the db of the MD5 cache.
+        """
+        self.cache_db = cache_db
+        self._lock = threading.Lock()
+        # the connection is shared by the scanning threads
+        self._conn = sqlite3.connect(self.cache_db,
+                                     check_same_thread=False)
+        with self._lock, self._conn:
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                ("create table if not exists "
+                 "directories (path text PRIMARY KEY NOT NULL, "
+                 "st_ino int NOT NULL, st_mtime_ns int NOT NULL, "
+                 "entries int NOT NULL)"))
+            self._conn.execute(
+                ("create table if not exists "
+                 "directory_entries (directory text NOT NULL, "
+                 "name text NOT NULL, is_dir int NOT NULL, st_size int, "
+                 "st_mtime real, st_dev int, st_ino int, st_mtime_ns int, "
+                 "st_ctime_ns int, PRIMARY KEY (directory, name))"))
+            # the snapshots of the previous versions miss the fingerprint
+            existing = {row[1] for row in self._conn.execute(
+                "PRAGMA table_info(directory_entries)")}
+            for column in FINGERPRINT_COLUMNS:
+                if column not in existing:
+                    self._conn.execute(
+                        "ALTER TABLE directory_entries ADD COLUMN {} "
+                        "int".format(column))
+
+    def get(self, path, stat):
+        """Get the recorded entries of a directory if it did not change.
+
+        :param path: path of the directory
+        :param stat: current os.stat() of the directory
+        :return: list of the (name, is_dir, st_size, st_mtime, st_dev,
+        st_ino, st_mtime_ns, st_ctime_ns) of the entries sorted by name, the
+        stat fields None for directories, or None if the directory changed
+        or was never recorded
+        """
+        with self._lock:
+            row = self._conn.execute(
+                ("SELECT st_ino, st_mtime_ns, entries FROM directories "
+                 "WHERE path = ?"), (path,)).fetchone()
+            if row is None or row[0] != stat.st_ino or \
+                    row[1] != stat.st_mtime_ns:
+                return None
+            entries = self._conn.execute(
+                ("SELECT name, is_dir, st_size, st_mtime, st_dev, st_ino, "
+                 "st_mtime_ns, st_ctime_ns FROM directory_entries "
+                 "WHERE directory = ? ORDER BY name"), (path,)).fetchall()
+        if len(entries) != row[2]:
+            # incomplete record
+            return None
+        return [(name, bool(is_dir)) + tuple(stat)
+                for name, is_dir, *stat in entries]
+
+    def update(self, path, stat, entries):
+        """Record the entries of a directory.
+
+        :param path: path of the directory
+        :param stat: os.stat() of the directory taken before listing it
+        :param entries: list of the (name, is_dir, st_size, st_mtime, st_dev,
+        st_ino, st_mtime_ns, st_ctime_ns) of the entries, the stat fields
+        None for directories
+        """
+        with self._lock, self._conn:
+            self._conn.execute(
+                "DELETE from directory_entries WHERE directory = ?", (path,))
+            self._conn.executemany(
+                ("INSERT INTO directory_entries "
+                 "(directory, name, is_dir, st_size, st_mtime, st_dev, "
+                 "st_ino, st_mtime_ns, st_ctime_ns) "
+                 "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)"),
+                [(path, name, int(is_dir)) + tuple(stat)
+                 for name, is_dir, *stat in entries])
+            self._conn.execute(
+                ("INSERT OR REPLACE INTO directories "
+                 "(path, st_ino, st_mtime_ns, entries) VALUES (?, ?, ?, ?)"),
+                (path, stat.st_ino, stat.st_mtime_ns, len(entries)))
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -76,37 +76,243 @@
  caller to choose to skip files that match (MD5 wise) between the
  two locations.
 """
+import atexit
+import collections
+import os
+import re
 import sqlite3
 import logging
 import hashlib
 import tempfile
+import threading
+import zlib
+import concurrent.futures
+import multiprocessing
 
 READ_BUFFER_SIZE = 8192
+# number of pending updates of the cache that triggers a write
+WRITE_BATCH_SIZE = 500
+# maximum seconds an update of the cache stays pending
+WRITE_INTERVAL = 0.2
+# seconds to wait for the lock of the db held by another process
+BUSY_TIMEOUT = 60
+# names of the tables of the local files and of the remote nodes
+LOCAL_TABLE = 'local_files'
+REMOTE_TABLE = 'remote_nodes'
+# columns of the entries of the tables. The local files are recorded with
+# the fingerprint of their stat and a sample of their content to tell
+# whether they changed since they were hashed
+COLUMNS = {
+    LOCAL_TABLE: ('md5', 'st_size', 'st_mtime', 'st_dev', 'st_ino',
+                  'st_mtime_ns', 'st_ctime_ns', 'sample'),
+    REMOTE_TABLE: ('md5', 'st_size', 'st_mtime')}
+# number of bytes read at the start and at the end of a file for its sample
+SAMPLE_SIZE = 2 ** 16
+# number of prefetched directories kept in memory
+PREFETCH_DIRECTORIES = 256
+# URIs of the remote nodes in the cache of the previous versions, a scheme
+# of more than one letter to tell them from Windows drives
+REMOTE_URI = re.compile(r'^[A-Za-z][A-Za-z0-9+.-]+:')
+# size of the buffers of the hashing engine. hashlib releases the GIL while
+# hashing updates larger than 2 KB so large buffers let threads hash in
+# parallel
+HASH_BUFFER_SIZE = 2 ** 20
+# number of threads of the hashing engine
+HASH_THREADS = 4
+
+# reusable buffer of each hashing thread or process
+_buffers = threading.local()
+
+
+def fingerprint(stat):
+    """
+    Fingerprint of a file, changed by any write, rename or replacement of
+    the file
+    :param stat: os.stat() of the file
+    :return: (st_dev, st_ino, st_size, st_mtime_ns, st_ctime_ns) tuple
+    """
+    return (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns,
+            stat.st_ctime_ns)
+
+
+def sample_file(filename, st_size, sample_size=SAMPLE_SIZE):
+    """
+    Fast non-cryptographic checksum of the start and the end of a file to
+    notice the rewrites that keep the modification time of the file
+    :param filename: Name of the file to sample
+    :param st_size: size of the file
+    :param sample_size: number of bytes read at each end of the file
+    :return: the CRC32 of the samples, None if the file cannot be read
+    """
+    try:
+        with open(filename, 'rb') as f:
+            sample = zlib.crc32(f.read(sample_size))
+            if st_size > sample_size:
+                f.seek(max(sample_size, st_size - sample_size))
+                sample = zlib.crc32(f.read(sample_size), sample)
+    except OSError:
+        return None
+    return sample
+
+
+def hash_file(filename, buffer_size=HASH_BUFFER_SIZE):
+    """
+    Computes the MD5 of a file, reading it with readinto in a buffer reused
+    by the calls of the same thread
+    :param filename: Name of the file to compute the MD5 checksum for.
+    :param buffer_size: size of the buffer
+    :return: the MD5 hexdigest of the file.
+    :rtype: str
+    """
+    buffer = getattr(_buffers, 'buffer', None)
+    if buffer is None or len(buffer) != buffer_size:
+        buffer = memoryview(bytearray(buffer_size))
+        _buffers.buffer = buffer
+    md5 = hashlib.md5()
+    with open(filename, 'rb', buffering=0) as f:
+        while True:
+            size = f.readinto(buffer)
+            if not size:
+                break
+            md5.update(buffer[:size])
+    return md5.hexdigest()
+
+
+class HashEngine(object):
+    """
+    Computes the MD5 of files in a pool of threads, or of processes for many
+    small files where the per file overhead of the threads dominates. The
+    hashes can be requested ahead of time with prefetch so that they are
+    ready when needed.
+    """
+    def __init__(self, nthreads=HASH_THREADS, nprocesses=0,
+                 buffer_size=HASH_BUFFER_SIZE):
+        """
+        :param nthreads: number of hashing threads
+        :param nprocesses: number of hashing processes, 0 to hash in
+        threads
+        :param buffer_size: size of the read buffer of each thread or
+        process
+        """
+        self.buffer_size = buffer_size
+        if nprocesses > 0:
+            self._executor = concurrent.futures.ProcessPoolExecutor(
+                max_workers=nprocesses,
+                mp_context=multiprocessing.get_context('spawn'))
+        else:
+            self._executor = concurrent.futures.ThreadPoolExecutor(
+                max_workers=nthreads)
+        self._pending = {}
+        self._lock = threading.Lock()
+
+    def prefetch(self, filename):
+        """
+        Starts hashing a file in the background
+        :param filename: Name of the file to compute the MD5 checksum for.
+        """
+        with self._lock:
+            if filename not in self._pending:
+                self._pending[filename] = self._submit(filename)
+
+    def md5(self, filename):
+        """
+        MD5 of a file, from its prefetch if any
+        :param filename: Name of the file to compute the MD5 checksum for.
+        :return: the MD5 hexdigest of the file.
+        :rtype: str
+        """
+        with self._lock:
+            future = self._pending.pop(filename, None)
+        if future is None:
+            future = self._submit(filename)
+        return future.result()
+
+    def discard(self, filename):
+        """
+        Drops the prefetch of a file whose MD5 is not needed after all
+        :param filename: Name of the prefetched file
+        """
+        with self._lock:
+            future = self._pending.pop(filename, None)
+        if future is not None:
+            future.cancel()
+
+    def close(self):
+        with self._lock:
+            for future in self._pending.values():
+                future.cancel()
+            self._pending.clear()
+        self._executor.shutdown(wait=True)
+
+    def _submit(self, filename):
+        return self._executor.submit(hash_file, filename, self.buffer_size)
 
 
 class MD5Cache:
-    def __init__(self, cache_db=None):
-        """Setup the sqlDB that will contain the cache table.
+    def __init__(self, cache_db=None, batch_size=WRITE_BATCH_SIZE,
+                 write_interval=WRITE_INTERVAL, sample=False):
+        """Setup the sqlDB that will contain the cache tables.
 
         The slqDB can then be used to lookup MD5 values rather than
-        recompute them at each restart of a transfer.
+        recompute them at each restart of a transfer. The local files and
+        the remote nodes are kept in separate tables keyed on their parent
+        directory so that the entries of a directory are loaded with a
+        single query by prefetch. The db is in WAL mode so that the threads
+        and the processes sharing it read while one of them writes, and the
+        updates are written in batches by a background thread.
+
+        A db with the single md5_cache table of the previous versions is
+        migrated to the new tables.
 
         :param cache_db: The path and filename where the SQL db will be stored.
+        :param batch_size: number of pending updates that triggers a write
+        :param write_interval: maximum seconds an update stays pending
+        :param sample: True to sample the content of the local files on
+        top of their fingerprint to tell whether they changed
         """
         if cache_db is None:
             self.cache_obj = tempfile.NamedTemporaryFile()
             self.cache_db = self.cache_obj.name
         else:
             self.cache_db = cache_db
+        self.batch_size = batch_size
+        self.write_interval = write_interval
+        self.sample = sample
+        self._local = threading.local()
+        self._connections = []
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        # serializes the writes so that they are applied in order
+        self._write_lock = threading.Lock()
+        # (table, parent, name) -> values of the COLUMNS of the entry, None
+        # for a deletion
+        self._pending = {}
+        self._writing = {}
+        # (table, parent) -> {name: values of the COLUMNS} of the
+        # prefetched directories, least recently used first
+        self._prefetched = collections.OrderedDict()
+        self._writer = None
+        self._closed = False
 
         # initialize the md5Cache db
-        sql_conn = sqlite3.connect(self.cache_db)
-        with sql_conn:
-            # build cache lookup if doesn't already exists
-            sql_conn.execute(
-                ("create table if not exists "
-                 "md5_cache (filename text PRIMARY KEY NOT NULL , "
-                 "md5 text, st_size int, st_mtime int)"))
+        sql_conn = self._connection()
+        sql_conn.execute("PRAGMA journal_mode=WAL")
+        # the processes sharing the db create and migrate it once
+        sql_conn.execute("BEGIN IMMEDIATE")
+        try:
+            for table in (LOCAL_TABLE, REMOTE_TABLE):
+                sql_conn.execute(
+                    ("create table if not exists "
+                     "{} (parent text NOT NULL, name text NOT NULL, "
+                     "md5 text, {}, "
+                     "PRIMARY KEY (parent, name)) WITHOUT ROWID").format(
+                        table, ', '.join('{} int'.format(column)
+                                         for column in COLUMNS[table][1:])))
+            self._migrate(sql_conn)
+            sql_conn.commit()
+        except Exception:
+            sql_conn.rollback()
+            raise
 
     @staticmethod
     def compute_md5(filename, block_size=READ_BUFFER_SIZE):
@@ -128,37 +334,85 @@ class MD5Cache:
                 md5.update(buf)
         return md5.hexdigest()
 
-    def get(self, filename):
+    def get(self, filename, remote=False):
         """Get the MD5 for filename.
 
         First look in MD5 cache databse and then compute if needbe.
 
         :param filename: name of the file you want the MD5 sum for.
+        :param remote: True if filename is the URI of a VOSpace node
+        :return: (md5, st_size, st_mtime) tuple or None if not cached
         """
-        slq_conn = sqlite3.connect(self.cache_db)
-        with slq_conn:
-            cursor = slq_conn.execute(
-                "SELECT md5, st_size, "
-                "st_mtime FROM md5_cache WHERE filename = ? ",
-                (filename,))
-            md5_row = cursor.fetchone()
-        if md5_row is not None:
-            return md5_row
-        else:
+        row = self._row(_key(filename, remote))
+        return None if row is None else tuple(row[:3])
+
+    def get_md5(self, filename, stat):
+        """Get the MD5 of a local file if it did not change since it was
+        hashed.
+
+        The file is considered unchanged as long as its fingerprint, and
+        its sample if the cache samples the files, are the same, so no
+        file is read when nothing changed.
+
+        :param filename: name of the file you want the MD5 sum for.
+        :param stat: current os.stat() of the file
+        :return: the MD5 hexdigest of the file or None if the file changed
+        or was never hashed
+        """
+        row = self._row(_key(filename, False))
+        if row is None:
+            return None
+        md5, st_size, _, st_dev, st_ino, st_mtime_ns, st_ctime_ns, \
+            sample = row
+        if (st_dev, st_ino, st_size, st_mtime_ns, st_ctime_ns) != \
+                fingerprint(stat):
+            return None
+        if self.sample and (
+                sample is None or
+                sample != sample_file(filename, stat.st_size)):
             return None
+        return md5
+
+    def prefetch(self, prefix, remote=False):
+        """Load the entries of a directory so that their get is a lookup
+        in memory.
+
+        :param prefix: the directory, as the parent of its entries in the
+        names given to get
+        :param remote: True if prefix is the URI of a VOSpace container
+        """
+        table = REMOTE_TABLE if remote else LOCAL_TABLE
+        directory = (table, prefix.rstrip('/') if remote else prefix)
+        with self._lock:
+            if directory in self._prefetched:
+                self._prefetched.move_to_end(directory)
+                return
+        cursor = self._connection().execute(
+            ("SELECT name, {} FROM {} WHERE parent = ?").format(
+                ', '.join(COLUMNS[table]), table), directory[1:])
+        entries = {row[0]: row[1:] for row in cursor}
+        with self._lock:
+            # updates made while loading are still pending, they are the
+            # most recent
+            for rows in (self._writing, self._pending):
+                for key, row in rows.items():
+                    if key[:2] == directory:
+                        _set(entries, key[2], row)
+            self._prefetched[directory] = entries
+            while len(self._prefetched) > PREFETCH_DIRECTORIES:
+                self._prefetched.popitem(last=False)
 
-    def delete(self, filename):
+    def delete(self, filename, remote=False):
         """Delete a record from the cache MD5 database.
 
         :param filename: Name of the file whose md5 record to be deleted
         from the cache database
+        :param remote: True if filename is the URI of a VOSpace node
         """
-        sql_conn = sqlite3.connect(self.cache_db)
-        with sql_conn:
-            sql_conn.execute("DELETE from md5_cache WHERE filename = ?",
-                             (filename,))
+        self._queue(_key(filename, remote), None)
 
-    def update(self, filename, md5, st_size, st_mtime):
+    def update(self, filename, md5, st_size, st_mtime, remote=False,
+               stat=None):
         """Update the MD5 value stored in the cache db
 
         :param filename: Name of the file to update the MD5 value for.
@@ -166,18 +420,169 @@ class MD5Cache:
         :param st_size: size of the file being updated (stored to database)
         :param st_mtime: last modified time of the file being stored to
         database.
+        :param remote: True if filename is the URI of a VOSpace node
+        :param stat: os.stat() of the local file taken before it was hashed,
+        its fingerprint is recorded for get_md5
         """
-
-        # UPDATE the MD5 database
-        sql_connection = sqlite3.connect(self.cache_db)
-        try:
-            with sql_connection:
-                sql_connection.execute(
-                    "DELETE from md5_cache WHERE filename = ?", (filename,))
-                sql_connection.execute(
-                    ("INSERT INTO md5_cache (filename, md5, st_size, st_mtime)"
-                     " VALUES ( ?, ?, ?, ?)"),
-                    (filename, md5, st_size, st_mtime))
-        except Exception as e:
-            logging.error(e)
+        row = (md5, st_size, st_mtime)
+        if not remote:
+            if stat is None:
+                row += (None,) * 5
+            else:
+                sample = sample_file(filename, stat.st_size) \
+                    if self.sample else None
+                row += (stat.st_dev, stat.st_ino, stat.st_mtime_ns,
+                        stat.st_ctime_ns, sample)
+        self._queue(_key(filename, remote), row)
         return md5
+
+    def flush(self):
+        """Write the pending updates to the cache db
+        """
+        with self._write_lock:
+            with self._lock:
+                self._writing = self._pending
+                self._pending = {}
+            rows = self._writing
+            if rows:
+                try:
+                    self._write(rows)
+                except Exception as e:
+                    logging.error(e)
+            with self._lock:
+                self._writing = {}
+
+    def close(self):
+        """Write the pending updates and close the connections
+        """
+        with self._lock:
+            if self._closed:
+                return
+            self._closed = True
+            self._wakeup.notify()
+        if self._writer is not None:
+            self._writer.join()
+        self.flush()
+        for sql_conn in self._connections:
+            sql_conn.close()
+        self._connections = []
+
+    def _row(self, key):
+        with self._lock:
+            for rows in (self._pending, self._writing):
+                if key in rows:
+                    return rows[key]
+            entries = self._prefetched.get(key[:2])
+            if entries is not None:
+                self._prefetched.move_to_end(key[:2])
+                return entries.get(key[2])
+        cursor = self._connection().execute(
+            ("SELECT {} FROM {} WHERE parent = ? AND name = ?").format(
+                ', '.join(COLUMNS[key[0]]), key[0]), key[1:])
+        return cursor.fetchone()
+
+    def _connection(self):
+        # each thread has its own connection
+        sql_conn = getattr(self._local, 'connection', None)
+        if sql_conn is None:
+            sql_conn = sqlite3.connect(self.cache_db, timeout=BUSY_TIMEOUT,
+                                       check_same_thread=False)
+            self._local.connection = sql_conn
+            with self._lock:
+                self._connections.append(sql_conn)
+        return sql_conn
+
+    def _queue(self, key, row):
+        with self._lock:
+            self._pending[key] = row
+            entries = self._prefetched.get(key[:2])
+            if entries is not None:
+                _set(entries, key[2], row)
+            closed = self._closed
+            if self._writer is None and not closed:
+                self._writer = threading.Thread(target=self._write_loop,
+                                                daemon=True)
+                self._writer.start()
+                # the updates left pending are written at exit
+                atexit.register(self.close)
+            if len(self._pending) >= self.batch_size:
+                self._wakeup.notify()
+        if closed:
+            # no writer anymore
+            self.flush()
+
+    def _write_loop(self):
+        while True:
+            with self._lock:
+                if not self._closed and len(self._pending) < self.batch_size:
+                    self._wakeup.wait(self.write_interval)
+                if self._closed:
+                    return
+            self.flush()
+
+    def _write(self, rows):
+        sql_conn = self._connection()
+        with sql_conn:
+            for table in (LOCAL_TABLE, REMOTE_TABLE):
+                sql_conn.executemany(
+                    ("DELETE from {} WHERE parent = ? AND name = ?").format(
+                        table),
+                    [key[1:] for key, row in rows.items()
+                     if key[0] == table and row is None])
+                columns = COLUMNS[table]
+                sql_conn.executemany(
+                    ("INSERT INTO {} (parent, name, {}) VALUES (?, ?, {}) "
+                     "ON CONFLICT (parent, name) DO UPDATE SET {}").format(
+                        table, ', '.join(columns),
+                        ', '.join('?' * len(columns)),
+                        ', '.join('{0} = excluded.{0}'.format(column)
+                                  for column in columns)),
+                    [key[1:] + tuple(row) for key, row in rows.items()
+                     if key[0] == table and row is not None])
+
+    @staticmethod
+    def _migrate(sql_conn):
+        # the tables of the previous versions miss the fingerprint columns
+        for table, columns in COLUMNS.items():
+            existing = {row[1] for row in sql_conn.execute(
+                "PRAGMA table_info({})".format(table))}
+            for column in columns:
+                if column not in existing:
+                    sql_conn.execute("ALTER TABLE {} ADD COLUMN {} int".format(
+                        table, column))
+        # the single table of the previous versions held the local paths
+        # and the remote URIs alike
+        if sql_conn.execute(
+                "SELECT name FROM sqlite_master WHERE type = 'table' AND "
+                "name = 'md5_cache'").fetchone() is None:
+            return
+        logging.info('Migrating the MD5 cache to separate local and remote '
+                     'tables')
+        rows = {LOCAL_TABLE: [], REMOTE_TABLE: []}
+        for filename, md5, st_size, st_mtime in sql_conn.execute(
+                "SELECT filename, md5, st_size, st_mtime FROM md5_cache"):
+            key = _key(filename, REMOTE_URI.match(filename) is not None)
+            rows[key[0]].append(key[1:] + (md5, st_size, st_mtime))
+        for table in (LOCAL_TABLE, REMOTE_TABLE):
+            # the entries already in the new tables are more recent
+            sql_conn.executemany(
+                ("INSERT INTO {} (parent, name, md5, st_size, st_mtime) "
+                 "VALUES (?, ?, ?, ?, ?) ON CONFLICT (parent, name) DO "
+                 "NOTHING").format(table), rows[table])
+        sql_conn.execute("DROP TABLE md5_cache")
+
+
+def _key(filename, remote):
+    # (table, parent, name) of a local file or remote node
+    if remote:
+        parent, _, name = filename.rstrip('/').rpartition('/')
+        return REMOTE_TABLE, parent, name
+    parent, name = os.path.split(filename)
+    return LOCAL_TABLE, parent, name
+
+
+def _set(entries, name, row):
+    if row is None:
+        entries.pop(name, None)
+    else:
+        entries[name] = row
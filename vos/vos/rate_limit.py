@@ -0,0 +1,281 @@
+# ***********************************************************************
+# ******************  CANADIAN ASTRONOMY DATA CENTRE  *******************
+# *************  CENTRE CANADIEN DE DONNÉES ASTRONOMIQUES  **************
+#
+#  (c) 2026.                            (c) 2026.
+#  Government of Canada                 Gouvernement du Canada
+#  National Research Council            Conseil national de recherches
+#  Ottawa, Canada, K1A 0R6              Ottawa, Canada, K1A 0R6
+#  All rights reserved                  Tous droits réservés
+#
+#  NRC disclaims any warranties,        Le CNRC dénie toute garantie
+#  expressed, implied, or               énoncée, implicite ou légale,
+#  statutory, of any kind with          de quelque nature que ce
+#  respect to the software,             soit, concernant le logiciel,
+#  including without limitation         y compris sans restriction
+#  any warranty of merchantability      toute garantie de valeur
+#  or fitness for a particular          marchande ou de pertinence
+#  purpose. NRC shall not be            pour un usage particulier.
+#  liable in any event for any          Le CNRC ne pourra en aucun cas
+#  damages, whether direct or           être tenu responsable de tout
+#  indirect, special or general,        dommage, direct ou indirect,
+#  consequential or incidental,         particulier ou général,
+#  arising from the use of the          accessoire ou fortuit, résultant
+#  software.  Neither the name          de l'utilisation du logiciel. Ni
+#  of the National Research             le nom du Conseil National de
+#  Council of Canada nor the            Recherches du Canada ni les noms
+#  names of its contributors may        de ses  participants ne peuvent
+#  be used to endorse or promote        être utilisés pour approuver ou
+#  products derived from this           promouvoir les produits dérivés
+#  software without specific prior      de ce logiciel sans autorisation
+#  written permission.                  préalable et particulière
+#                                       par écrit.
+#
+#  This file is part of the             Ce fichier fait partie du projet
+#  OpenCADC project.                    OpenCADC.
+#
+#  OpenCADC is free software:           OpenCADC est un logiciel libre ;
+#  you can redistribute it and/or       vous pouvez le redistribuer ou le
+#  modify it under the terms of         modifier suivant les termes de
+#  the GNU Affero General Public        la “GNU Affero General Public
+#  License as published by the          License” telle que publiée
+#  Free Software Foundation,            par la Free Software Foundation
+#  either version 3 of the              : soit la version 3 de cette
+#  License, or (at your option)         licence, soit (à votre gré)
+#  any later version.                   toute version ultérieure.
+#
+#  OpenCADC is distributed in the       OpenCADC est distribué
+#  hope that it will be useful,         dans l’espoir qu’il vous
+#  but WITHOUT ANY WARRANTY;            sera utile, mais SANS AUCUNE
+#  without even the implied             GARANTIE : sans même la garantie
+#  warranty of MERCHANTABILITY          implicite de COMMERCIALISABILITÉ
+#  or FITNESS FOR A PARTICULAR          ni d’ADÉQUATION À UN OBJECTIF
+#  PURPOSE.  See the GNU Affero         PARTICULIER. Consultez la Licence
+#  General Public License for           Générale Publique GNU Affero
+#  more details.                        pour plus de détails.
+#
+#  You should have received             Vous devriez avoir reçu une
+#  a copy of the GNU Affero             copie de la Licence Générale
+#  General Public License along         Publique GNU Affero avec
+#  with OpenCADC.  If not, see          OpenCADC ; si ce n’est
+#  <http://www.gnu.org/licenses/>.      pas le cas, consultez :
+#                                       <http://www.gnu.org/licenses/>.
+#
+#  $Revision: 4 $
+#
+# ***********************************************************************
+#
+
+"""
+ Process-wide limit of the bandwidth used by the transfers.
+
+ All the bytes sent in the bodies of the requests and read from the bodies
+ of the responses of the sessions that mount a ThrottledAdapter draw tokens
+ from a single token bucket, so the combined rate of all the threads holds
+ regardless of how many are active. The bucket also measures the live rate.
+"""
+import collections
+import logging
+import threading
+import time
+
+from requests.adapters import HTTPAdapter
+
+# seconds over which the live rate is measured
+RATE_WINDOW = 5
+# seconds between the logs of the live rate
+RATE_LOG_INTERVAL = 30
+
+logger = logging.getLogger('vos')
+
+_bucket = None
+_bucket_lock = threading.Lock()
+
+
+class TokenBucket(object):
+    """
+    Token bucket with one token per byte. The bucket holds at most one
+    second worth of tokens. Consumers wait for the tokens they take, so a
+    large read delays the next consumers rather than exceeding the rate.
+    """
+    def __init__(self, rate):
+        """
+        :param rate: maximum rate in bytes/sec
+        """
+        self._lock = threading.Lock()
+        self._rate = None
+        self._tokens = 0
+        self._last = time.monotonic()
+        self._history = collections.deque()
+        self.rate = rate
+
+    @property
+    def rate(self):
+        """maximum rate in bytes/sec"""
+        return self._rate
+
+    @rate.setter
+    def rate(self, rate):
+        if rate <= 0:
+            raise ValueError('Invalid rate {}'.format(rate))
+        with self._lock:
+            self._rate = rate
+            self._tokens = min(self._tokens, rate)
+
+    def consume(self, nbytes):
+        """
+        Takes tokens for nbytes, waiting until they are available
+        :param nbytes: number of bytes transferred
+        """
+        if not nbytes:
+            return
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(
+                self._rate, self._tokens + (now - self._last) * self._rate)
+            self._last = now
+            self._tokens -= nbytes
+            delay = -self._tokens / self._rate if self._tokens < 0 else 0
+            self._history.append((now, nbytes))
+            self._expire(now)
+        if delay:
+            time.sleep(delay)
+
+    def current_rate(self):
+        """
+        :return: the rate of the last RATE_WINDOW seconds in bytes/sec
+        """
+        with self._lock:
+            self._expire(time.monotonic())
+            return sum([nbytes for _, nbytes in self._history]) / RATE_WINDOW
+
+    def _expire(self, now):
+        # only the reads of the last RATE_WINDOW seconds are kept
+        while self._history and self._history[0][0] < now - RATE_WINDOW:
+            self._history.popleft()
+
+
+class ThrottledReader(object):
+    """
+    File like object that draws tokens for the bytes read from the wrapped
+    file
+    """
+    def __init__(self, raw, bucket):
+        self._raw = raw
+        self._bucket = bucket
+
+    def read(self, *args, **kwargs):
+        data = self._raw.read(*args, **kwargs)
+        self._bucket.consume(len(data))
+        return data
+
+    def __iter__(self):
+        for data in self._raw:
+            self._bucket.consume(len(data))
+            yield data
+
+    def __getattr__(self, name):
+        return getattr(self._raw, name)
+
+
+class ThrottledAdapter(HTTPAdapter):
+    """
+    Transport adapter that limits the rate of the request and response
+    bodies to the rate of the process-wide bucket
+    """
+    def send(self, request, *args, **kwargs):
+        bucket = _bucket
+        if bucket is not None and hasattr(request.body, 'read') and \
+                not isinstance(request.body, ThrottledReader):
+            request.body = ThrottledReader(request.body, bucket)
+        response = super(ThrottledAdapter, self).send(request, *args,
+                                                      **kwargs)
+        if bucket is not None and response.raw is not None:
+            throttle_response(response.raw, bucket)
+        return response
+
+
+def throttle_response(raw, bucket):
+    """
+    Makes the reads of a urllib3 response draw tokens from the bucket
+    :param raw: the urllib3 response
+    :param bucket: the token bucket
+    """
+    read = raw.read
+    read_chunked = raw.read_chunked
+
+    def throttled_read(*args, **kwargs):
+        data = read(*args, **kwargs)
+        bucket.consume(len(data))
+        return data
+
+    def throttled_read_chunked(*args, **kwargs):
+        for data in read_chunked(*args, **kwargs):
+            bucket.consume(len(data))
+            yield data
+
+    raw.read = throttled_read
+    raw.read_chunked = throttled_read_chunked
+
+
+def set_max_rate(rate):
+    """
+    Sets the maximum rate of the transfers of the process
+    :param rate: maximum rate in bytes/sec. None removes the limit
+    """
+    global _bucket
+    with _bucket_lock:
+        if rate is None:
+            _bucket = None
+        elif _bucket is None:
+            _bucket = TokenBucket(rate)
+        else:
+            _bucket.rate = rate
+
+
+def get_max_rate():
+    """
+    :return: the maximum rate of the transfers of the process in bytes/sec,
+    None if not limited
+    """
+    bucket = _bucket
+    return None if bucket is None else bucket.rate
+
+
+def current_rate():
+    """
+    :return: the rate of the transfers of the last RATE_WINDOW seconds in
+    bytes/sec, None if the rate is not limited
+    """
+    bucket = _bucket
+    return None if bucket is None else bucket.current_rate()
+
+
+def throttle_session(session):
+    """
+    Mounts a ThrottledAdapter on a requests session
+    :param session: the session
+    """
+    for prefix in ('https://', 'http://'):
+        if not isinstance(session.adapters.get(prefix), ThrottledAdapter):
+            session.mount(prefix, ThrottledAdapter())
+
+
+def start_rate_log(interval=RATE_LOG_INTERVAL):
+    """
+    Logs the live rate of the transfers periodically from a daemon thread
+    :param interval: seconds between logs
+    :return: threading.Event to set to stop logging
+    """
+    stop = threading.Event()
+
+    def log_rate():
+        while not stop.wait(interval):
+            rate = current_rate()
+            if rate is not None:
+                logger.info('Transfer rate: {} kBytes/s (max {} kBytes/s)'.
+                            format(round(rate / 1024.0, 2),
+                                   round(get_max_rate() / 1024.0, 2)))
+
+    threading.Thread(target=log_rate, daemon=True).start()
+    return stop
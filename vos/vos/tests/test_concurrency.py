@@ -0,0 +1,184 @@
+# ***********************************************************************
+# ******************  CANADIAN ASTRONOMY DATA CENTRE  *******************
+# *************  CENTRE CANADIEN DE DONNÉES ASTRONOMIQUES  **************
+#
+#  (c) 2026.                            (c) 2026.
+#  Government of Canada                 Gouvernement du Canada
+#  National Research Council            Conseil national de recherches
+#  Ottawa, Canada, K1A 0R6              Ottawa, Canada, K1A 0R6
+#  All rights reserved                  Tous droits réservés
+#
+#  NRC disclaims any warranties,        Le CNRC dénie toute garantie
+#  expressed, implied, or               énoncée, implicite ou légale,
+#  statutory, of any kind with          de quelque nature que ce
+#  respect to the software,             soit, concernant le logiciel,
+#  including without limitation         y compris sans restriction
+#  any warranty of merchantability      toute garantie de valeur
+#  or fitness for a particular          marchande ou de pertinence
+#  purpose. NRC shall not be            pour un usage particulier.
+#  liable in any event for any          Le CNRC ne pourra en aucun cas
+#  damages, whether direct or           être tenu responsable de tout
+#  indirect, special or general,        dommage, direct ou indirect,
+#  consequential or incidental,         particulier ou général,
+#  arising from the use of the          accessoire ou fortuit, résultant
+#  software.  Neither the name          de l'utilisation du logiciel. Ni
+#  of the National Research             le nom du Conseil National de
+#  Council of Canada nor the            Recherches du Canada ni les noms
+#  names of its contributors may        de ses  participants ne peuvent
+#  be used to endorse or promote        être utilisés pour approuver ou
+#  products derived from this           promouvoir les produits dérivés
+#  software without specific prior      de ce logiciel sans autorisation
+#  written permission.                  préalable et particulière
+#                                       par écrit.
+#
+#  This file is part of the             Ce fichier fait partie du projet
+#  OpenCADC project.                    OpenCADC.
+#
+#  OpenCADC is free software:           OpenCADC est un logiciel libre ;
+#  you can redistribute it and/or       vous pouvez le redistribuer ou le
+#  modify it under the terms of         modifier suivant les termes de
+#  the GNU Affero General Public        la “GNU Affero General Public
+#  License as published by the          License” telle que publiée
+#  Free Software Foundation,            par la Free Software Foundation
+#  either version 3 of the              : soit la version 3 de cette
+#  License, or (at your option)         licence, soit (à votre gré)
+#  any later version.                   toute version ultérieure.
+#
+#  OpenCADC is distributed in the       OpenCADC est distribué
+#  hope that it will be useful,         dans l’espoir qu’il vous
+#  but WITHOUT ANY WARRANTY;            sera utile, mais SANS AUCUNE
+#  without even the implied             GARANTIE : sans même la garantie
+#  warranty of MERCHANTABILITY          implicite de COMMERCIALISABILITÉ
+#  or FITNESS FOR A PARTICULAR          ni d’ADÉQUATION À UN OBJECTIF
+#  PURPOSE.  See the GNU Affero         PARTICULIER. Consultez la Licence
+#  General Public License for           Générale Publique GNU Affero
+#  more details.                        pour plus de détails.
+#
+#  You should have received             Vous devriez avoir reçu une
+#  a copy of the GNU Affero             copie de la Licence Générale
+#  General Public License along         Publique GNU Affero avec
+#  with OpenCADC.  If not, see          OpenCADC ; si ce n’est
+#  <http://www.gnu.org/licenses/>.      pas le cas, consultez :
+#                                       <http://www.gnu.org/licenses/>.
+#
+#  $Revision: 4 $
+#
+# ***********************************************************************
+#
+
+# Test the AdaptiveConcurrency class
+import datetime
+import threading
+import unittest
+from unittest.mock import Mock, patch
+
+from vos.concurrency import AdaptiveConcurrency
+
+
+def response(status_code=200, elapsed=0.1, body=None,
+             content_type='text/xml'):
+    return Mock(status_code=status_code,
+                elapsed=datetime.timedelta(seconds=elapsed),
+                request=Mock(body=body),
+                headers={'Content-Type': content_type})
+
+
+class TestAdaptiveConcurrency(unittest.TestCase):
+    """Test the AdaptiveConcurrency class.
+    """
+
+    def complete_window(self, controller, nbytes, now):
+        with patch('vos.concurrency.time.time', return_value=now):
+            for _ in range(controller.limit):
+                controller.acquire()
+            for _ in range(controller.limit):
+                controller.release(nbytes)
+
+    def test_limits(self):
+        self.assertEqual(5, AdaptiveConcurrency(10).limit)
+        self.assertEqual(1, AdaptiveConcurrency(1).limit)
+        self.assertEqual(10, AdaptiveConcurrency(10, initial=20).limit)
+        self.assertEqual(3, AdaptiveConcurrency(10, initial=3).limit)
+
+    def test_increase(self):
+        with patch('vos.concurrency.time.time', return_value=0):
+            controller = AdaptiveConcurrency(4, initial=1)
+        # the first window increases the limit
+        self.complete_window(controller, 100, 1)
+        self.assertEqual(2, controller.limit)
+        # better throughput => increase
+        self.complete_window(controller, 100, 2)
+        self.assertEqual(3, controller.limit)
+        # same throughput => no increase
+        self.complete_window(controller, 200 / 3, 3)
+        self.assertEqual(3, controller.limit)
+        # up to the ceiling
+        self.complete_window(controller, 1000, 4)
+        self.assertEqual(4, controller.limit)
+        self.complete_window(controller, 10000, 5)
+        self.assertEqual(4, controller.limit)
+
+    def test_throttle(self):
+        controller = AdaptiveConcurrency(16, initial=16)
+        controller.response_hook(response(200))
+        self.assertEqual(16, controller.limit)
+        controller.response_hook(response(503))
+        self.assertEqual(8, controller.limit)
+        # once per window
+        controller.response_hook(response(504))
+        self.assertEqual(8, controller.limit)
+        with patch('vos.concurrency.time.time', return_value=1):
+            self.complete_window(controller, 100, 1)
+        # no increase in the window after a reduction
+        self.assertEqual(8, controller.limit)
+        controller.response_hook(response(408))
+        self.assertEqual(4, controller.limit)
+
+    def test_latency(self):
+        controller = AdaptiveConcurrency(16, initial=16)
+        for _ in range(10):
+            controller.response_hook(response(elapsed=0.1))
+        self.assertEqual(16, controller.limit)
+        # rising latency
+        for _ in range(10):
+            controller.response_hook(response(elapsed=1))
+        self.assertEqual(8, controller.limit)
+
+    def test_data_latency(self):
+        controller = AdaptiveConcurrency(16, initial=8)
+        # the time of the data transfers is not latency
+        for _ in range(20):
+            controller.response_hook(response(elapsed=0.05))
+            controller.response_hook(response(elapsed=2, body=Mock()))
+            controller.response_hook(response(elapsed=2, body=b'A' * 2 ** 20))
+            controller.response_hook(response(
+                elapsed=2, content_type='application/octet-stream'))
+        self.assertEqual(8, controller.limit)
+        # small documents posted are metadata
+        for _ in range(10):
+            controller.response_hook(response(elapsed=1, body='<xml/>'))
+        self.assertEqual(4, controller.limit)
+
+    def test_acquire(self):
+        controller = AdaptiveConcurrency(2, initial=1)
+        controller.acquire()
+        started = threading.Event()
+
+        def transfer():
+            controller.acquire()
+            started.set()
+
+        thread = threading.Thread(target=transfer)
+        thread.start()
+        self.assertFalse(started.wait(0.1))
+        controller.release(10)
+        self.assertTrue(started.wait(5))
+        thread.join()
+        self.assertEqual(1, controller.in_flight)
+
+
+def run():
+    suite1 = unittest.TestLoader().loadTestsFromTestCase(
+        TestAdaptiveConcurrency)
+    allTests = unittest.TestSuite([suite1])
+    return unittest.TextTestRunner(verbosity=2).run(allTests)
@@ -0,0 +1,145 @@
+# ***********************************************************************
+# ******************  CANADIAN ASTRONOMY DATA CENTRE  *******************
+# *************  CENTRE CANADIEN DE DONNÉES ASTRONOMIQUES  **************
+#
+#  (c) 2026.                            (c) 2026.
+#  Government of Canada                 Gouvernement du Canada
+#  National Research Council            Conseil national de recherches
+#  Ottawa, Canada, K1A 0R6              Ottawa, Canada, K1A 0R6
+#  All rights reserved                  Tous droits réservés
+#
+#  NRC disclaims any warranties,        Le CNRC dénie toute garantie
+#  expressed, implied, or               énoncée, implicite ou légale,
+#  statutory, of any kind with          de quelque nature que ce
+#  respect to the software,             soit, concernant le logiciel,
+#  including without limitation         y compris sans restriction
+#  any warranty of merchantability      toute garantie de valeur
+#  or fitness for a particular          marchande ou de pertinence
+#  purpose. NRC shall not be            pour un usage particulier.
+#  liable in any event for any          Le CNRC ne pourra en aucun cas
+#  damages, whether direct or           être tenu responsable de tout
+#  indirect, special or general,        dommage, direct ou indirect,
+#  consequential or incidental,         particulier ou général,
+#  arising from the use of the          accessoire ou fortuit, résultant
+#  software.  Neither the name          de l'utilisation du logiciel. Ni
+#  of the National Research             le nom du Conseil National de
+#  Council of Canada nor the            Recherches du Canada ni les noms
+#  names of its contributors may        de ses  participants ne peuvent
+#  be used to endorse or promote        être utilisés pour approuver ou
+#  products derived from this           promouvoir les produits dérivés
+#  software without specific prior      de ce logiciel sans autorisation
+#  written permission.                  préalable et particulière
+#                                       par écrit.
+#
+#  This file is part of the             Ce fichier fait partie du projet
+#  OpenCADC project.                    OpenCADC.
+#
+#  OpenCADC is free software:           OpenCADC est un logiciel libre ;
+#  you can redistribute it and/or       vous pouvez le redistribuer ou le
+#  modify it under the terms of         modifier suivant les termes de
+#  the GNU Affero General Public        la “GNU Affero General Public
+#  License as published by the          License” telle que publiée
+#  Free Software Foundation,            par la Free Software Foundation
+#  either version 3 of the              : soit la version 3 de cette
+#  License, or (at your option)         licence, soit (à votre gré)
+#  any later version.                   toute version ultérieure.
+#
+#  OpenCADC is distributed in the       OpenCADC est distribué
+#  hope that it will be useful,         dans l’espoir qu’il vous
+#  but WITHOUT ANY WARRANTY;            sera utile, mais SANS AUCUNE
+#  without even the implied             GARANTIE : sans même la garantie
+#  warranty of MERCHANTABILITY          implicite de COMMERCIALISABILITÉ
+#  or FITNESS FOR A PARTICULAR          ni d’ADÉQUATION À UN OBJECTIF
+#  PURPOSE.  See the GNU Affero         PARTICULIER. Consultez la Licence
+#  General Public License for           Générale Publique GNU Affero
+#  more details.                        pour plus de détails.
+#
+#  You should have received             Vous devriez avoir reçu une
+#  a copy of the GNU Affero             copie de la Licence Générale
+#  General Public License along         Publique GNU Affero avec
+#  with OpenCADC.  If not, see          OpenCADC ; si ce n’est
+#  <http://www.gnu.org/licenses/>.      pas le cas, consultez :
+#                                       <http://www.gnu.org/licenses/>.
+#
+#  $Revision: 4 $
+#
+# ***********************************************************************
+#
+
+# Test the DirectorySnapshots class
+import os
+import sqlite3
+import tempfile
+import unittest
+
+from vos.dir_snapshot import DirectorySnapshots
+
+
+class TestDirectorySnapshots(unittest.TestCase):
+    """Test the DirectorySnapshots class.
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.cache_db = os.path.join(self.tmp_dir.name, 'cache.db')
+        self.dir = os.path.join(self.tmp_dir.name, 'dir')
+        os.mkdir(self.dir)
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_snapshots(self):
+        snapshots = DirectorySnapshots(self.cache_db)
+        stat = os.stat(self.dir)
+        self.assertIsNone(snapshots.get(self.dir, stat))
+        entries = [('file1', False, 3, 1.5, 10, 20, 1500000000, 1600000000),
+                   ('sub', True, None, None, None, None, None, None)]
+        snapshots.update(self.dir, stat, entries)
+        self.assertEqual(entries, snapshots.get(self.dir, stat))
+        snapshots.close()
+
+        # the snapshots survive the process
+        snapshots = DirectorySnapshots(self.cache_db)
+        self.assertEqual(entries, snapshots.get(self.dir, stat))
+
+        # any change of the directory invalidates its snapshot
+        open(os.path.join(self.dir, 'file2'), 'w').write('ABC')
+        os.utime(self.dir, ns=(stat.st_atime_ns, stat.st_mtime_ns + 1))
+        new_stat = os.stat(self.dir)
+        self.assertIsNone(snapshots.get(self.dir, new_stat))
+        entries = entries[:1]
+        snapshots.update(self.dir, new_stat, entries)
+        self.assertEqual(entries, snapshots.get(self.dir, new_stat))
+        self.assertIsNone(snapshots.get(self.dir, stat))
+        snapshots.close()
+
+    def test_snapshots_migration(self):
+        # snapshots recorded without the fingerprint of the files
+        stat = os.stat(self.dir)
+        conn = sqlite3.connect(self.cache_db)
+        conn.execute(
+            "create table directories (path text PRIMARY KEY NOT NULL, "
+            "st_ino int NOT NULL, st_mtime_ns int NOT NULL, "
+            "entries int NOT NULL)")
+        conn.execute(
+            "create table directory_entries (directory text NOT NULL, "
+            "name text NOT NULL, is_dir int NOT NULL, st_size int, "
+            "st_mtime real, PRIMARY KEY (directory, name))")
+        conn.execute("INSERT INTO directories VALUES (?, ?, ?, 1)",
+                     (self.dir, stat.st_ino, stat.st_mtime_ns))
+        conn.execute("INSERT INTO directory_entries VALUES (?, ?, 0, 3, 1.5)",
+                     (self.dir, 'file1'))
+        conn.commit()
+        conn.close()
+        snapshots = DirectorySnapshots(self.cache_db)
+        self.assertEqual(
+            [('file1', False, 3, 1.5, None, None, None, None)],
+            snapshots.get(self.dir, stat))
+        snapshots.close()
+
+
+def run():
+    suite1 = unittest.TestLoader().loadTestsFromTestCase(
+        TestDirectorySnapshots)
+    allTests = unittest.TestSuite([suite1])
+    return unittest.TextTestRunner(verbosity=2).run(allTests)
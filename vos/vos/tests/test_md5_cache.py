@@ -67,12 +67,16 @@
 #
 
 # Test the NodeCache class
+import os
+import sqlite3
 import tempfile
+import threading
+import time
 import unittest
 import hashlib
 
-from vos.md5_cache import MD5Cache
-from unittest.mock import patch, MagicMock, call, mock_open
+from vos.md5_cache import MD5Cache, HashEngine, hash_file, sample_file
+from unittest.mock import patch, MagicMock, Mock, call, mock_open
 
 # The following is a temporary workaround for Python issue 25532
 # (https://bugs.python.org/issue25532)
@@ -90,39 +94,260 @@ class TestMD5Cache(unittest.TestCase):
         # test constructor
         sql_conn_mock = MagicMock()
         mock_sqlite3.return_value = sql_conn_mock
+        # no table of the previous versions to migrate
+        columns = {
+            'local_files': ['md5', 'st_size', 'st_mtime', 'st_dev', 'st_ino',
+                            'st_mtime_ns', 'st_ctime_ns', 'sample'],
+            'remote_nodes': ['md5', 'st_size', 'st_mtime']}
 
-        md5_cache = MD5Cache()
-        sql_conn_mock.execute.assert_called_once_with(
-            'create table if not exists md5_cache (filename text'
-            ' PRIMARY KEY NOT NULL , md5 text, st_size int, st_mtime int)')
+        def execute(sql, *args):
+            result = MagicMock()
+            result.fetchone.return_value = None
+            if sql.startswith('PRAGMA table_info'):
+                table = sql[len('PRAGMA table_info('):-1]
+                result.__iter__.return_value = [
+                    (i, column) for i, column in enumerate(columns[table])]
+            return result
 
-        # test delete
-        sql_conn_mock.reset_mock()
-        md5_cache.delete('somefile')
-        sql_conn_mock.execute.assert_called_once_with(
-            'DELETE from md5_cache WHERE filename = ?', ('somefile',))
+        sql_conn_mock.execute.side_effect = execute
 
-        # test update
+        md5_cache = MD5Cache(write_interval=60)
+        sql_conn_mock.execute.assert_has_calls([
+            call('PRAGMA journal_mode=WAL'),
+            call('BEGIN IMMEDIATE'),
+            call('create table if not exists local_files (parent text NOT '
+                 'NULL, name text NOT NULL, md5 text, st_size int, '
+                 'st_mtime int, st_dev int, st_ino int, st_mtime_ns int, '
+                 'st_ctime_ns int, sample int, PRIMARY KEY (parent, name)) '
+                 'WITHOUT ROWID'),
+            call('create table if not exists remote_nodes (parent text NOT '
+                 'NULL, name text NOT NULL, md5 text, st_size int, '
+                 'st_mtime int, PRIMARY KEY (parent, name)) WITHOUT ROWID')])
+        # the columns are all there
+        self.assertFalse([c for c in sql_conn_mock.execute.call_args_list
+                          if c[0][0].startswith('ALTER')])
+        sql_conn_mock.execute.side_effect = None
+        sql_conn_mock.commit.assert_called_once_with()
+
+        # test update and delete, written in a batch
         sql_conn_mock.reset_mock()
-        self.assertEqual(0x00123, md5_cache.update('somefile', 0x00123, 23,
-                                                   'Jan 01 2001'))
-        call1 = call('DELETE from md5_cache WHERE filename = ?', ('somefile',))
-        call2 = call(
-            'INSERT INTO md5_cache (filename, md5, st_size, st_mtime) '
-            'VALUES ( ?, ?, ?, ?)', ('somefile', 291, 23, 'Jan 01 2001'))
-        calls = [call1, call2]
-        sql_conn_mock.execute.assert_has_calls(calls)
+        self.assertEqual(0x00123, md5_cache.update('dir/somefile', 0x00123,
+                                                   23, 'Jan 01 2001'))
+        md5_cache.delete('vos:dir/otherfile', remote=True)
+        # pending updates are read back without a query
+        self.assertEqual((0x00123, 23, 'Jan 01 2001'),
+                         md5_cache.get('dir/somefile'))
+        self.assertIsNone(md5_cache.get_md5('dir/somefile', Mock()))
+        self.assertIsNone(md5_cache.get('vos:dir/otherfile', remote=True))
+        sql_conn_mock.execute.assert_not_called()
+        md5_cache.flush()
+        sql_conn_mock.executemany.assert_has_calls([
+            call('DELETE from local_files WHERE parent = ? AND name = ?',
+                 []),
+            call('INSERT INTO local_files (parent, name, md5, st_size, '
+                 'st_mtime, st_dev, st_ino, st_mtime_ns, st_ctime_ns, '
+                 'sample) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT '
+                 '(parent, name) DO UPDATE SET md5 = excluded.md5, st_size = '
+                 'excluded.st_size, st_mtime = excluded.st_mtime, st_dev = '
+                 'excluded.st_dev, st_ino = excluded.st_ino, st_mtime_ns = '
+                 'excluded.st_mtime_ns, st_ctime_ns = excluded.st_ctime_ns, '
+                 'sample = excluded.sample',
+                 [('dir', 'somefile', 291, 23, 'Jan 01 2001', None, None,
+                   None, None, None)]),
+            call('DELETE from remote_nodes WHERE parent = ? AND name = ?',
+                 [('vos:dir', 'otherfile')])])
 
         # test get
         sql_conn_mock.reset_mock()
         cursor_mock = MagicMock()
         cursor_mock.fetchone.return_value = ['0x0023', '23', 'Jan 01 2000']
         sql_conn_mock.execute.return_value = cursor_mock
-        self.assertEqual(cursor_mock.fetchone.return_value,
-                         md5_cache.get('somefile'))
+        self.assertEqual(tuple(cursor_mock.fetchone.return_value),
+                         md5_cache.get('vos:dir/somefile', remote=True))
+        sql_conn_mock.execute.assert_called_once_with(
+            'SELECT md5, st_size, st_mtime FROM remote_nodes '
+            'WHERE parent = ? AND name = ?', ('vos:dir', 'somefile'))
+
+        # test prefetch, one query for the directory
+        sql_conn_mock.reset_mock()
+        sql_conn_mock.execute.return_value = [
+            ('file1', '0x0001', 1, 'Jan 01 2000') + (None,) * 5,
+            ('file2', '0x0002', 2, 'Jan 01 2000') + (None,) * 5]
+        md5_cache.prefetch('dir')
+        md5_cache.prefetch('dir')
         sql_conn_mock.execute.assert_called_once_with(
-            'SELECT md5, st_size, st_mtime FROM md5_cache WHERE filename = ? ',
-            ('somefile',))
+            'SELECT name, md5, st_size, st_mtime, st_dev, st_ino, '
+            'st_mtime_ns, st_ctime_ns, sample FROM local_files '
+            'WHERE parent = ?', ('dir',))
+        self.assertEqual(('0x0002', 2, 'Jan 01 2000'),
+                         md5_cache.get('dir/file2'))
+        self.assertIsNone(md5_cache.get('dir/file3'))
+        # still a local file
+        self.assertEqual(('0x0001', 1, 'Jan 01 2000'),
+                         md5_cache.get(os.path.join('dir', 'file1')))
+        self.assertEqual(1, sql_conn_mock.execute.call_count)
+        md5_cache.close()
+
+    def test_prefetch(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        cache = MD5Cache(os.path.join(tmp_dir.name, 'cache.db'))
+        cache.update('dir/file1', 'md51', 1, 1)
+        cache.update('dir/file2', 'md52', 2, 2)
+        cache.update('vos:dir/file1', 'md5r', 3, 3, remote=True)
+        cache.flush()
+        cache.update('dir/file3', 'md53', 3, 3)
+        cache.prefetch('dir')
+        cache.prefetch('vos:dir/', remote=True)
+        # the local and remote namespaces are separate
+        self.assertEqual(('md51', 1, 1), cache.get('dir/file1'))
+        self.assertEqual(('md5r', 3, 3),
+                         cache.get('vos:dir/file1', remote=True))
+        self.assertIsNone(cache.get('vos:dir/file2', remote=True))
+        # the updates, pending or not, are seen in the prefetched entries
+        cache.flush()
+        self.assertEqual(('md53', 3, 3), cache.get('dir/file3'))
+        cache.delete('dir/file1')
+        cache.flush()
+        self.assertIsNone(cache.get('dir/file1'))
+        cache.close()
+        tmp_dir.cleanup()
+
+    def test_fingerprint(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        filename = os.path.join(tmp_dir.name, 'file')
+        open(filename, 'wb').write(b'ABCD' * 100)
+        stat = os.stat(filename)
+        for sample in [False, True]:
+            cache = MD5Cache(os.path.join(tmp_dir.name, 'cache.db'),
+                             sample=sample)
+            self.assertIsNone(cache.get_md5(filename, stat))
+            cache.update(filename, 'md5', stat.st_size, stat.st_mtime,
+                         stat=stat)
+            cache.flush()
+            self.assertEqual('md5', cache.get_md5(filename, stat))
+            self.assertEqual(('md5', stat.st_size, stat.st_mtime),
+                             cache.get(filename))
+            # any change of the stat is a change of the file
+            for field in ['st_dev', 'st_ino', 'st_size', 'st_mtime_ns',
+                          'st_ctime_ns']:
+                changed = Mock(**{name: getattr(stat, name) for name in [
+                    'st_dev', 'st_ino', 'st_size', 'st_mtime_ns',
+                    'st_ctime_ns']})
+                setattr(changed, field, getattr(stat, field) + 1)
+                self.assertIsNone(cache.get_md5(filename, changed))
+            # a rewrite keeping the stat is only noticed by the sample
+            open(filename, 'wb').write(b'ABCE' * 100)
+            self.assertEqual(None if sample else 'md5',
+                             cache.get_md5(filename, stat))
+            open(filename, 'wb').write(b'ABCD' * 100)
+            cache.delete(filename)
+            cache.close()
+        tmp_dir.cleanup()
+
+    def test_sample_file(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        filename = os.path.join(tmp_dir.name, 'file')
+        content = bytearray(b'A' * 100)
+        open(filename, 'wb').write(content)
+        sample = sample_file(filename, 100, sample_size=10)
+        # the middle of the file is not sampled
+        content[50] = ord('B')
+        open(filename, 'wb').write(content)
+        self.assertEqual(sample, sample_file(filename, 100, sample_size=10))
+        for index in [0, 95]:
+            changed = bytearray(content)
+            changed[index] = ord('B')
+            open(filename, 'wb').write(changed)
+            self.assertNotEqual(sample,
+                                sample_file(filename, 100, sample_size=10))
+        self.assertIsNone(sample_file(filename + '.missing', 100))
+        tmp_dir.cleanup()
+
+    def test_migration(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        cache_db = os.path.join(tmp_dir.name, 'node_cache.db')
+        sql_conn = sqlite3.connect(cache_db)
+        with sql_conn:
+            sql_conn.execute(
+                ("create table if not exists "
+                 "md5_cache (filename text PRIMARY KEY NOT NULL , "
+                 "md5 text, st_size int, st_mtime int)"))
+            sql_conn.executemany(
+                "INSERT INTO md5_cache VALUES (?, ?, ?, ?)",
+                [('/data/file1', 'md51', 1, 1),
+                 ('vos:user/data/file1', 'md5r', 2, 2),
+                 ('vos://cadc.nrc.ca~vault/user/file2', 'md52', 3, 3)])
+        sql_conn.close()
+        cache = MD5Cache(cache_db)
+        self.assertEqual(('md51', 1, 1), cache.get('/data/file1'))
+        self.assertIsNone(cache.get('vos:user/data/file1'))
+        self.assertEqual(('md5r', 2, 2),
+                         cache.get('vos:user/data/file1', remote=True))
+        self.assertEqual(('md52', 3, 3), cache.get(
+            'vos://cadc.nrc.ca~vault/user/file2', remote=True))
+        cache.close()
+        # migrated once
+        sql_conn = sqlite3.connect(cache_db)
+        self.assertIsNone(sql_conn.execute(
+            "SELECT name FROM sqlite_master WHERE name = 'md5_cache'"
+        ).fetchone())
+        sql_conn.close()
+        MD5Cache(cache_db).close()
+
+        # the tables without the fingerprint columns get them
+        cache_db = os.path.join(tmp_dir.name, 'cache.db')
+        sql_conn = sqlite3.connect(cache_db)
+        with sql_conn:
+            sql_conn.execute(
+                ("create table local_files (parent text NOT NULL, "
+                 "name text NOT NULL, md5 text, st_size int, st_mtime int, "
+                 "PRIMARY KEY (parent, name)) WITHOUT ROWID"))
+            sql_conn.execute(
+                "INSERT INTO local_files VALUES ('/data', 'file1', 'md51', "
+                "1, 1)")
+        sql_conn.close()
+        cache = MD5Cache(cache_db)
+        self.assertEqual(('md51', 1, 1), cache.get('/data/file1'))
+        # hashed again to record the fingerprint
+        self.assertIsNone(cache.get_md5('/data/file1', os.stat(cache_db)))
+        cache.close()
+        tmp_dir.cleanup()
+
+    def test_batched_writes(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        cache_db = os.path.join(tmp_dir.name, 'cache.db')
+        cache = MD5Cache(cache_db, batch_size=10, write_interval=60)
+        other = MD5Cache(cache_db)
+
+        def update(start):
+            for i in range(start, start + 25):
+                cache.update('file{}'.format(i), 'md5{}'.format(i), i, i)
+
+        threads = [threading.Thread(target=update, args=(start,))
+                   for start in range(0, 100, 25)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        for i in range(100):
+            self.assertEqual(('md5{}'.format(i), i, i),
+                             cache.get('file{}'.format(i)))
+        # full batches are written without waiting for the interval
+        for _ in range(100):
+            if other.get('file0') is not None:
+                break
+            time.sleep(0.05)
+        self.assertEqual(('md50', 0, 0), other.get('file0'))
+
+        cache.delete('file1')
+        cache.update('file2', 'new', 2, 3)
+        cache.close()
+        # the pending updates are written on close
+        self.assertIsNone(other.get('file1'))
+        self.assertEqual(('new', 2, 3), other.get('file2'))
+        self.assertEqual(('md599', 99, 99), other.get('file99'))
+        other.close()
+        tmp_dir.cleanup()
 
     def test_compute_md5(self):
         file_mock = MagicMock()
@@ -139,6 +364,46 @@ class TestMD5Cache(unittest.TestCase):
             self.assertEqual(expect_md5.hexdigest(),
                              cache.compute_md5('fakefile', 4))
 
+    def test_hash_file(self):
+        tmp_dir = tempfile.TemporaryDirectory()
+        filename = os.path.join(tmp_dir.name, 'file')
+        for size in [0, 3, 4, 10]:
+            content = os.urandom(size)
+            open(filename, 'wb').write(content)
+            self.assertEqual(hashlib.md5(content).hexdigest(),
+                             hash_file(filename, buffer_size=4))
+        tmp_dir.cleanup()
+
+    def check_engine(self, engine):
+        tmp_dir = tempfile.TemporaryDirectory()
+        expected = {}
+        for i in range(10):
+            filename = os.path.join(tmp_dir.name, 'file{}'.format(i))
+            content = os.urandom(i * 1000)
+            open(filename, 'wb').write(content)
+            expected[filename] = hashlib.md5(content).hexdigest()
+        try:
+            for filename in expected:
+                engine.prefetch(filename)
+            for filename, md5 in expected.items():
+                self.assertEqual(md5, engine.md5(filename))
+            # not prefetched
+            filename = os.path.join(tmp_dir.name, 'file1')
+            self.assertEqual(expected[filename], engine.md5(filename))
+            engine.prefetch(filename)
+            engine.discard(filename)
+            with self.assertRaises(FileNotFoundError):
+                engine.md5(os.path.join(tmp_dir.name, 'missing'))
+        finally:
+            engine.close()
+            tmp_dir.cleanup()
+
+    def test_hash_engine_threads(self):
+        self.check_engine(HashEngine(nthreads=3, buffer_size=256))
+
+    def test_hash_engine_processes(self):
+        self.check_engine(HashEngine(nprocesses=2, buffer_size=256))
+
 
 def run():
     suite1 = unittest.TestLoader().loadTestsFromTestCase(TestMD5Cache)
@@ -0,0 +1,195 @@
+# ***********************************************************************
+# ******************  CANADIAN ASTRONOMY DATA CENTRE  *******************
+# *************  CENTRE CANADIEN DE DONNÉES ASTRONOMIQUES  **************
+#
+#  (c) 2026.                            (c) 2026.
+#  Government of Canada                 Gouvernement du Canada
+#  National Research Council            Conseil national de recherches
+#  Ottawa, Canada, K1A 0R6              Ottawa, Canada, K1A 0R6
+#  All rights reserved                  Tous droits réservés
+#
+#  NRC disclaims any warranties,        Le CNRC dénie toute garantie
+#  expressed, implied, or               énoncée, implicite ou légale,
+#  statutory, of any kind with          de quelque nature que ce
+#  respect to the software,             soit, concernant le logiciel,
+#  including without limitation         y compris sans restriction
+#  any warranty of merchantability      toute garantie de valeur
+#  or fitness for a particular          marchande ou de pertinence
+#  purpose. NRC shall not be            pour un usage particulier.
+#  liable in any event for any          Le CNRC ne pourra en aucun cas
+#  damages, whether direct or           être tenu responsable de tout
+#  indirect, special or general,        dommage, direct ou indirect,
+#  consequential or incidental,         particulier ou général,
+#  arising from the use of the          accessoire ou fortuit, résultant
+#  software.  Neither the name          de l'utilisation du logiciel. Ni
+#  of the National Research             le nom du Conseil National de
+#  Council of Canada nor the            Recherches du Canada ni les noms
+#  names of its contributors may        de ses  participants ne peuvent
+#  be used to endorse or promote        être utilisés pour approuver ou
+#  products derived from this           promouvoir les produits dérivés
+#  software without specific prior      de ce logiciel sans autorisation
+#  written permission.                  préalable et particulière
+#                                       par écrit.
+#
+#  This file is part of the             Ce fichier fait partie du projet
+#  OpenCADC project.                    OpenCADC.
+#
+#  OpenCADC is free software:           OpenCADC est un logiciel libre ;
+#  you can redistribute it and/or       vous pouvez le redistribuer ou le
+#  modify it under the terms of         modifier suivant les termes de
+#  the GNU Affero General Public        la “GNU Affero General Public
+#  License as published by the          License” telle que publiée
+#  Free Software Foundation,            par la Free Software Foundation
+#  either version 3 of the              : soit la version 3 de cette
+#  License, or (at your option)         licence, soit (à votre gré)
+#  any later version.                   toute version ultérieure.
+#
+#  OpenCADC is distributed in the       OpenCADC est distribué
+#  hope that it will be useful,         dans l’espoir qu’il vous
+#  but WITHOUT ANY WARRANTY;            sera utile, mais SANS AUCUNE
+#  without even the implied             GARANTIE : sans même la garantie
+#  warranty of MERCHANTABILITY          implicite de COMMERCIALISABILITÉ
+#  or FITNESS FOR A PARTICULAR          ni d’ADÉQUATION À UN OBJECTIF
+#  PURPOSE.  See the GNU Affero         PARTICULIER. Consultez la Licence
+#  General Public License for           Générale Publique GNU Affero
+#  more details.                        pour plus de détails.
+#
+#  You should have received             Vous devriez avoir reçu une
+#  a copy of the GNU Affero             copie de la Licence Générale
+#  General Public License along         Publique GNU Affero avec
+#  with OpenCADC.  If not, see          OpenCADC ; si ce n’est
+#  <http://www.gnu.org/licenses/>.      pas le cas, consultez :
+#                                       <http://www.gnu.org/licenses/>.
+#
+#  $Revision: 4 $
+#
+# ***********************************************************************
+#
+
+# Test the rate_limit module
+import io
+import unittest
+from unittest.mock import Mock, patch
+
+import requests
+
+from vos import rate_limit
+from vos.rate_limit import TokenBucket, ThrottledReader, ThrottledAdapter
+
+
+class TestTokenBucket(unittest.TestCase):
+    """Test the TokenBucket class.
+    """
+
+    @patch('vos.rate_limit.time.sleep')
+    @patch('vos.rate_limit.time.monotonic')
+    def test_consume(self, monotonic_mock, sleep_mock):
+        monotonic_mock.return_value = 100
+        bucket = TokenBucket(1000)
+        # starts empty
+        bucket.consume(500)
+        sleep_mock.assert_called_once_with(0.5)
+        # the tokens owed by the first consumer delay the next one
+        sleep_mock.reset_mock()
+        bucket.consume(500)
+        sleep_mock.assert_called_once_with(1)
+        # tokens are replenished with time
+        sleep_mock.reset_mock()
+        monotonic_mock.return_value = 102
+        bucket.consume(500)
+        self.assertFalse(sleep_mock.called)
+        # up to one second worth of tokens
+        monotonic_mock.return_value = 200
+        bucket.consume(1000)
+        self.assertFalse(sleep_mock.called)
+        bucket.consume(1000)
+        sleep_mock.assert_called_once_with(1)
+
+        # live rate
+        self.assertEqual(2000 / rate_limit.RATE_WINDOW,
+                         bucket.current_rate())
+        monotonic_mock.return_value = 300
+        self.assertEqual(0, bucket.current_rate())
+        # the history is bounded even if the rate is never read
+        for i in range(100):
+            monotonic_mock.return_value = 400 + i
+            bucket.consume(1)
+        self.assertEqual(rate_limit.RATE_WINDOW + 1, len(bucket._history))
+
+        with self.assertRaises(ValueError):
+            bucket.rate = 0
+        bucket.rate = 10
+        self.assertEqual(10, bucket.rate)
+
+    def test_reader(self):
+        bucket = Mock()
+        reader = ThrottledReader(io.BytesIO(b'abcdef'), bucket)
+        self.assertEqual(b'abcd', reader.read(4))
+        bucket.consume.assert_called_once_with(4)
+        self.assertEqual(4, reader.tell())
+        self.assertEqual(b'ef', reader.read())
+        bucket.consume.assert_called_with(2)
+
+    def test_adapter(self):
+        bucket = Mock()
+        response = requests.Response()
+        response.raw = Mock()
+        response.raw.read.return_value = b'abc'
+        response.raw.read_chunked.return_value = iter([b'ab', b'c'])
+        request = Mock(body=io.BytesIO(b'content'))
+        with patch('vos.rate_limit._bucket', bucket), \
+                patch('vos.rate_limit.HTTPAdapter.send',
+                      return_value=response) as send_mock:
+            adapter = ThrottledAdapter()
+            self.assertEqual(response, adapter.send(request))
+            send_mock.assert_called_once_with(request)
+            # response bodies are throttled
+            self.assertEqual(b'abc', response.raw.read(3))
+            bucket.consume.assert_called_once_with(3)
+            bucket.reset_mock()
+            self.assertEqual([b'ab', b'c'], list(response.raw.read_chunked()))
+            self.assertEqual(2, bucket.consume.call_count)
+            # and request bodies, once when the request is resent
+            self.assertIsInstance(request.body, ThrottledReader)
+            body = request.body
+            send_mock.return_value = requests.Response()
+            adapter.send(request)
+            self.assertEqual(body, request.body)
+            bucket.reset_mock()
+            self.assertEqual(b'content', request.body.read())
+            bucket.consume.assert_called_once_with(7)
+
+        # no limit
+        request = Mock(body=io.BytesIO(b'content'))
+        with patch('vos.rate_limit.HTTPAdapter.send', return_value=response):
+            ThrottledAdapter().send(request)
+            self.assertIsInstance(request.body, io.BytesIO)
+
+    def test_max_rate(self):
+        try:
+            self.assertIsNone(rate_limit.get_max_rate())
+            self.assertIsNone(rate_limit.current_rate())
+            rate_limit.set_max_rate(100)
+            self.assertEqual(100, rate_limit.get_max_rate())
+            bucket = rate_limit._bucket
+            rate_limit.set_max_rate(200)
+            # the bucket is process wide
+            self.assertIs(bucket, rate_limit._bucket)
+            self.assertEqual(200, rate_limit.get_max_rate())
+            self.assertEqual(0, rate_limit.current_rate())
+
+            session = requests.Session()
+            rate_limit.throttle_session(session)
+            adapter = session.get_adapter('https://example.com')
+            self.assertIsInstance(adapter, ThrottledAdapter)
+            rate_limit.throttle_session(session)
+            self.assertIs(adapter, session.get_adapter('https://example.com'))
+        finally:
+            rate_limit.set_max_rate(None)
+        self.assertIsNone(rate_limit.get_max_rate())
+
+
+def run():
+    suite1 = unittest.TestLoader().loadTestsFromTestCase(TestTokenBucket)
+    allTests = unittest.TestSuite([suite1])
+    return unittest.TextTestRunner(verbosity=2).run(allTests)
@@ -0,0 +1,179 @@
+# ***********************************************************************
+# ******************  CANADIAN ASTRONOMY DATA CENTRE  *******************
+# *************  CENTRE CANADIEN DE DONNÉES ASTRONOMIQUES  **************
+#
+#  (c) 2026.                            (c) 2026.
+#  Government of Canada                 Gouvernement du Canada
+#  National Research Council            Conseil national de recherches
+#  Ottawa, Canada, K1A 0R6              Ottawa, Canada, K1A 0R6
+#  All rights reserved                  Tous droits réservés
+#
+#  NRC disclaims any warranties,        Le CNRC dénie toute garantie
+#  expressed, implied, or               énoncée, implicite ou légale,
+#  statutory, of any kind with          de quelque nature que ce
+#  respect to the software,             soit, concernant le logiciel,
+#  including without limitation         y compris sans restriction
+#  any warranty of merchantability      toute garantie de valeur
+#  or fitness for a particular          marchande ou de pertinence
+#  purpose. NRC shall not be            pour un usage particulier.
+#  liable in any event for any          Le CNRC ne pourra en aucun cas
+#  damages, whether direct or           être tenu responsable de tout
+#  indirect, special or general,        dommage, direct ou indirect,
+#  consequential or incidental,         particulier ou général,
+#  arising from the use of the          accessoire ou fortuit, résultant
+#  software.  Neither the name          de l'utilisation du logiciel. Ni
+#  of the National Research             le nom du Conseil National de
+#  Council of Canada nor the            Recherches du Canada ni les noms
+#  names of its contributors may        de ses  participants ne peuvent
+#  be used to endorse or promote        être utilisés pour approuver ou
+#  products derived from this           promouvoir les produits dérivés
+#  software without specific prior      de ce logiciel sans autorisation
+#  written permission.                  préalable et particulière
+#                                       par écrit.
+#
+#  This file is part of the             Ce fichier fait partie du projet
+#  OpenCADC project.                    OpenCADC.
+#
+#  OpenCADC is free software:           OpenCADC est un logiciel libre ;
+#  you can redistribute it and/or       vous pouvez le redistribuer ou le
+#  modify it under the terms of         modifier suivant les termes de
+#  the GNU Affero General Public        la “GNU Affero General Public
+#  License as published by the          License” telle que publiée
+#  Free Software Foundation,            par la Free Software Foundation
+#  either version 3 of the              : soit la version 3 de cette
+#  License, or (at your option)         licence, soit (à votre gré)
+#  any later version.                   toute version ultérieure.
+#
+#  OpenCADC is distributed in the       OpenCADC est distribué
+#  hope that it will be useful,         dans l’espoir qu’il vous
+#  but WITHOUT ANY WARRANTY;            sera utile, mais SANS AUCUNE
+#  without even the implied             GARANTIE : sans même la garantie
+#  warranty of MERCHANTABILITY          implicite de COMMERCIALISABILITÉ
+#  or FITNESS FOR A PARTICULAR          ni d’ADÉQUATION À UN OBJECTIF
+#  PURPOSE.  See the GNU Affero         PARTICULIER. Consultez la Licence
+#  General Public License for           Générale Publique GNU Affero
+#  more details.                        pour plus de détails.
+#
+#  You should have received             Vous devriez avoir reçu une
+#  a copy of the GNU Affero             copie de la Licence Générale
+#  General Public License along         Publique GNU Affero avec
+#  with OpenCADC.  If not, see          OpenCADC ; si ce n’est
+#  <http://www.gnu.org/licenses/>.      pas le cas, consultez :
+#                                       <http://www.gnu.org/licenses/>.
+#
+#  $Revision: 4 $
+#
+# ***********************************************************************
+#
+
+# Test the TransferJournal class
+import os
+import tempfile
+import unittest
+
+from vos import transfer_journal
+from vos.transfer_journal import TransferJournal, PLANNED, IN_FLIGHT, \
+    DONE, FAILED
+
+
+class TestTransferJournal(unittest.TestCase):
+    """Test the TransferJournal class.
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.journal_db = os.path.join(self.tmp_dir.name, 'journal.db')
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def test_states(self):
+        journal = TransferJournal(self.journal_db)
+        journal.start('job1')
+        self.assertFalse(journal.is_scanned('job1'))
+        self.assertEqual(PLANNED, journal.plan('job1', 'a', 'vos:a'))
+        self.assertEqual(PLANNED, journal.plan('job1', 'b', 'vos:b'))
+        self.assertEqual(PLANNED, journal.plan('job1', 'c', 'vos:c'))
+        self.assertEqual(PLANNED, journal.plan('job2', 'a', 'vos:a'))
+        journal.set_scanned('job1')
+        self.assertTrue(journal.is_scanned('job1'))
+        self.assertFalse(journal.is_scanned('job2'))
+
+        journal.update('job1', 'a', 'vos:a', DONE)
+        journal.update('job1', 'b', 'vos:b', IN_FLIGHT)
+        journal.update('job1', 'c', 'vos:c', FAILED)
+        # planning again keeps the state
+        self.assertEqual(DONE, journal.plan('job1', 'a', 'vos:a'))
+        journal.close()
+
+        # the journal survives the process
+        journal = TransferJournal(self.journal_db)
+        self.assertEqual([('b', 'vos:b')],
+                         list(journal.get('job1', [PLANNED, IN_FLIGHT])))
+        self.assertEqual([('c', 'vos:c')],
+                         list(journal.get('job1', [FAILED])))
+        self.assertEqual([('a', 'vos:a')],
+                         list(journal.get('job2', [PLANNED])))
+
+        # a new run forgets the previous one
+        journal.start('job1')
+        self.assertFalse(journal.is_scanned('job1'))
+        self.assertEqual([], list(journal.get(
+            'job1', [PLANNED, IN_FLIGHT, DONE, FAILED])))
+        self.assertEqual([('a', 'vos:a')],
+                         list(journal.get('job2', [PLANNED])))
+
+    def test_get_batches(self):
+        journal = TransferJournal(self.journal_db)
+        journal.start('job')
+        expected = []
+        for i in range(25):
+            journal.plan('job', 'src{}'.format(i), 'dest{}'.format(i))
+            expected.append(('src{}'.format(i), 'dest{}'.format(i)))
+        orig_batch_size = transfer_journal.BATCH_SIZE
+        transfer_journal.BATCH_SIZE = 10
+        try:
+            # in the planning order, while states are updated
+            result = []
+            for src, dest in journal.get('job', [PLANNED]):
+                journal.update('job', src, dest, DONE)
+                result.append((src, dest))
+            self.assertEqual(expected, result)
+            self.assertEqual([], list(journal.get('job', [PLANNED])))
+        finally:
+            transfer_journal.BATCH_SIZE = orig_batch_size
+
+    def test_summary(self):
+        journal = TransferJournal(self.journal_db)
+        self.assertIsNone(journal.summary('job'))
+        journal.start('job')
+        for name in ['a', 'b', 'c']:
+            journal.plan('job', name, 'vos:' + name)
+        journal.update('job', 'a', 'vos:a', DONE)
+        journal.update('job', 'b', 'vos:b', FAILED)
+        self.assertEqual({PLANNED: 1, IN_FLIGHT: 0, DONE: 1, FAILED: 1,
+                          'scanned': False}, journal.summary('job'))
+        journal.set_scanned('job')
+        self.assertTrue(journal.summary('job')['scanned'])
+
+    def test_stream_throughput(self):
+        journal = TransferJournal(self.journal_db)
+        self.assertIsNone(journal.stream_throughput())
+        journal.record_run('job1', 2, 10, 4000, 10.0)
+        journal.record_run('job2', 4, 5, 2000, 5.0)
+        # 6000 bytes in 40 stream seconds
+        self.assertEqual(150, journal.stream_throughput())
+
+        # only the recent runs count
+        orig_history_size = transfer_journal.HISTORY_SIZE
+        transfer_journal.HISTORY_SIZE = 1
+        try:
+            self.assertEqual(100, journal.stream_throughput())
+        finally:
+            transfer_journal.HISTORY_SIZE = orig_history_size
+
+
+def run():
+    suite1 = unittest.TestLoader().loadTestsFromTestCase(TestTransferJournal)
+    allTests = unittest.TestSuite([suite1])
+    return unittest.TextTestRunner(verbosity=2).run(allTests)
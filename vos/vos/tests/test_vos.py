@@ -68,10 +68,12 @@
 
 # Test the vos Client class
 
+import errno
 import os
 import unittest
 import pytest
 import requests
+import urllib3
 from xml.etree import ElementTree
 from unittest.mock import Mock, patch, MagicMock, call
 from vos import Client, Connection, Node, VOFile, vosconfig
@@ -80,6 +82,7 @@ from urllib.parse import urlparse, unquote
 from io import BytesIO
 import hashlib
 import tempfile
+import time
 
 
 # The following is a temporary workaround for Python issue 25532
@@ -562,6 +565,271 @@ class TestClient(unittest.TestCase):
                                                   method='GET',
                                                   cutout=None, view='header')
 
+    @patch('vos.vos.md5_cache.MD5Cache.compute_md5')
+    def test_copy_stream_md5(self, compute_md5_mock):
+        content = b'File content'
+        md5 = hashlib.md5(content).hexdigest()
+        tmp_file = tempfile.NamedTemporaryFile()
+        open(tmp_file.name, 'wb').write(content)
+        node = MagicMock(spec=Node)
+        node.props = {'MD5': 'beef', 'length': len(content)}
+
+        test_client = Client()
+        test_client.is_remote_file = Mock(side_effect=lambda x: ':' in x)
+        test_client.get_node = Mock(return_value=node)
+        test_client.get_node_url = Mock(
+            side_effect=lambda *args, **kwargs: ['https://cadc.ca/foo'])
+        test_client._get_si_client = Mock()
+        upload_mock = test_client._get_si_client.return_value.upload_file
+        upload_mock.return_value = ('foo', md5, len(content))
+
+        # same size on both sides but the source is not hashed beforehand
+        assert md5 == test_client.copy(tmp_file.name, 'vos:foo',
+                                       send_md5=True, stream_md5=True)
+        assert not compute_md5_mock.called
+        upload_mock.assert_called_once_with(url='https://cadc.ca/foo',
+                                            src=tmp_file.name,
+                                            md5_checksum=None)
+
+        # md5 known by the caller is passed along
+        upload_mock.reset_mock()
+        test_client.copy(tmp_file.name, 'vos:foo', stream_md5=True,
+                         md5_checksum=md5)
+        assert not compute_md5_mock.called
+        upload_mock.assert_called_once_with(url='https://cadc.ca/foo',
+                                            src=tmp_file.name,
+                                            md5_checksum=md5)
+
+        # structured details of the transfer
+        before = time.time()
+        result = test_client.copy(tmp_file.name, 'vos:foo', stream_md5=True,
+                                  transfer_result=True)
+        assert ('foo', md5, len(content)) == result[:3]
+        assert md5 == result.md5
+        assert len(content) == result.length
+        assert before <= result.timestamp <= time.time()
+
+    def test_add_response_hook(self):
+        test_client = Client()
+        endpoints = Mock()
+        endpoints.session.hooks = {'response': []}
+        test_client._endpoints = {'ivo://cadc.nrc.ca/vault': endpoints}
+        hook = Mock()
+        test_client.add_response_hook(hook)
+        self.assertEqual([hook], endpoints.session.hooks['response'])
+        # hooks are registered once per session
+        test_client.add_response_hook(hook)
+        self.assertEqual([hook], endpoints.session.hooks['response'])
+
+        # and with the sessions created afterwards
+        with patch('vos.vos.net.BaseDataClient') as data_client_mock:
+            session = data_client_mock.return_value._get_session.return_value
+            session.hooks = {'response': []}
+            test_client.get_endpoints = Mock(return_value=endpoints)
+            test_client._get_si_client('vos:foo')
+            self.assertEqual([hook], session.hooks['response'])
+
+    def test_max_rate_sessions(self):
+        test_client = Client()
+        endpoints = Mock()
+        endpoints.session = requests.Session()
+        test_client._endpoints = {'ivo://cadc.nrc.ca/vault': endpoints}
+        test_client._setup_sessions()
+        self.assertNotIsInstance(
+            endpoints.session.get_adapter('https://cadc.ca'),
+            vos.rate_limit.ThrottledAdapter)
+        try:
+            vos.rate_limit.set_max_rate(1000)
+            test_client._setup_sessions()
+            self.assertIsInstance(
+                endpoints.session.get_adapter('https://cadc.ca'),
+                vos.rate_limit.ThrottledAdapter)
+        finally:
+            vos.rate_limit.set_max_rate(None)
+
+    @patch('vos.vos.Connection', Mock())
+    def test_download_segments(self):
+        content = b'0123456789abcdefghijklmnopq'
+        md5 = hashlib.md5(content).hexdigest()
+
+        def get_vofile(url, conn, method, byte_range):
+            start, end = [int(i) for i in
+                          byte_range.replace('bytes=', '').split('-')]
+            response = Mock(status_code=206,
+                            raw=BytesIO(content[start:end + 1]))
+            return Mock(read=Mock(return_value=response))
+
+        test_client = Client()
+        test_client.get_endpoints = Mock()
+        tmp_dir = tempfile.TemporaryDirectory()
+        dest_file = os.path.join(tmp_dir.name, 'foo')
+        with patch('vos.vos.VOFile', Mock(side_effect=get_vofile)) as \
+                vofile_mock:
+            assert ('foo', md5, len(content)) == \
+                test_client._download_segments(
+                    'vos:foo', 'https://cadc.ca/foo', dest_file,
+                    len(content), md5, segments=3, segment_size=5)
+            assert content == open(dest_file, 'rb').read()
+            assert 6 == vofile_mock.call_count
+
+            assert not os.path.exists(dest_file + vos.PART_SUFFIX)
+            assert not os.path.exists(dest_file + vos.PART_SUFFIX + '.json')
+
+            # corrupted content is removed
+            with pytest.raises(OSError):
+                test_client._download_segments(
+                    'vos:foo', 'https://cadc.ca/foo', dest_file,
+                    len(content), 'beef', segments=3)
+            assert not os.path.exists(dest_file + vos.PART_SUFFIX)
+            os.remove(dest_file)
+
+            # resume a download with the first 10 bytes already downloaded
+            partial = vos.PartialDownload(dest_file, md5, len(content))
+            with open(partial.part_file, 'wb') as f:
+                f.write(content[:10] + b'-' * (len(content) - 10))
+            partial.update(0, 10)
+            vofile_mock.reset_mock()
+            test_client._download_segments(
+                'vos:foo', 'https://cadc.ca/foo', dest_file,
+                len(content), md5, segments=1)
+            assert content == open(dest_file, 'rb').read()
+            vofile_mock.assert_called_once_with(
+                'https://cadc.ca/foo', vos.Connection.return_value,
+                method='GET', byte_range='bytes=10-26')
+            os.remove(dest_file)
+
+            # the content of the node changed since the previous attempt
+            partial = vos.PartialDownload(dest_file, 'beef', len(content))
+            with open(partial.part_file, 'wb') as f:
+                f.write(b'-' * len(content))
+            partial.update(0, 10)
+            vofile_mock.reset_mock()
+            test_client._download_segments(
+                'vos:foo', 'https://cadc.ca/foo', dest_file,
+                len(content), md5, segments=1)
+            assert content == open(dest_file, 'rb').read()
+            vofile_mock.assert_called_once_with(
+                'https://cadc.ca/foo', vos.Connection.return_value,
+                method='GET', byte_range='bytes=0-26')
+            os.remove(dest_file)
+
+        # range not supported
+        response = Mock(status_code=200, raw=BytesIO(content))
+        with patch('vos.vos.VOFile',
+                   Mock(return_value=Mock(read=Mock(return_value=response)))):
+            with pytest.raises(vos.RangeNotSupported):
+                test_client._download_segments(
+                    'vos:foo', 'https://cadc.ca/foo', dest_file,
+                    len(content), md5, segments=2)
+            assert not os.path.exists(dest_file)
+            # partial download kept for a later attempt
+            assert os.path.exists(dest_file + vos.PART_SUFFIX)
+
+        # connection lost while reading a byte range
+        raw = Mock()
+        raw.read.side_effect = urllib3.exceptions.ProtocolError('Lost')
+        response = Mock(status_code=206, raw=raw)
+        with patch('vos.vos.VOFile',
+                   Mock(return_value=Mock(read=Mock(return_value=response)))):
+            with pytest.raises(vos.DownloadInterrupted) as ex:
+                test_client._download_segments(
+                    'vos:foo', 'https://cadc.ca/foo', dest_file,
+                    len(content), md5, segments=2)
+            assert errno.EIO == ex.value.errno
+            assert os.path.exists(dest_file + vos.PART_SUFFIX)
+
+        # copy uses segmented downloads for large files only
+        node = MagicMock(spec=Node)
+        node.props = {'MD5': md5, 'length': len(content)}
+        test_client.get_node = Mock(return_value=node)
+        test_client.get_node_url = Mock(return_value='https://cadc.ca/foo')
+        test_client.is_remote_file = Mock(side_effect=lambda x: ':' in x)
+        test_client._download_segments = Mock(
+            return_value=('foo', md5, len(content)))
+        test_client._get_si_client = Mock()
+        test_client.copy('vos:foo', dest_file, segments=2)
+        test_client._download_segments.assert_called_once_with(
+            'vos:foo', 'https://cadc.ca/foo', dest_file, len(content), md5,
+            2, None)
+        test_client.get_node.assert_called_once_with('vos:foo', force=True)
+        assert not test_client._get_si_client.called
+
+        # resume the download of a small file through the .part file
+        test_client._download_segments.reset_mock()
+        test_client.copy('vos:foo', dest_file)
+        test_client._download_segments.assert_called_once_with(
+            'vos:foo', 'https://cadc.ca/foo', dest_file, len(content), md5,
+            1, None)
+
+        # an interrupted download is not restarted from the start and its
+        # .part file is kept for the next attempt
+        test_client._download_segments.reset_mock()
+        test_client._download_segments.side_effect = \
+            vos.DownloadInterrupted(errno.EIO, 'Failed')
+        test_client._get_si_client.return_value.download_file.return_value = \
+            ('foo', md5, len(content))
+        with pytest.raises(OSError) as ex:
+            test_client.copy('vos:foo', dest_file)
+        assert errno.EIO == ex.value.errno
+        test_client._download_segments.assert_called_once()
+        assert not test_client._get_si_client.return_value.download_file.called
+        assert os.path.exists(dest_file + vos.PART_SUFFIX)
+
+        # single stream download when the server ignores the byte ranges,
+        # the obsolete .part file is removed
+        test_client._download_segments.reset_mock()
+        test_client._download_segments.side_effect = vos.RangeNotSupported(
+            errno.EIO, 'Failed')
+        test_client.copy('vos:foo', dest_file)
+        test_client._download_segments.assert_called_once()
+        assert test_client._get_si_client.return_value.download_file.called
+        assert not os.path.exists(dest_file + vos.PART_SUFFIX)
+
+        # corrupted content is not resumed but downloaded again in a single
+        # stream or from the other URLs. Not an EIO when they all fail.
+        test_client._download_segments.reset_mock()
+        test_client._download_segments.side_effect = OSError(
+            errno.EIO, 'Downloaded file is corrupted')
+        download_file = test_client._get_si_client.return_value.download_file
+        download_file.reset_mock()
+        download_file.side_effect = OSError(errno.EIO, 'Corrupted')
+        test_client.get_node_url = Mock(
+            side_effect=lambda *args, **kwargs:
+            [] if kwargs.get('full_negotiation') else 'https://cadc.ca/foo')
+        with pytest.raises(OSError) as ex:
+            test_client.copy('vos:foo', dest_file, segments=2)
+        assert errno.EFAULT == ex.value.errno
+        test_client._download_segments.assert_called_once()
+        assert download_file.called
+        test_client.get_node_url = Mock(return_value='https://cadc.ca/foo')
+        download_file.side_effect = None
+        download_file.reset_mock()
+
+        # small files are downloaded in one go, without looking up their
+        # node
+        assert not os.path.exists(dest_file + vos.PART_SUFFIX)
+        test_client.fix_uri = Mock(side_effect=lambda uri: uri)
+        test_client.get_node.reset_mock()
+        test_client._download_segments.reset_mock()
+        test_client._get_si_client.reset_mock()
+        test_client.copy('vos:foo', dest_file)
+        assert not test_client.get_node.called
+        assert not test_client._download_segments.called
+        assert test_client._get_si_client.return_value.download_file.called
+
+        # large according to the node already looked up by the caller
+        test_client._download_segments.reset_mock()
+        test_client._download_segments.side_effect = None
+        with patch('vos.vos.SEGMENTED_DOWNLOAD_THRESHOLD', 10), \
+                patch('vos.vos.nodeCache', {'vos:foo': node}):
+            test_client.copy('vos:foo', tmp_dir.name)
+            test_client._download_segments.assert_called_once_with(
+                'vos:foo', 'https://cadc.ca/foo', dest_file, len(content),
+                md5, vos.DEFAULT_DOWNLOAD_SEGMENTS, None)
+            # the MD5 checking the download is not taken from the cache
+            test_client.get_node.assert_called_once_with('vos:foo',
+                                                         force=True)
+
     def test_add_props(self):
         old_node = Node(ElementTree.fromstring(NODE_XML))
         old_node.uri = 'vos:sometest'
@@ -0,0 +1,169 @@
+# ***********************************************************************
+# ******************  CANADIAN ASTRONOMY DATA CENTRE  *******************
+# *************  CENTRE CANADIEN DE DONNÉES ASTRONOMIQUES  **************
+#
+#  (c) 2026.                            (c) 2026.
+#  Government of Canada                 Gouvernement du Canada
+#  National Research Council            Conseil national de recherches
+#  Ottawa, Canada, K1A 0R6              Ottawa, Canada, K1A 0R6
+#  All rights reserved                  Tous droits réservés
+#
+#  NRC disclaims any warranties,        Le CNRC dénie toute garantie
+#  expressed, implied, or               énoncée, implicite ou légale,
+#  statutory, of any kind with          de quelque nature que ce
+#  respect to the software,             soit, concernant le logiciel,
+#  including without limitation         y compris sans restriction
+#  any warranty of merchantability      toute garantie de valeur
+#  or fitness for a particular          marchande ou de pertinence
+#  purpose. NRC shall not be            pour un usage particulier.
+#  liable in any event for any          Le CNRC ne pourra en aucun cas
+#  damages, whether direct or           être tenu responsable de tout
+#  indirect, special or general,        dommage, direct ou indirect,
+#  consequential or incidental,         particulier ou général,
+#  arising from the use of the          accessoire ou fortuit, résultant
+#  software.  Neither the name          de l'utilisation du logiciel. Ni
+#  of the National Research             le nom du Conseil National de
+#  Council of Canada nor the            Recherches du Canada ni les noms
+#  names of its contributors may        de ses  participants ne peuvent
+#  be used to endorse or promote        être utilisés pour approuver ou
+#  products derived from this           promouvoir les produits dérivés
+#  software without specific prior      de ce logiciel sans autorisation
+#  written permission.                  préalable et particulière
+#                                       par écrit.
+#
+#  This file is part of the             Ce fichier fait partie du projet
+#  OpenCADC project.                    OpenCADC.
+#
+#  OpenCADC is free software:           OpenCADC est un logiciel libre ;
+#  you can redistribute it and/or       vous pouvez le redistribuer ou le
+#  modify it under the terms of         modifier suivant les termes de
+#  the GNU Affero General Public        la “GNU Affero General Public
+#  License as published by the          License” telle que publiée
+#  Free Software Foundation,            par la Free Software Foundation
+#  either version 3 of the              : soit la version 3 de cette
+#  License, or (at your option)         licence, soit (à votre gré)
+#  any later version.                   toute version ultérieure.
+#
+#  OpenCADC is distributed in the       OpenCADC est distribué
+#  hope that it will be useful,         dans l’espoir qu’il vous
+#  but WITHOUT ANY WARRANTY;            sera utile, mais SANS AUCUNE
+#  without even the implied             GARANTIE : sans même la garantie
+#  warranty of MERCHANTABILITY          implicite de COMMERCIALISABILITÉ
+#  or FITNESS FOR A PARTICULAR          ni d’ADÉQUATION À UN OBJECTIF
+#  PURPOSE.  See the GNU Affero         PARTICULIER. Consultez la Licence
+#  General Public License for           Générale Publique GNU Affero
+#  more details.                        pour plus de détails.
+#
+#  You should have received             Vous devriez avoir reçu une
+#  a copy of the GNU Affero             copie de la Licence Générale
+#  General Public License along         Publique GNU Affero avec
+#  with OpenCADC.  If not, see          OpenCADC ; si ce n’est
+#  <http://www.gnu.org/licenses/>.      pas le cas, consultez :
+#                                       <http://www.gnu.org/licenses/>.
+#
+#  $Revision: 4 $
+#
+# ***********************************************************************
+#
+
+# Test the watchers of directory trees
+import os
+import tempfile
+import unittest
+
+from vos import watch
+
+
+class TestDebouncer(unittest.TestCase):
+    """Test the Debouncer class.
+    """
+
+    def test_debouncer(self):
+        debouncer = watch.Debouncer(2)
+        self.assertIsNone(debouncer.next_ready())
+        debouncer.add(['a', 'b'], now=10)
+        debouncer.add(['c'], now=11)
+        self.assertEqual(12, debouncer.next_ready())
+        self.assertEqual([], debouncer.ready(now=11.5))
+        # a file still written is held back
+        debouncer.add(['a'], now=11.5)
+        self.assertEqual(['b'], debouncer.ready(now=12))
+        self.assertEqual(['c', 'a'], debouncer.ready(now=14))
+        self.assertEqual([], debouncer.ready(now=20))
+        self.assertIsNone(debouncer.next_ready())
+
+
+class TestWatchers(unittest.TestCase):
+    """Test the InotifyWatcher and PollingWatcher classes.
+    """
+
+    def setUp(self):
+        self.tmp_dir = tempfile.TemporaryDirectory()
+        self.root = self.tmp_dir.name
+        os.mkdir(os.path.join(self.root, 'sub'))
+        os.mkdir(os.path.join(self.root, 'pruned'))
+
+    def tearDown(self):
+        self.tmp_dir.cleanup()
+
+    def prune(self, path):
+        return os.path.basename(path) == 'pruned'
+
+    def collect(self, watcher, expected):
+        changed = set()
+        for _ in range(20):
+            paths, lost = watcher.changes(0.1)
+            self.assertFalse(lost)
+            changed.update(paths)
+            if expected <= changed:
+                break
+        return changed
+
+    def check_watcher(self, watcher):
+        try:
+            self.assertEqual(([], False), watcher.changes(0))
+            file1 = os.path.join(self.root, 'sub', 'file1')
+            open(file1, 'w').write('ABC')
+            open(os.path.join(self.root, 'pruned', 'file2'), 'w').write('A')
+            new_dir = os.path.join(self.root, 'new')
+            os.makedirs(os.path.join(new_dir, 'deep'))
+            file3 = os.path.join(new_dir, 'deep', 'file3')
+            open(file3, 'w').write('ABC')
+            expected = {file1, new_dir, os.path.join(new_dir, 'deep'),
+                        file3}
+            self.assertEqual(expected, self.collect(watcher, expected))
+
+            # the new directories are watched as well
+            file4 = os.path.join(new_dir, 'deep', 'file4')
+            open(file4, 'w').write('ABC')
+            self.assertEqual({file4}, self.collect(watcher, {file4}))
+        finally:
+            watcher.close()
+
+    def test_polling_watcher(self):
+        self.check_watcher(watch.PollingWatcher(
+            [self.root], prune=self.prune, interval=0.1))
+
+    def test_inotify_watcher(self):
+        try:
+            watcher = watch.InotifyWatcher([self.root], prune=self.prune)
+        except OSError as ex:
+            self.skipTest('inotify not available: {}'.format(ex))
+        self.check_watcher(watcher)
+
+    def test_not_recursive(self):
+        watcher = watch.watcher([self.root], recursive=False)
+        try:
+            open(os.path.join(self.root, 'sub', 'file1'), 'w').write('ABC')
+            file2 = os.path.join(self.root, 'file2')
+            open(file2, 'w').write('ABC')
+            self.assertEqual({file2}, self.collect(watcher, {file2}))
+        finally:
+            watcher.close()
+
+
+def run():
+    suite1 = unittest.TestLoader().loadTestsFromTestCase(TestDebouncer)
+    suite2 = unittest.TestLoader().loadTestsFromTestCase(TestWatchers)
+    allTests = unittest.TestSuite([suite1, suite2])
+    return unittest.TextTestRunner(verbosity=2).run(allTests)
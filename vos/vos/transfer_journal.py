@@ -0,0 +1,267 @@
+# ***********************************************************************
+# ******************  CANADIAN ASTRONOMY DATA CENTRE  *******************
+# *************  CENTRE CANADIEN DE DONNÉES ASTRONOMIQUES  **************
+#
+#  (c) 2026.                            (c) 2026.
+#  Government of Canada                 Gouvernement du Canada
+#  National Research Council            Conseil national de recherches
+#  Ottawa, Canada, K1A 0R6              Ottawa, Canada, K1A 0R6
+#  All rights reserved                  Tous droits réservés
+#
+#  NRC disclaims any warranties,        Le CNRC dénie toute garantie
+#  expressed, implied, or               énoncée, implicite ou légale,
+#  statutory, of any kind with          de quelque nature que ce
+#  respect to the software,             soit, concernant le logiciel,
+#  including without limitation         y compris sans restriction
+#  any warranty of merchantability      toute garantie de valeur
+#  or fitness for a particular          marchande ou de pertinence
+#  purpose. NRC shall not be            pour un usage particulier.
+#  liable in any event for any          Le CNRC ne pourra en aucun cas
+#  damages, whether direct or           être tenu responsable de tout
+#  indirect, special or general,        dommage, direct ou indirect,
+#  consequential or incidental,         particulier ou général,
+#  arising from the use of the          accessoire ou fortuit, résultant
+#  software.  Neither the name          de l'utilisation du logiciel. Ni
+#  of the National Research             le nom du Conseil National de
+#  Council of Canada nor the            Recherches du Canada ni les noms
+#  names of its contributors may        de ses  participants ne peuvent
+#  be used to endorse or promote        être utilisés pour approuver ou
+#  products derived from this           promouvoir les produits dérivés
+#  software without specific prior      de ce logiciel sans autorisation
+#  written permission.                  préalable et particulière
+#                                       par écrit.
+#
+#  This file is part of the             Ce fichier fait partie du projet
+#  OpenCADC project.                    OpenCADC.
+#
+#  OpenCADC is free software:           OpenCADC est un logiciel libre ;
+#  you can redistribute it and/or       vous pouvez le redistribuer ou le
+#  modify it under the terms of         modifier suivant les termes de
+#  the GNU Affero General Public        la “GNU Affero General Public
+#  License as published by the          License” telle que publiée
+#  Free Software Foundation,            par la Free Software Foundation
+#  either version 3 of the              : soit la version 3 de cette
+#  License, or (at your option)         licence, soit (à votre gré)
+#  any later version.                   toute version ultérieure.
+#
+#  OpenCADC is distributed in the       OpenCADC est distribué
+#  hope that it will be useful,         dans l’espoir qu’il vous
+#  but WITHOUT ANY WARRANTY;            sera utile, mais SANS AUCUNE
+#  without even the implied             GARANTIE : sans même la garantie
+#  warranty of MERCHANTABILITY          implicite de COMMERCIALISABILITÉ
+#  or FITNESS FOR A PARTICULAR          ni d’ADÉQUATION À UN OBJECTIF
+#  PURPOSE.  See the GNU Affero         PARTICULIER. Consultez la Licence
+#  General Public License for           Générale Publique GNU Affero
+#  more details.                        pour plus de détails.
+#
+#  You should have received             Vous devriez avoir reçu une
+#  a copy of the GNU Affero             copie de la Licence Générale
+#  General Public License along         Publique GNU Affero avec
+#  with OpenCADC.  If not, see          OpenCADC ; si ce n’est
+#  <http://www.gnu.org/licenses/>.      pas le cas, consultez :
+#                                       <http://www.gnu.org/licenses/>.
+#
+#  $Revision: 4 $
+#
+# ***********************************************************************
+#
+
+"""
+ A journal of the transfers of a sync job.
+
+ Every (source, destination) pair of a job is recorded as planned when it is
+ scanned, in-flight while it is transferred and done or failed at the end of
+ its transfer. The journal survives the interruption of the job, so the
+ next run can continue with the transfers that did not complete or retry
+ only those that failed instead of checking every file again.
+
+ The volume and duration of the completed runs are kept as well to estimate
+ the duration of the next ones.
+"""
+import sqlite3
+import threading
+
+PLANNED = 'planned'
+IN_FLIGHT = 'in-flight'
+DONE = 'done'
+FAILED = 'failed'
+
+# number of entries read from the db at once
+BATCH_SIZE = 1000
+# number of recent runs the throughput is estimated from
+HISTORY_SIZE = 10
+
+
+class TransferJournal:
+    def __init__(self, journal_db):
+        """Setup the sqlDB that will contain the journal tables.
+
+        :param journal_db: The path and filename where the SQL db will be
+        stored.
+        """
+        self.journal_db = journal_db
+        self._lock = threading.Lock()
+        # the connection is shared by the transfer threads
+        self._conn = sqlite3.connect(self.journal_db,
+                                     check_same_thread=False)
+        with self._lock, self._conn:
+            # losing the last updates in a crash is fine: the corresponding
+            # transfers are repeated
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                ("create table if not exists "
+                 "jobs (job text PRIMARY KEY NOT NULL, scanned int)"))
+            self._conn.execute(
+                ("create table if not exists "
+                 "transfers (job text NOT NULL, src text NOT NULL, "
+                 "dest text NOT NULL, state text NOT NULL, "
+                 "PRIMARY KEY (job, src, dest))"))
+            self._conn.execute(
+                ("create table if not exists "
+                 "runs (job text NOT NULL, nstreams int NOT NULL, "
+                 "files int NOT NULL, bytes int NOT NULL, "
+                 "duration real NOT NULL)"))
+
+    def start(self, job):
+        """Start a new run of a job, forgetting the previous runs.
+
+        :param job: identifier of the job
+        """
+        with self._lock, self._conn:
+            self._conn.execute("DELETE from transfers WHERE job = ?", (job,))
+            self._conn.execute(
+                "INSERT OR REPLACE INTO jobs (job, scanned) VALUES (?, 0)",
+                (job,))
+
+    def set_scanned(self, job):
+        """Record that all the transfers of a job have been planned.
+
+        :param job: identifier of the job
+        """
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO jobs (job, scanned) VALUES (?, 1)",
+                (job,))
+
+    def is_scanned(self, job):
+        """Check if all the transfers of a job have been planned.
+
+        :param job: identifier of the job
+        :return: True if the job has been fully scanned, False otherwise
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT scanned FROM jobs WHERE job = ?", (job,)).fetchone()
+        return row is not None and bool(row[0])
+
+    def plan(self, job, src, dest):
+        """Record a transfer of a job, keeping the state of an already
+        recorded transfer.
+
+        :param job: identifier of the job
+        :param src: source of the transfer
+        :param dest: destination of the transfer
+        :return: the state of the transfer
+        """
+        with self._lock, self._conn:
+            self._conn.execute(
+                ("INSERT OR IGNORE INTO transfers (job, src, dest, state) "
+                 "VALUES (?, ?, ?, ?)"), (job, src, dest, PLANNED))
+            return self._conn.execute(
+                ("SELECT state FROM transfers "
+                 "WHERE job = ? AND src = ? AND dest = ?"),
+                (job, src, dest)).fetchone()[0]
+
+    def update(self, job, src, dest, state):
+        """Update the state of a transfer.
+
+        :param job: identifier of the job
+        :param src: source of the transfer
+        :param dest: destination of the transfer
+        :param state: new state of the transfer
+        """
+        with self._lock, self._conn:
+            self._conn.execute(
+                ("UPDATE transfers SET state = ? "
+                 "WHERE job = ? AND src = ? AND dest = ?"),
+                (state, job, src, dest))
+
+    def get(self, job, states):
+        """Generator of the transfers of a job in a given state, in the
+        order they were planned.
+
+        :param job: identifier of the job
+        :param states: the states of the transfers to return
+        :return: (src, dest) of the transfers
+        """
+        last = 0
+        query = ("SELECT rowid, src, dest FROM transfers "
+                 "WHERE job = ? AND rowid > ? AND state IN ({}) "
+                 "ORDER BY rowid LIMIT ?").format(
+                     ', '.join('?' * len(states)))
+        while True:
+            with self._lock:
+                rows = self._conn.execute(
+                    query, (job, last) + tuple(states) +
+                    (BATCH_SIZE,)).fetchall()
+            for rowid, src, dest in rows:
+                yield src, dest
+            if len(rows) < BATCH_SIZE:
+                break
+            last = rows[-1][0]
+
+    def summary(self, job):
+        """Summary of the state of a job.
+
+        :param job: identifier of the job
+        :return: dictionary with the number of transfers in each state and
+        whether the job was fully scanned, None if the job is not in the
+        journal
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT scanned FROM jobs WHERE job = ?", (job,)).fetchone()
+            if row is None:
+                return None
+            counts = dict(self._conn.execute(
+                ("SELECT state, count(*) FROM transfers WHERE job = ? "
+                 "GROUP BY state"), (job,)).fetchall())
+        summary = {state: counts.get(state, 0)
+                   for state in (PLANNED, IN_FLIGHT, DONE, FAILED)}
+        summary['scanned'] = bool(row[0])
+        return summary
+
+    def record_run(self, job, nstreams, files, nbytes, duration):
+        """Record the volume and duration of a completed run.
+
+        :param job: identifier of the job
+        :param nstreams: number of streams of the run
+        :param files: number of files transferred
+        :param nbytes: number of bytes transferred
+        :param duration: duration of the run in seconds
+        """
+        with self._lock, self._conn:
+            self._conn.execute(
+                ("INSERT INTO runs (job, nstreams, files, bytes, duration) "
+                 "VALUES (?, ?, ?, ?, ?)"),
+                (job, nstreams, files, nbytes, duration))
+
+    def stream_throughput(self):
+        """Throughput of a single stream over the recent runs of all the
+        jobs.
+
+        :return: throughput in bytes/sec or None without history
+        """
+        with self._lock:
+            row = self._conn.execute(
+                ("SELECT sum(bytes), sum(duration * nstreams) FROM "
+                 "(SELECT * FROM runs ORDER BY rowid DESC LIMIT ?)"),
+                (HISTORY_SIZE,)).fetchone()
+        if not row[0] or not row[1]:
+            return None
+        return row[0] / row[1]
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1 @@
+version = 'vos 3.6.3'
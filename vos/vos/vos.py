@@ -74,11 +74,15 @@
 
 import warnings
 import copy
+from collections import namedtuple
 import errno
 from datetime import datetime
 import fnmatch
 from enum import Enum
 import hashlib
+import json
+import threading
+import concurrent.futures
 
 try:
     from cStringIO import StringIO
@@ -86,6 +90,7 @@ except ImportError:
     from io import StringIO
 import requests
 from requests.exceptions import HTTPError
+import urllib3
 import html2text
 import logging
 import mimetypes
@@ -106,6 +111,7 @@ except ImportError:
     version = "unknown"
 from cadcutils import net, exceptions, util
 from . import md5_cache
+from . import rate_limit
 
 from urllib.parse import urlparse, parse_qs
 logger = logging.getLogger('vos')
@@ -123,6 +129,24 @@ MAX_RETRY_DELAY = 128  # maximum delay between retries
 DEFAULT_RETRY_DELAY = 30
 MAX_RETRY_TIME = 900  # maximum time for retries before giving up...
 MAX_INTERMTTENT_RETRIES = 3
+# data nodes larger than this are downloaded as byte ranges fetched in
+# parallel (segmented download)
+SEGMENTED_DOWNLOAD_THRESHOLD = 2 * 1024 ** 3
+DEFAULT_DOWNLOAD_SEGMENTS = 4  # parallel connections of a segmented download
+MIN_DOWNLOAD_SEGMENT_SIZE = 64 * 1024 ** 2
+# downloads of data nodes larger than this can be resumed: bytes are written
+# to <dest>.part and the progress to a <dest>.part.json sidecar
+RESUMABLE_DOWNLOAD_THRESHOLD = 64 * 1024 ** 2
+DOWNLOAD_CHECKPOINT_SIZE = 64 * 1024 ** 2  # bytes between progress saves
+PART_SUFFIX = '.part'
+# errors of a connection lost or timed out while the bytes of a byte range
+# are read. The download is resumed by the next attempt.
+DOWNLOAD_READ_ERRORS = (ConnectionError, TimeoutError,
+                        requests.exceptions.ConnectionError,
+                        requests.exceptions.ChunkedEncodingError,
+                        requests.exceptions.Timeout,
+                        urllib3.exceptions.ProtocolError,
+                        urllib3.exceptions.ReadTimeoutError)
 
 VOSPACE_ARCHIVE = os.getenv("VOSPACE_ARCHIVE", "vospace")
 HEADER_DELEG_TOKEN = 'X-CADC-DelegationToken'
@@ -169,6 +193,12 @@ CADC_VO_VIEWS = {'data': '{}#data'.format(VO_CADC_VIEW_URI),
 # md5sum of a size zero file
 ZERO_MD5 = 'd41d8cd98f00b204e9800998ecf8427e'
 
+# details of a completed transfer returned by Client.copy: the name, MD5 and
+# length of the transferred file and the time (seconds since epoch) the
+# transfer completed at
+TransferResult = namedtuple('TransferResult',
+                            ['name', 'md5', 'length', 'timestamp'])
+
 
 # Pattern matching in filenames to extract out the RA/DEC/RADIUS part
 FILENAME_PATTERN_MAGIC = re.compile(
@@ -1519,6 +1549,32 @@ class Client(object):
         self.insecure = insecure
         self._fs_type = True  # True - file system type (cavern), False - db type (vault)
         self._si_client = None
+        self._response_hooks = []
+
+    def add_response_hook(self, hook):
+        """Registers a function called with every HTTP response received by
+        the client, including the responses to requests retried internally.
+
+        :param hook: requests response hook, i.e. a function called with the
+        response as its first argument
+        """
+        self._response_hooks.append(hook)
+        self._setup_sessions()
+
+    def _setup_sessions(self):
+        # applies the response hooks and the rate limit to the sessions
+        # created so far
+        for endpoints in self._endpoints.values():
+            self._setup_session(endpoints.session)
+        if self._si_client:
+            self._setup_session(self._si_client._get_session())
+
+    def _setup_session(self, session):
+        for hook in self._response_hooks:
+            if hook not in session.hooks['response']:
+                session.hooks['response'].append(hook)
+        if rate_limit.get_max_rate():
+            rate_limit.throttle_session(session)
 
     def glob(self, pathname):
         """Return a list of paths matching a pathname pattern.
@@ -1705,6 +1761,8 @@ class Client(object):
                     raise AttributeError(
                         'No service with resource ID {} found in registry or '
                         'the config file'.format(resource_id))
+            if self._response_hooks or rate_limit.get_max_rate():
+                self._setup_session(self._endpoints[resource_id].session)
         return self._endpoints[resource_id]
 
     def get_session(self, uri):
@@ -1722,11 +1780,130 @@ class Client(object):
                                                  host=ep.conn.ws_client.host,
                                                  insecure=self.insecure,
                                                  server_versions=SUPPORTED_SERVER_VERSIONS)
+            if self._response_hooks or rate_limit.get_max_rate():
+                self._setup_session(self._si_client._get_session())
         return self._si_client
 
+    def _download_segments(self, source, url, dest_file, size, md5,
+                           segments, segment_size=None):
+        """Download a data node as byte ranges fetched in parallel.
+
+        Bytes are written at their offset in a preallocated <dest>.part file
+        while the progress is saved in a sidecar so that an interrupted
+        download is resumed by the next call, unless the MD5 of the node has
+        changed in the meantime. The content is checked against the MD5 of
+        the node before the file is renamed to its final name.
+
+        :param source: the VOSpace uri of the node
+        :param url: the URL of the bytes of the node
+        :param dest_file: name of the local file to write to
+        :param size: size of the node
+        :param md5: MD5 of the node. No check nor resume when None.
+        :param segments: number of parallel connections to use
+        :param segment_size: size of the byte ranges. By default, the file is
+        evenly split across the connections.
+        :return: (file name, md5, size) of the downloaded file
+        """
+        if not segment_size:
+            segment_size = size if segments == 1 else max(
+                -(-size // segments), MIN_DOWNLOAD_SEGMENT_SIZE)
+        partial = PartialDownload(dest_file, md5, size)
+        resumed = partial.resume()
+        ranges = partial.pending(segment_size)
+        if resumed:
+            logger.info('Resuming download of {} ({} of {} bytes '
+                        'left)'.format(source,
+                                       sum([e - s + 1 for s, e in ranges]),
+                                       size))
+        logger.debug('Downloading {} in {} byte ranges over {} '
+                     'connections'.format(source, len(ranges), segments))
+        endpoints = self.get_endpoints(source)
+        # each thread gets its own connection/session
+        thread_local = threading.local()
+
+        def get_range(fd, start, end):
+            if not hasattr(thread_local, 'conn'):
+                thread_local.conn = Connection(
+                    vospace_certfile=self.vospace_certfile,
+                    vospace_token=self.vospace_token,
+                    resource_id=endpoints.resource_id,
+                    insecure=self.insecure)
+                if self._response_hooks or rate_limit.get_max_rate():
+                    self._setup_session(thread_local.conn.session)
+            vofile = VOFile(url, thread_local.conn, method='GET',
+                            byte_range='bytes={}-{}'.format(start, end))
+            try:
+                response = vofile.read(return_response=True)
+            except exceptions.TransferException as ex:
+                # intermittent error of the service
+                raise DownloadInterrupted(
+                    errno.EIO, 'Failed to get byte range {}-{} of {}: '
+                    '{}'.format(start, end, url, str(ex))) from ex
+            if response.status_code != 206:
+                raise RangeNotSupported(errno.EIO,
+                                        'Byte range requests not supported '
+                                        'by {} (status {})'.format(
+                                            url, response.status_code))
+            offset = start
+            checkpoint = start
+            try:
+                while offset <= end:
+                    buf = response.raw.read(min(BUFSIZE, end - offset + 1))
+                    if not buf:
+                        break
+                    os.pwrite(fd, buf, offset)
+                    offset += len(buf)
+                    if offset - checkpoint >= DOWNLOAD_CHECKPOINT_SIZE:
+                        partial.update(start, offset)
+                        checkpoint = offset
+            except DOWNLOAD_READ_ERRORS as ex:
+                raise DownloadInterrupted(
+                    errno.EIO, 'Byte range {}-{} of {} interrupted: '
+                    '{}'.format(start, end, url, str(ex))) from ex
+            finally:
+                partial.update(start, offset)
+            if offset != end + 1:
+                raise DownloadInterrupted(
+                    errno.EIO, 'Incomplete byte range {}-{} of {}: got {} '
+                    'bytes'.format(start, end, url, offset - start))
+
+        fd = os.open(partial.part_file, os.O_RDWR | os.O_CREAT, 0o666)
+        try:
+            if not resumed:
+                try:
+                    os.posix_fallocate(fd, 0, size)
+                except (AttributeError, OSError):
+                    # not available on the platform or the file system
+                    os.ftruncate(fd, size)
+                partial.save()
+            with concurrent.futures.ThreadPoolExecutor(
+                    max_workers=segments) as executor:
+                futures = [executor.submit(get_range, fd, start, end)
+                           for start, end in ranges]
+                try:
+                    for future in concurrent.futures.as_completed(futures):
+                        future.result()
+                except BaseException:
+                    for future in futures:
+                        future.cancel()
+                    raise
+        finally:
+            os.close(fd)
+        if md5:
+            dest_md5 = md5_cache.MD5Cache.compute_md5(partial.part_file,
+                                                      block_size=BUFSIZE)
+            if dest_md5 != md5:
+                partial.discard()
+                raise OSError(errno.EIO,
+                              'Downloaded file is corrupted: expected md5({})'
+                              ' != actual md5({})'.format(md5, dest_md5))
+        partial.commit()
+        return os.path.basename(dest_file), md5, size
+
     # @logExceptions()
     def copy(self, source, destination, send_md5=False, disposition=False,
-             head=None):
+             head=None, segments=None, segment_size=None, stream_md5=False,
+             md5_checksum=None, transfer_result=False, max_rate=None):
         """copy from source to destination.
 
         One of source or destination must be a vospace location and the other
@@ -1746,12 +1923,45 @@ class Client(object):
         :type disposition: bool
         :param head: Return just the headers of a file.
         :type head: bool
+        :param segments: Number of parallel connections used to download a
+        data node as byte ranges. By default, DEFAULT_DOWNLOAD_SEGMENTS are
+        used for nodes larger than SEGMENTED_DOWNLOAD_THRESHOLD. 1 turns off
+        segmented downloads. Downloads of nodes larger than
+        RESUMABLE_DOWNLOAD_THRESHOLD go through a <dest>.part file and are
+        resumed by a subsequent call if interrupted. Without segments, the
+        size of the node is only known, and these defaults only apply, if
+        the node was looked up (get_node) before the copy.
+        :type segments: int
+        :param segment_size: Size of the byte ranges in a segmented download.
+        By default, the node is evenly split between the connections.
+        :type segment_size: int
+        :param stream_md5: Upload the source in a single pass, i.e. compute
+        its MD5 while the bytes are sent rather than reading the file once
+        before the transfer. The content is checked against the MD5 returned
+        by the service. Because the source is not hashed first, the upload
+        is not skipped when the destination has the same content.
+        :type stream_md5: bool
+        :param md5_checksum: MD5 of the source when already known by the
+        caller. It is sent to the service along with the bytes.
+        :type md5_checksum: str
+        :param transfer_result: Return a TransferResult with the name, MD5
+        and length of the transferred file as reported by the transfer
+        itself, so that no additional request is needed to learn them.
+        :type transfer_result: bool
+        :param max_rate: Limit the bandwidth of the transfers to max_rate
+        bytes/sec. The limit is process-wide: it is shared by the transfers
+        of all the threads and clients and remains in effect for subsequent
+        transfers (see vos.rate_limit).
+        :type max_rate: int
         :raises When a network problem occurs, it raises one of the
         HttpException exceptions declared in the
         cadcutils.exceptions module
 
         """
         # TODO: handle vospace to vospace copies.
+        if max_rate is not None:
+            rate_limit.set_max_rate(max_rate)
+            self._setup_sessions()
 
         success = False
         copy_failed_message = ""
@@ -1803,14 +2013,78 @@ class Client(object):
                                           view=view)
             if isinstance(files_url, list) and len(files_url) > 0:
                 files_url = files_url.pop(0)
-            try:
-                transf_file = self._get_si_client(source).download_file(
-                    url=files_url, dest=destination,
-                    params=self._get_soda_params(view=view, cutout=cutout))
-                success = True
-            except Exception as e:
-                # not much to do but to fall through with full negotiation
-                logger.debug('GET fail on files endpoint for {}'.format(source), e)
+            partial_dest = None
+            if view == 'data' and files_url:
+                # large files are downloaded over parallel connections
+                # and/or resumable
+                ranged = False
+                try:
+                    dest_file = destination
+                    if os.path.isdir(dest_file):
+                        dest_file = os.path.join(
+                            dest_file,
+                            os.path.basename(urlparse(source).path))
+                    resuming = os.path.isfile(dest_file + PART_SUFFIX)
+                    lookup = (segments or 1) > 1 or resuming
+                    if not lookup:
+                        # large enough according to the node already
+                        # looked up by the caller
+                        cached_node = nodeCache[self.fix_uri(source)]
+                        lookup = cached_node is not None and int(
+                            cached_node.props.get('length', 0) or 0) > min(
+                                SEGMENTED_DOWNLOAD_THRESHOLD,
+                                RESUMABLE_DOWNLOAD_THRESHOLD)
+                    if lookup:
+                        # the node is looked up only when the download can
+                        # be ranged, afresh as its MD5 checks the content
+                        src_node = self.get_node(source, force=True)
+                        src_size = int(src_node.props.get('length', 0) or 0)
+                        if not segments:
+                            segments = DEFAULT_DOWNLOAD_SEGMENTS \
+                                if src_size > SEGMENTED_DOWNLOAD_THRESHOLD \
+                                else 1
+                        ranged = bool(src_size) and (
+                            segments > 1 or
+                            src_size > RESUMABLE_DOWNLOAD_THRESHOLD or
+                            resuming)
+                except Exception as e:
+                    # fall through to the single stream download
+                    logger.warning(
+                        'Ranged download of {} failed: {}'.format(
+                            source, str(e)))
+                if ranged:
+                    partial_dest = dest_file
+                    try:
+                        transf_file = self._download_segments(
+                            source, files_url, dest_file, src_size,
+                            src_node.props.get('MD5', None),
+                            segments, segment_size)
+                        partial_dest = None
+                        success = True
+                    except DownloadInterrupted as e:
+                        # the .part file is kept for the next attempt to
+                        # resume the download
+                        raise OSError(
+                            errno.EIO,
+                            'Download of {} interrupted, the next attempt '
+                            'resumes it: {}'.format(source, str(e)))
+                    except Exception as e:
+                        # byte ranges not supported, HTTP error or corrupted
+                        # content: fall through to the single stream and
+                        # the other URLs
+                        logger.warning(
+                            'Ranged download of {} failed: {}'.format(
+                                source, str(e)))
+            if not success:
+                try:
+                    transf_file = self._get_si_client(source).download_file(
+                        url=files_url, dest=destination,
+                        params=self._get_soda_params(view=view, cutout=cutout))
+                    success = True
+                except Exception as e:
+                    # not much to do but to fall through with full negotiation
+                    logger.debug('GET fail on files endpoint for {}: {}'.format(
+                        source, str(e)))
 
             if not success:
                 # at this point it's probably time to check whether the node is actually empty
@@ -1859,8 +2133,13 @@ class Client(object):
                     logging.debug("Failed to GET {0}: {1}{2}".format(
                         get_url, str(ex), msg))
                     continue
+            if success and partial_dest:
+                # the .part file of a failed ranged download is obsolete
+                # once the single stream download succeeded
+                PartialDownload(partial_dest).discard()
         else:
             # PUT
+            retried_urls = {}
             success = False
             dest_size = None
             destination_node = None
@@ -1886,7 +2165,7 @@ class Client(object):
                 self.create(destination)
                 transf_file = os.path.basename(destination), ZERO_MD5, 0
                 success = True
-            elif src_size == dest_size:
+            elif src_size == dest_size and not stream_md5:
                 if dest_node_md5 is not None:
                     # compute the md5 of the source file. This serves 2
                     # purposes:
@@ -1894,7 +2173,8 @@ class Client(object):
                     #   avoid sending the bytes again.
                     #   2. send info to the service so that it can recover in case
                     #   the bytes got corrupted on the way
-                    src_md5 = md5_cache.MD5Cache.compute_md5(source)
+                    src_md5 = md5_checksum or \
+                        md5_cache.MD5Cache.compute_md5(source)
                     if src_md5 == dest_node_md5:
                         logger.info('Source and destination identical for {}. Skip transfer!'.format(source))
                         # post the node so that the modify time is updated
@@ -1902,7 +2182,11 @@ class Client(object):
                         transf_file = os.path.basename(destination), dest_node_md5, dest_size
                         success = True
             if not success:
-                # transfer the bytes with source md5 available
+                if src_md5 is None:
+                    src_md5 = md5_checksum
+                # transfer the bytes with source md5 available. Without it
+                # the md5 is computed while the bytes are uploaded and
+                # checked against the md5 returned by the service
                 while not success:
                     if not get_node_url_retried:
                         put_urls = self.get_node_url(
@@ -1945,6 +2229,8 @@ class Client(object):
             logger.info('Transfer successful')
         if transf_file is None:
             raise RuntimeError('BUG: Not found details of successful transfer')
+        if transfer_result:
+            return TransferResult(*transf_file, time.time())
         if disposition and transf_file:
             return transf_file[0]  # file name
         if send_md5 and transf_file:
@@ -2679,13 +2965,16 @@ class Client(object):
             else:
                 raise RuntimeError('Unknown job phase: ' + phase)
 
-    def get_children_info(self, uri, sort=None, order=None, force=False):
+    def get_children_info(self, uri, sort=None, order=None, force=False,
+                          limit=None):
         """Returns an iterator over tuples of (NodeName, Info dict)
         :param uri: the Node to get info about.
         :param sort: node property to sort on (vos.NodeProperty)
         :param order: order of sorting: 'asc' - default or 'desc'
         :param force: if True force the read from server otherwise use local
         cache
+        :param limit: list the children in pages of limit nodes. None to
+        list them all in one request
         """
         uri = self.fix_uri(uri)
         logger.debug(str(uri))
@@ -2701,7 +2990,7 @@ class Client(object):
         if node.type in ["vos:DataNode", "vos:LinkNode"]:
             return [node]
         else:
-            return node.get_children(self, sort, order, None)
+            return node.get_children(self, sort, order, limit)
 
     def get_info_list(self, uri):
         """Retrieve a list of tuples of (NodeName, Info dict).
@@ -2843,6 +3132,109 @@ class Client(object):
     #                   follow_redirect=False).read()
 
 
+class RangeNotSupported(OSError):
+    """
+    The server does not honour the byte range requests of a segmented
+    download
+    """
+
+
+class DownloadInterrupted(OSError):
+    """
+    The connection of a byte range was lost or timed out. The bytes written
+    so far are kept for the next attempt.
+    """
+
+
+class PartialDownload(object):
+    """
+    Keeps track of the byte ranges of a data node that have already been
+    written to the <dest>.part file of a download. The ranges are saved,
+    along with the MD5 and length of the node, in a <dest>.part.json sidecar
+    which allows a subsequent download to only fetch the missing ranges.
+    """
+
+    def __init__(self, dest_file, md5=None, size=None):
+        self.dest_file = dest_file
+        self.part_file = dest_file + PART_SUFFIX
+        self.sidecar_file = self.part_file + '.json'
+        self.md5 = md5
+        self.size = size
+        self._done = []  # [start, end] of the completed ranges
+        self._progress = {}  # start -> next offset of ranges in progress
+        self._lock = threading.Lock()
+
+    def resume(self):
+        """
+        Loads the progress of a previous download of the same content.
+        Leftovers of downloads of a different content are removed.
+        :return: True if the download can be resumed, False otherwise
+        """
+        try:
+            with open(self.sidecar_file, 'r') as f:
+                info = json.load(f)
+            if self.md5 and info['md5'] == self.md5 and \
+                    info['length'] == self.size and \
+                    os.stat(self.part_file).st_size == self.size:
+                self._done = [[int(start), int(end)]
+                              for start, end in info['ranges']]
+                return True
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+        self.discard()
+        return False
+
+    def pending(self, segment_size):
+        """
+        :param segment_size: maximum size of the returned ranges
+        :return: list of (start, end) byte ranges still to be downloaded
+        """
+        result = []
+        offset = 0
+        for start, end in sorted(self._done) + [[self.size, self.size]]:
+            while offset < start:
+                range_end = min(offset + segment_size, start)
+                result.append((offset, range_end - 1))
+                offset = range_end
+            offset = max(offset, end + 1)
+        return result
+
+    def update(self, start, offset):
+        """
+        Records the progress of the range starting at start and saves it.
+        :param start: start of the range
+        :param offset: offset of the next byte to write in the range
+        """
+        with self._lock:
+            self._progress[start] = offset
+            self._save()
+
+    def save(self):
+        with self._lock:
+            self._save()
+
+    def _save(self):
+        ranges = self._done + [[start, offset - 1] for start, offset in
+                               self._progress.items() if offset > start]
+        tmp_file = self.sidecar_file + '.tmp'
+        with open(tmp_file, 'w') as f:
+            json.dump({'md5': self.md5, 'length': self.size,
+                       'ranges': ranges}, f)
+        os.replace(tmp_file, self.sidecar_file)
+
+    def commit(self):
+        """Renames the completed .part file to its final name."""
+        os.replace(self.part_file, self.dest_file)
+        if os.path.exists(self.sidecar_file):
+            os.remove(self.sidecar_file)
+
+    def discard(self):
+        """Removes the .part file and its sidecar."""
+        for f in [self.part_file, self.sidecar_file]:
+            if os.path.exists(f):
+                os.remove(f)
+
+
 class Md5File(object):
     """
     A wrapper to a file object that calculates the MD5 sum of the bytes
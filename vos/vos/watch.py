@@ -0,0 +1,354 @@
+# ***********************************************************************
+# ******************  CANADIAN ASTRONOMY DATA CENTRE  *******************
+# *************  CENTRE CANADIEN DE DONNÉES ASTRONOMIQUES  **************
+#
+#  (c) 2026.                            (c) 2026.
+#  Government of Canada                 Gouvernement du Canada
+#  National Research Council            Conseil national de recherches
+#  Ottawa, Canada, K1A 0R6              Ottawa, Canada, K1A 0R6
+#  All rights reserved                  Tous droits réservés
+#
+#  NRC disclaims any warranties,        Le CNRC dénie toute garantie
+#  expressed, implied, or               énoncée, implicite ou légale,
+#  statutory, of any kind with          de quelque nature que ce
+#  respect to the software,             soit, concernant le logiciel,
+#  including without limitation         y compris sans restriction
+#  any warranty of merchantability      toute garantie de valeur
+#  or fitness for a particular          marchande ou de pertinence
+#  purpose. NRC shall not be            pour un usage particulier.
+#  liable in any event for any          Le CNRC ne pourra en aucun cas
+#  damages, whether direct or           être tenu responsable de tout
+#  indirect, special or general,        dommage, direct ou indirect,
+#  consequential or incidental,         particulier ou général,
+#  arising from the use of the          accessoire ou fortuit, résultant
+#  software.  Neither the name          de l'utilisation du logiciel. Ni
+#  of the National Research             le nom du Conseil National de
+#  Council of Canada nor the            Recherches du Canada ni les noms
+#  names of its contributors may        de ses  participants ne peuvent
+#  be used to endorse or promote        être utilisés pour approuver ou
+#  products derived from this           promouvoir les produits dérivés
+#  software without specific prior      de ce logiciel sans autorisation
+#  written permission.                  préalable et particulière
+#                                       par écrit.
+#
+#  This file is part of the             Ce fichier fait partie du projet
+#  OpenCADC project.                    OpenCADC.
+#
+#  OpenCADC is free software:           OpenCADC est un logiciel libre ;
+#  you can redistribute it and/or       vous pouvez le redistribuer ou le
+#  modify it under the terms of         modifier suivant les termes de
+#  the GNU Affero General Public        la “GNU Affero General Public
+#  License as published by the          License” telle que publiée
+#  Free Software Foundation,            par la Free Software Foundation
+#  either version 3 of the              : soit la version 3 de cette
+#  License, or (at your option)         licence, soit (à votre gré)
+#  any later version.                   toute version ultérieure.
+#
+#  OpenCADC is distributed in the       OpenCADC est distribué
+#  hope that it will be useful,         dans l’espoir qu’il vous
+#  but WITHOUT ANY WARRANTY;            sera utile, mais SANS AUCUNE
+#  without even the implied             GARANTIE : sans même la garantie
+#  warranty of MERCHANTABILITY          implicite de COMMERCIALISABILITÉ
+#  or FITNESS FOR A PARTICULAR          ni d’ADÉQUATION À UN OBJECTIF
+#  PURPOSE.  See the GNU Affero         PARTICULIER. Consultez la Licence
+#  General Public License for           Générale Publique GNU Affero
+#  more details.                        pour plus de détails.
+#
+#  You should have received             Vous devriez avoir reçu une
+#  a copy of the GNU Affero             copie de la Licence Générale
+#  General Public License along         Publique GNU Affero avec
+#  with OpenCADC.  If not, see          OpenCADC ; si ce n’est
+#  <http://www.gnu.org/licenses/>.      pas le cas, consultez :
+#                                       <http://www.gnu.org/licenses/>.
+#
+#  $Revision: 4 $
+#
+# ***********************************************************************
+#
+
+
+"""
+ Watchers of the changes of local directory trees.
+
+ InotifyWatcher gets the events of the Linux kernel through inotify, called
+ with ctypes. PollingWatcher, for the other systems or when inotify cannot
+ watch the trees, compares periodic scans of the trees. Both report the
+ paths of the files and directories created or modified.
+
+ The writers of a file can keep writing into it for a while: Debouncer
+ holds the changed paths back until they have not changed for some time.
+"""
+import ctypes
+import ctypes.util
+import errno
+import logging
+import os
+import select
+import struct
+import time
+
+# inotify(7) events
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+WATCH_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_TO | IN_CREATE
+# struct inotify_event without its name
+EVENT_HEADER = struct.Struct('iIII')
+READ_SIZE = 2 ** 16
+
+# seconds between the scans of the polling watcher
+POLL_INTERVAL = 10
+
+
+def _libc():
+    libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    if not hasattr(libc, 'inotify_init1'):
+        raise OSError(errno.ENOSYS, 'inotify is not supported')
+    return libc
+
+
+def _raise_errno(path=None):
+    error = ctypes.get_errno()
+    raise OSError(error, os.strerror(error), path)
+
+
+class InotifyWatcher(object):
+    """
+    Watches directory trees with Linux inotify. The changes made since the
+    creation of the watcher are reported, including those of the
+    directories created after it.
+    """
+    def __init__(self, roots, recursive=True, prune=None):
+        """
+        :param roots: the directories to watch
+        :param recursive: True to watch the subdirectories as well
+        :param prune: function telling whether a directory is left out with
+        its content, None to watch all of them
+        :raises OSError: if inotify is not available or cannot watch all the
+        directories
+        """
+        self.recursive = recursive
+        self.prune = prune
+        self._libc = _libc()
+        self._fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self._fd < 0:
+            _raise_errno()
+        self._paths = {}
+        try:
+            for root in roots:
+                self._add_tree(root, None)
+        except OSError:
+            self.close()
+            raise
+
+    def changes(self, timeout):
+        """
+        Waits for changes
+        :param timeout: maximum time to wait in seconds
+        :return: (paths, lost) with paths the list of the files and
+        directories created or modified and lost True if the kernel dropped
+        events, in which case any file can have changed
+        """
+        readable, _, _ = select.select([self._fd], [], [], timeout)
+        if not readable:
+            return [], False
+        try:
+            data = os.read(self._fd, READ_SIZE)
+        except BlockingIOError:
+            return [], False
+        changed = []
+        lost = False
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = os.fsdecode(data[offset:offset + length].rstrip(b'\0'))
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                lost = True
+                continue
+            if mask & IN_IGNORED:
+                # the directory was removed
+                self._paths.pop(wd, None)
+                continue
+            directory = self._paths.get(wd)
+            if directory is None or not name:
+                continue
+            path = os.path.join(directory, name)
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO) and self.recursive and \
+                        not (self.prune and self.prune(path)):
+                    changed.append(path)
+                    # the files written before the watch started
+                    self._add_tree(path, changed)
+            else:
+                changed.append(path)
+        return changed, lost
+
+    def close(self):
+        os.close(self._fd)
+
+    def _add_tree(self, root, changed):
+        directories = [root]
+        while directories:
+            directory = directories.pop()
+            wd = self._libc.inotify_add_watch(
+                self._fd, os.fsencode(directory), WATCH_MASK)
+            if wd < 0:
+                if changed is not None and \
+                        ctypes.get_errno() in (errno.ENOENT, errno.ENOTDIR):
+                    # removed in the meantime
+                    continue
+                _raise_errno(directory)
+            self._paths[wd] = directory
+            try:
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            if self.recursive and not \
+                                    (self.prune and self.prune(entry.path)):
+                                if changed is not None:
+                                    changed.append(entry.path)
+                                directories.append(entry.path)
+                        elif changed is not None:
+                            changed.append(entry.path)
+            except OSError:
+                if changed is None:
+                    raise
+
+
+class PollingWatcher(object):
+    """
+    Watches directory trees by scanning them every interval seconds
+    """
+    def __init__(self, roots, recursive=True, prune=None,
+                 interval=POLL_INTERVAL):
+        """
+        :param roots: the directories to watch
+        :param recursive: True to watch the subdirectories as well
+        :param prune: function telling whether a directory is left out with
+        its content, None to watch all of them
+        :param interval: seconds between the scans
+        """
+        self.roots = roots
+        self.recursive = recursive
+        self.prune = prune
+        self.interval = interval
+        self._state = self._scan()
+        self._next_scan = time.monotonic() + interval
+
+    def changes(self, timeout):
+        """
+        Waits for changes
+        :param timeout: maximum time to wait in seconds
+        :return: (paths, lost) with paths the list of the files and
+        directories created or modified, lost always False
+        """
+        wait = self._next_scan - time.monotonic()
+        if wait > timeout:
+            time.sleep(timeout)
+            return [], False
+        time.sleep(max(0, wait))
+        state = self._scan()
+        changed = sorted(path for path, signature in state.items()
+                         if self._state.get(path) != signature)
+        self._state = state
+        self._next_scan = time.monotonic() + self.interval
+        return changed, False
+
+    def close(self):
+        pass
+
+    def _scan(self):
+        # path -> (is_dir, size, mtime) of the entries of the trees
+        state = {}
+        directories = list(self.roots)
+        while directories:
+            directory = directories.pop()
+            try:
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            if self.recursive and not \
+                                    (self.prune and self.prune(entry.path)):
+                                state[entry.path] = (True, None, None)
+                                directories.append(entry.path)
+                        else:
+                            stat = entry.stat(follow_symlinks=False)
+                            state[entry.path] = (False, stat.st_size,
+                                                 stat.st_mtime_ns)
+            except OSError:
+                # removed in the meantime
+                pass
+        return state
+
+
+def watcher(roots, recursive=True, prune=None, interval=POLL_INTERVAL):
+    """
+    Watcher of directory trees, with inotify if possible and polling
+    otherwise
+    :param roots: the directories to watch
+    :param recursive: True to watch the subdirectories as well
+    :param prune: function telling whether a directory is left out with its
+    content, None to watch all of them
+    :param interval: seconds between the scans when polling
+    :return: InotifyWatcher or PollingWatcher
+    """
+    try:
+        return InotifyWatcher(roots, recursive=recursive, prune=prune)
+    except OSError as ex:
+        logging.warning(
+            'Cannot watch with inotify ({}), scanning every {}s'.format(
+                str(ex), interval))
+        return PollingWatcher(roots, recursive=recursive, prune=prune,
+                              interval=interval)
+
+
+class Debouncer(object):
+    """
+    Holds the changed paths back until they stop changing
+    """
+    def __init__(self, settle):
+        """
+        :param settle: seconds without change after which a path is ready
+        """
+        self.settle = settle
+        self._pending = {}
+
+    def add(self, paths, now=None):
+        """
+        Records changes
+        :param paths: the changed paths
+        :param now: time of the changes, time.monotonic() by default
+        """
+        now = time.monotonic() if now is None else now
+        for path in paths:
+            # the latest change counts
+            self._pending.pop(path, None)
+            self._pending[path] = now
+
+    def ready(self, now=None):
+        """
+        Takes the paths that stopped changing
+        :param now: current time, time.monotonic() by default
+        :return: the paths that did not change for settle seconds
+        """
+        now = time.monotonic() if now is None else now
+        ready = [path for path, changed in self._pending.items()
+                 if now - changed >= self.settle]
+        for path in ready:
+            del self._pending[path]
+        return ready
+
+    def next_ready(self):
+        """
+        :return: time.monotonic() time when the next path is ready, None if
+        there are no pending paths
+        """
+        if not self._pending:
+            return None
+        return min(self._pending.values()) + self.settle